@@ -0,0 +1,45 @@
+'''Runs ADXL345 acquisition against a fake SPI device producing samples in real
+time, draining the FIFO per sample (FIFO_BULK_READ = False) and as a block,
+at each sample rate, and reports the acquisition thread's CPU time per second,
+the deepest FIFO level seen and the samples lost to a full FIFO.
+
+    python benchmarks/bench_adxl345_fifo.py [--seconds 3] [--xfer-us 20] [--int-gpio]
+'''
+import argparse
+import os
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..')); sys.path.insert(0, os.path.join(here, '..', 'tests'))
+
+from fake_pigpio import FakePi
+
+from octoprint_ulendocaas.accelerometers.accelerometer_abc import AcclrmtrCfg, AcclrmtrRangeCfg, AcclrmtrRateCfg
+from octoprint_ulendocaas.accelerometers.accelerometer_adxl345 import Adxl345
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=3., help='Length of each collection.')
+    parser.add_argument('--xfer-us', type=float, default=20., help='Time each SPI transfer takes, usec.')
+    parser.add_argument('--int-gpio', action='store_true', help='Wait for watermark edges instead of polling.')
+    args = parser.parse_args()
+
+    print(f'{"rate":>7} {"path":>10} {"status":>10} {"samples":>8} {"lost/s":>7} {"fifo max":>9} {"cpu/s":>7} {"late p99 ms":>12}')
+    for rate in AcclrmtrRateCfg:
+        for bulk_read in (False, True):
+            pi = FakePi(rate=int(rate.name[:-2]), xfer_time=args.xfer_us*1e-6)
+            adxl = Adxl345(AcclrmtrCfg(AcclrmtrRangeCfg['+/-2g'], rate, int_gpio=4 if args.int_gpio else None), rpi=pi)
+            adxl.bulk_read = bulk_read
+            adxl.start(expected_duration=args.seconds)
+            dropped = pi.dropped # Samples lost while the device settled, before collection.
+            t = time.perf_counter()
+            while time.perf_counter() - t < args.seconds and adxl._acq_thread.is_alive(): time.sleep(0.05)
+            elapsed = time.perf_counter() - t
+            adxl.stop()
+
+            stats = adxl.acquisition_stats()
+            print(f'{rate.name:>7} {"block" if bulk_read else "per-sample":>10} {stats["status"]:>10} {stats["samples"]:>8}'
+                  f' {(pi.dropped - dropped)/elapsed:>7.0f} {stats["fifo_max_level"]:>9} {stats.get("cpu_per_sec", 0.):>7.3f}'
+                  f' {stats["late_p99"]*1e3:>12.2f}')
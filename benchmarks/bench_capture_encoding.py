@@ -0,0 +1,62 @@
+'''Sizes and times the capture's wire formats at each sample rate: the legacy
+(base64 float32, the body a JSON-encoded string) and the compact (zlib int16
+counts in a plain JSON body), on 60 s of 3-axis ADXL345-style counts.
+
+    python benchmarks/bench_capture_encoding.py [--levels 1 6]
+'''
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from octoprint_ulendocaas import service_abstraction
+from octoprint_ulendocaas.cfg import CAPTURE_COMPRESS_LEVEL, CAPTURE_ENCODING_LEGACY, CAPTURE_ENCODING_VERSION
+
+
+RATES = [3200, 1600, 800, 400, 200]
+CAPTURE_TI = 60.
+LSB = 2.*2./1024.*9806.65 # +/-2g
+
+
+class Capture():
+    def __init__(self, rate, rng):
+        T = 1./rate; t = np.arange(0., CAPTURE_TI, T); f = 5. + 2.5*t
+        self.lsb = LSB
+        self.x_buff, self.y_buff, self.z_buff = [
+            (np.clip(np.round((a*np.sin(2.*np.pi*np.cumsum(f)*T) + rng.normal(0., 40., t.size))/LSB), -512, 511)*LSB).astype(np.float32)
+            for a in (3000., 1500., 300.)]
+
+
+def encoded_body(capture, capture_encoding):
+    '''The request body as post_run_data sends it.'''
+    postdata = { 'REQUEST': {} }
+    service_abstraction.set_capture_encoding(postdata, capture, capture_encoding)
+    body = json.dumps(postdata) if capture_encoding == CAPTURE_ENCODING_LEGACY else postdata
+    return json.dumps(body).encode('utf-8')
+
+
+def best_of(f, repeat=5): return min(timeit.repeat(f, number=1, repeat=repeat))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--levels', type=int, nargs='*', default=[CAPTURE_COMPRESS_LEVEL], help='zlib levels to compare.')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f'{"rate":>7} {"samples":>8} {"legacy kB":>10} {"ms":>6}' + ''.join(f' {f"zlib-{l} kB":>10} {"ms":>6} {"smaller":>8}' for l in args.levels))
+    for rate in RATES:
+        capture = Capture(rate, rng)
+        legacy = encoded_body(capture, CAPTURE_ENCODING_LEGACY)
+        row = f'{rate:>5}Hz {len(capture.x_buff):>8} {len(legacy)/1e3:>10.1f} {best_of(lambda: encoded_body(capture, CAPTURE_ENCODING_LEGACY))*1e3:>6.1f}'
+        for level in args.levels:
+            service_abstraction.CAPTURE_COMPRESS_LEVEL = level
+            compact = encoded_body(capture, CAPTURE_ENCODING_VERSION)
+            t = best_of(lambda: encoded_body(capture, CAPTURE_ENCODING_VERSION))
+            row += f' {len(compact)/1e3:>10.1f} {t*1e3:>6.1f} {len(legacy)/len(compact):>7.1f}x'
+        print(row)
@@ -0,0 +1,79 @@
+'''Measures the gcode.received hook (proc_rx) in lines per second on typical
+print chatter: idle (fast path), idle while the M115 reply is still awaited,
+and during a sweep (full substring dispatch). For comparison it also times a
+precompiled first-token classifier that would pick out the lines the dispatch
+acts on, to show whether gating the dispatch behind one would pay off.
+
+    python benchmarks/bench_proc_rx.py [--lines 100000]
+'''
+import argparse
+import logging
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from octoprint_ulendocaas import AxisRespnsFSMData, AxisRespnsFSMStates, UlendocaasPlugin
+
+
+CHATTER = [
+    'ok',
+    ' T:210.00 /210.00 B:60.00 /60.00 @:64 B@:0',
+    'ok T:210.0 /210.0 B:60.0 /60.0 @:64 B@:0',
+    'echo:busy: processing',
+    'ok N1234 P15 B3',
+]
+
+# Every line the dispatch acts on starts with or contains one of these.
+classifier = re.compile(r'M494|NAME[:.]|M92|echo:Home|[XYZ]:')
+
+
+def substring_dispatch(line):
+    '''proc_rx's checks, in its order, with the state tests taken as true.'''
+    if 'M494' in line: return 1
+    elif 'X:' in line: return 2
+    elif 'NAME:' in line or line.startswith('NAME.'): return 3
+    elif 'M92' in line: return 4
+    elif 'echo:Home' in line and 'First' in line: return 5
+    return 0
+
+
+def classified_dispatch(line): return substring_dispatch(line) if classifier.search(line) else 0
+
+
+def idle_plugin():
+    '''A plugin as on_after_startup leaves it, minus OctoPrint.'''
+    p = UlendocaasPlugin()
+    p._logger = logging.getLogger('bench'); p.initialized = True; p.log_routine_debug_info = False
+    p.fsm = AxisRespnsFSMData(); p.fsm.state = AxisRespnsFSMStates.IDLE
+    p.metadata = {}; p.rx_metadata_pending = set(); p.rx_metadata_deadline = None
+    p.fsm_post_event = lambda *args: None
+    return p
+
+
+def lines_per_sec(f, lines):
+    t = time.perf_counter()
+    for line in lines: f(line)
+    return len(lines)/(time.perf_counter() - t)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=100000)
+    args = parser.parse_args()
+    lines = (CHATTER*(args.lines//len(CHATTER) + 1))[:args.lines]
+
+    p = idle_plugin()
+    rx = lambda line: p.proc_rx(None, line)
+    cases = [('idle', set(), AxisRespnsFSMStates.IDLE), ('idle, M115 pending', {'FIRMWARE'}, AxisRespnsFSMStates.IDLE),
+             ('sweep', set(), AxisRespnsFSMStates.SWEEP)]
+    print(f'{"proc_rx":<22} {"M lines/s":>10}')
+    for label, pending, state in cases:
+        p.rx_metadata_pending = set(pending); p.rx_metadata_deadline = time.monotonic() + 1e9; p.fsm.state = state; p.fsm.axis = 'x'
+        print(f'{label:<22} {max(lines_per_sec(rx, lines) for _ in range(3))/1e6:>10.2f}')
+
+    print(f'\n{"dispatch only":<22} {"M lines/s":>10}')
+    for label, f in [('substring checks', substring_dispatch), ('classifier first', classified_dispatch)]:
+        print(f'{label:<22} {max(lines_per_sec(f, lines) for _ in range(3))/1e6:>10.2f}')
@@ -0,0 +1,55 @@
+'''Times the frequency map's RANSAC line fit, batched (ransac_line_fit) against
+the per-candidate loop it replaced, for typical numbers of STFT windows.
+
+    python benchmarks/bench_ransac.py
+'''
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from octoprint_ulendocaas.analysis import ransac_line_fit
+from octoprint_ulendocaas.cfg import I2F_CANDIDATE_ERROR_THD, I2F_CONSENSUS_THD, I2F_MAX_ITERATIONS, I2F_RANDOM_IDCS
+
+
+WINDOW_COUNTS = [30, 62, 120, 240] # 62 for the default sweep.
+
+
+def ransac_line_fit_loop(x, y, w, rng):
+    e = np.inf; bm = None
+    for _ in range(I2F_MAX_ITERATIONS):
+        idcs1 = rng.permutation(len(x)); hi = idcs1[:I2F_RANDOM_IDCS]
+        X = np.block([np.ones((I2F_RANDOM_IDCS, 1)), x[hi].reshape(-1, 1)]); W = np.diag(w[hi])
+        bm_ = np.linalg.inv(X.T @ W @ X) @ X.T @ W @ y[hi]
+        e_ = (y[idcs1] - np.block([np.ones((len(idcs1), 1)), x[idcs1].reshape(-1, 1)]) @ bm_)**2
+        idcs2 = idcs1[I2F_RANDOM_IDCS:][np.where(e_[I2F_RANDOM_IDCS:] < I2F_CANDIDATE_ERROR_THD)]
+        if len(idcs2) > I2F_CONSENSUS_THD:
+            idcs = np.block([hi, idcs2])
+            X_ = np.block([np.ones((len(idcs), 1)), x[idcs].reshape(-1, 1)]); W = np.diag(w[idcs])
+            bm__ = np.linalg.inv(X_.T @ W @ X_) @ X_.T @ W @ y[idcs]
+            e__ = np.sum((y[idcs] - np.block([np.ones((len(idcs), 1)), x[idcs].reshape(-1, 1)]) @ bm__)**2)/len(idcs)
+            if e__ < e: e = e__; bm = bm__
+    return bm, e
+
+
+def best_of(f, repeat=5, number=10): return min(timeit.repeat(f, number=number, repeat=repeat))/number
+
+
+if __name__ == '__main__':
+    print(f'{"windows":>8} {"loop ms":>9} {"batched ms":>11} {"speedup":>8} {"same seed, same fit":>20}')
+    for n in WINDOW_COUNTS:
+        rng = np.random.default_rng(n)
+        x = np.linspace(0., 1., n); y = 0.1 + 0.85*x + rng.normal(scale=0.02, size=n)
+        outliers = rng.random(n) < 0.2; y[outliers] = rng.random(outliers.sum())
+        w = rng.random(n)**3
+
+        t_loop = best_of(lambda: ransac_line_fit_loop(x, y, w, np.random.default_rng(0)))
+        fit = lambda: ransac_line_fit(x, y, w, I2F_RANDOM_IDCS, I2F_CANDIDATE_ERROR_THD, I2F_CONSENSUS_THD, I2F_MAX_ITERATIONS,
+                                      rng=np.random.default_rng(0))
+        t_batched = best_of(fit)
+        (bm1, inliers1, e1), (bm2, inliers2, e2) = fit(), fit()
+        same = np.array_equal(bm1, bm2) and np.array_equal(inliers1, inliers2) and e1 == e2
+        print(f'{n:>8} {t_loop*1e3:>9.2f} {t_batched*1e3:>11.2f} {t_loop/t_batched:>7.1f}x {str(same):>20}')
@@ -0,0 +1,53 @@
+'''Times the magnitude plot smoothing (smooth_magnitude) against the per-bin
+dot-product loop it replaced, on the sweep band of captures of increasing
+length. The kernel spans +/-MAG_SMOOTHING_HALF_WIDTH Hz, so its taps grow with
+the capture's length (the spectrum's resolution). The convolution alone is also
+timed directly (np.convolve, as smooth_magnitude does) and by FFT, which only
+pays off from some hundreds of taps, captures far longer than any sweep's.
+
+    python benchmarks/bench_smoothing.py
+'''
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from octoprint_ulendocaas.analysis import smooth_magnitude
+from octoprint_ulendocaas.cfg import MAG_SMOOTHING_HALF_WIDTH
+
+
+CAPTURE_TIS = [25., 50., 100., 200., 400., 800., 1600.] # Sec; the default sweep's capture is about 25 s.
+F0, F1 = 5., 80.
+
+
+def smooth_magnitude_loop(f, mag, half_width):
+    kbp1s = np.arange(start=0, stop=half_width, step=((max(f) - min(f)) / (len(f) - 1)))
+    n = len(kbp1s)
+    k_bp = np.concatenate((np.flip(kbp1s)[:-1], kbp1s))
+    w = k_bp/(sum(k_bp))
+    mag_fild = []
+    for i in range(n-1, len(f) - n): mag_fild.append(np.dot(w, mag[i-n+1 : i+n]))
+    return f[n-1:-n], np.array(mag_fild)
+
+
+def fft_convolve_valid(x, k):
+    N = 1 << (len(x) + len(k) - 2).bit_length() # Power of two at least len(x) + len(k) - 1.
+    return np.fft.irfft(np.fft.rfft(x, N)*np.fft.rfft(k[::-1], N), N)[len(k)-1:len(x)]
+
+
+def best_of(f, number=5, repeat=5): return min(timeit.repeat(f, number=number, repeat=repeat))/number
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    print(f'{"capture s":>10} {"bins":>7} {"taps":>5} {"loop ms":>8} {"smooth ms":>10} {"conv ms":>8} {"fft conv ms":>12}')
+    for ti in CAPTURE_TIS:
+        f = np.arange(round(F0*ti), round(F1*ti))/ti; mag = rng.random(len(f))
+        w = rng.random(2*len(np.arange(0., MAG_SMOOTHING_HALF_WIDTH, (max(f) - min(f))/(len(f) - 1))) - 1)
+        t_loop = best_of(lambda: smooth_magnitude_loop(f, mag, MAG_SMOOTHING_HALF_WIDTH), number=1, repeat=3)
+        t_smooth = best_of(lambda: smooth_magnitude(f, mag, MAG_SMOOTHING_HALF_WIDTH))
+        t_direct = best_of(lambda: np.convolve(mag, w[::-1], mode='valid')); t_fft = best_of(lambda: fft_convolve_valid(mag, w))
+        print(f'{ti:>10.0f} {len(f):>7} {len(w):>5} {t_loop*1e3:>8.2f} {t_smooth*1e3:>10.3f} {t_direct*1e3:>8.3f} {t_fft*1e3:>12.3f}')
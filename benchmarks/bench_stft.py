@@ -0,0 +1,54 @@
+'''Times the frequency map's STFT, batched (stft_peak_frequencies) against the
+per-window loop it replaced, on the default profile at each sample rate.
+
+    python benchmarks/bench_stft.py
+'''
+import os
+import sys
+import timeit
+
+import numpy as np
+
+from math import ceil, floor, pi
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from octoprint_ulendocaas.accelerometers.accelerometer_sim import ChirpConfig, make_acceleration_profile
+from octoprint_ulendocaas.analysis import stft_peak_frequencies
+
+
+RATES = [400, 800, 1600, 3200]
+PROFILE = ChirpConfig(5., 80., 4., 4000., 0.05, 4000., 0.5, 1., 1.) # The plugin's default sweep.
+
+
+def stft_peak_frequencies_loop(data, T, wN, sN, f0, f1):
+    H = 0.5*(1. - np.cos(2.*pi*np.arange(wN)/wN))
+    ns = []; fs = []
+    for i in range(floor((len(data) - wN)/sN) + 1):
+        sidx = sN*i; eidx = sidx + wN
+        Y_ = np.fft.fft(H*data[sidx:eidx])
+        NT = len(Y_)*T; f_ = np.arange(len(Y_))/NT
+        minf_idx = ceil(f0*NT); maxf_idx = floor(f1*NT)
+        f_ = f_[minf_idx:maxf_idx]; Y_ = Y_[minf_idx:maxf_idx]
+        fs.append(f_[np.min(np.argmax(np.abs(Y_)))]); ns.append(round(sidx + eidx)/2)
+    return np.array(ns, dtype=float), np.array(fs)
+
+
+def best_of(f, repeat=5): return min(timeit.repeat(f, number=1, repeat=repeat))
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    print(f'{"rate":>7} {"windows":>8} {"loop ms":>9} {"batched ms":>11} {"speedup":>8} {"max |dbin|":>11}')
+    for rate in RATES:
+        T = 1./rate
+        data = make_acceleration_profile(PROFILE, T, sim=True)
+        data = data + rng.normal(scale=200., size=len(data))
+        wN, sN = round(PROFILE.dfdt/4./T), round(PROFILE.dfdt/4.*(1. - 0.66)/T)
+        args = (data, T, wN, sN, PROFILE.f0, PROFILE.f1)
+
+        t_loop = best_of(lambda: stft_peak_frequencies_loop(*args))
+        t_batched = best_of(lambda: stft_peak_frequencies(*args))
+        ns, fs = stft_peak_frequencies(*args); _, fs_loop = stft_peak_frequencies_loop(*args)
+        dbin = np.max(np.abs(fs - fs_loop))*wN*T
+        print(f'{rate:>5}Hz {len(ns):>8} {t_loop*1e3:>9.1f} {t_batched*1e3:>11.1f} {t_loop/t_batched:>7.1f}x {dbin:>11.0f}')
@@ -6,10 +6,13 @@ import subprocess
 import requests
 import platform
 import struct
+import threading
+import queue
+import time
 import numpy as np
 import re
 
-from math import pi, sqrt, floor, ceil, sin
+from math import pi, sqrt, floor
 from datetime import datetime
 
 from octoprint.util import ResettableTimer
@@ -17,11 +20,15 @@ from octoprint.util.comm import regex_float_pattern, parse_position_line, regex_
 import octoprint.plugin
 
 from .cfg import *
-from .ismags import get_ismag
+from .analysis import analyze_manual, StreamingPeakTrack, AnalysisCancelled, SampleRateTooLow, InsufficientData, WeakSignal, FrequencyMapError, FrequencyMapCrossCheckFailed
+from .analysis_runner import AnalysisRunner
+from .shaper_solver import InpShprSolution, NoResonanceFound, find_resonance, solve_shaper, optimize_shaper
+from .shaper_response_cache import ShaperResponseCache, quantize_wc, quantize_zt, quantize_vtol
 from .service_exceptions import *
+from .service_client import ServiceClient
 from .service_abstraction import autocal_service_solve, autocal_service_guidata, verify_credentials, save_post_as_file, autocal_service_share, save_post_as_file, get_run_post_data
 
-from .accelerometers.accelerometer_abc import AcclrmtrCfg, AcclrmtrRateCfg, AcclrmtrRangeCfg, AcclrmtrSelfTestSts, AcclrmtrStatus
+from .accelerometers.accelerometer_abc import AcclrmtrCfg, AcclrmtrRateCfg, AcclrmtrRangeCfg, AcclrmtrSelfTestSts, AcclrmtrStatus, full_scale_mm_per_sec_sqr
 from .accelerometers.accelerometer_abc import DaemonNotRunning, PigpioNotInstalled, PigpioConnectionFailed, SpiOpenFailed
 from .accelerometers.accelerometer_sim import SimulatedAccelerometer
 from .accelerometers.accelerometer_adxl345 import Adxl345
@@ -57,11 +64,25 @@ AxisRespnsFSMStates = Enum('AxisRespnsFSMStates',
                          'ANALYZE_MANUAL'])
 
 
+AxisRespnsFSMEvents = Enum('AxisRespnsFSMEvents',
+                        ['START',       # Routine started or reset from the tab.
+                         'PRINTER_RX',  # A printer line updated the FSM data.
+                         'ACCLRMTR',    # Accelerometer collection ended (or simulated data ran out).
+                         'PROMPT',      # User answered a prompt popup.
+                         'TIMEOUT',     # Scheduled: state timed out.
+                         'POLL',        # Scheduled: poll the printer.
+                         'SETTLED',     # Scheduled: axis has had time to settle.
+                         'DELAY',       # Scheduled: start delay elapsed.
+                         'ANALYSIS'])   # Background analysis finished.
+
+
 class AxisRespnsFSMData():
     def __init__(self):
         self.state = AxisRespnsFSMStates.INIT
         self.state_prev = AxisRespnsFSMStates.NONE
-        self.in_state_time = 0
+        self.state_seq = 0 # Incremented on each state entry; scheduled events from older entries are dropped.
+        self.state_entry_time = time.monotonic()
+        self.event = None # Event being processed.
 
         # States that should get reset
         self.axis = None
@@ -71,7 +92,7 @@ class AxisRespnsFSMData():
         self.axis_reported_steps_per_mm_recvd = False
         self.axis_last_reported_pos = 0.
 
-        self.axis_centering_wait_time = 0.
+        self.axis_centered = False
         self.sweep_initiated = False
         self.sweep_done_recvd = False
         self.accelerometer_stopped = False
@@ -83,8 +104,8 @@ class AxisRespnsFSMData():
         self.printer_additional_homing_axes = None
 
 
-class InpShprSolution():
-    def __init__(self, wc, zt, w_bp, G): self.wc = wc; self.zt = zt; self.w_bp = w_bp; self.G = G
+    @property
+    def in_state_time(self): return time.monotonic() - self.state_entry_time
 
 
 class SweepConfig:
@@ -93,6 +114,9 @@ class SweepConfig:
         self.step_ti = step_ti; self.step_a = step_a; self.dly1_ti = dly1_ti; self.dly2_ti = dly2_ti; self.dly3_ti = dly3_ti
     def as_dict(self): return { "f0": self.f0, "f1": self.f1, "dfdt": self.dfdt, "a": self.a,
                                 "step_ti": self.step_ti, "step_a": self.step_a, "dly1_ti": self.dly1_ti, "dly2_ti": self.dly2_ti, "dly3_ti": self.dly3_ti }
+    def duration(self):
+        '''Duration of the firmware profile in seconds (matches TrajGenConfig's last breakpoint).'''
+        return (self.dly1_ti + 8.*self.step_ti + self.dly2_ti + self.dly3_ti)/1000. + (self.f1 - self.f0 + 1.)/self.dfdt
 
 
 class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
@@ -120,9 +144,20 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         
         self.fsm = AxisRespnsFSMData()
         self.fsm.state = AxisRespnsFSMStates.IDLE
+        self.fsm_events = queue.Queue()
+        self.fsm_timers = []
+        self.fsm_thread = threading.Thread(target=self.fsm_run, name='ulendocaas-fsm', daemon=True)
+        self.fsm_thread.start()
         
         self.accelerometer = None
 
+        self.service_client = ServiceClient(logger=self._logger)
+        self.analysis_runner = AnalysisRunner(on_progress=self.send_client_analysis_progress)
+        self.analysis_future = None
+        self.peak_track = None
+        self.peak_track_stop = threading.Event()
+        self.peak_track_thread = None
+
         self.sts_self_test_active = False
         self.sts_acclrmtr_connected = False
         self.sts_acclrmtr_active = False
@@ -133,6 +168,7 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         self.sts_manual_mode_ready_for_user_selections = False
         self.sts_manual_calibration_data_ready_for_share = False
         self.sts_manual_calibration_data_shared = False
+        self.shaper_response_cache = ShaperResponseCache()
         self.active_solution = None
         self.active_solution_axis = None
         self.active_verification_result = None
@@ -142,6 +178,10 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         self.calibration_vtol = 0.05
 
         self.metadata = {}
+        self.rx_metadata_pending = {'FIRMWARE'} # Metadata to pick up from printer lines even when no routine runs (OctoPrint sends M115 on connect).
+        self.rx_metadata_deadline = None
+
+        self.refresh_settings_snapshot()
 
         self.verify_credentials_and_update_tab_layout()
     
@@ -172,6 +212,18 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         self.initialized = True
 
 
+    @property
+    def active_solution(self): return self._active_solution
+
+    @active_solution.setter
+    def active_solution(self, solution):
+        '''Shaper responses cached for the previous solution are dropped with it.'''
+        stats = self.shaper_response_cache.stats()
+        if stats['entries'] > 0: self._logger.info(f'Shaper response cache: {stats["hits"]} hits, {stats["misses"]} misses.')
+        self.shaper_response_cache.clear()
+        self._active_solution = solution
+
+
     def send_printer_command(self, cmd):
         if SIMULATION:
             self._logger.info('In simulation: sending command to printer: ' + cmd)
@@ -410,6 +462,15 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         self._plugin_manager.send_plugin_message(self._identifier, data)
 
 
+    def send_client_analysis_progress(self, stage, fraction):
+        data = dict(
+            type='analysis_progress',
+            stage=stage,
+            fraction=fraction
+        )
+        self._plugin_manager.send_plugin_message(self._identifier, data)
+
+
     def send_client_close_popups(self):
         data = dict(
             type='close_popups'
@@ -418,67 +479,91 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
 
 
     def fsm_update(self):
-        if self._settings.get(["log_routine_debug_info"]): self._logger.info(f'FSM update: {self.fsm.state}.')
-
-        if self.fsm.state != self.fsm.state_prev:
-            self.fsm.in_state_time = 0.
-        else:
-            self.fsm.in_state_time += FSM_UPDATE_RATE_SEC        
+        '''Runs the current state's entry or during handler. Returns True if
+        the FSM should be updated again for the same event (the state was just
+        entered, or the during handler moved to a new state).'''
+        if self.log_routine_debug_info: self._logger.info(f'FSM update: {self.fsm.state} ({self.fsm.event}).')
+
+        state = self.fsm.state
+        entering = state != self.fsm.state_prev
+        if entering:
+            self.fsm_cancel_scheduled_events()
+            self.fsm.state_seq += 1
+            self.fsm.state_entry_time = time.monotonic()
 
         if self.fsm.state == AxisRespnsFSMStates.INIT:
             if self.fsm.state_prev != AxisRespnsFSMStates.INIT:
                 self.fsm_on_INIT_entry()
             else:
-                self.fsm_on_INIT_during(); return
+                self.fsm_on_INIT_during()
         elif self.fsm.state == AxisRespnsFSMStates.IDLE:
             if self.fsm.state_prev != AxisRespnsFSMStates.IDLE:
                 self.fsm_on_IDLE_entry()
             else:
-                self.fsm_on_IDLE_during(); return
+                self.fsm_on_IDLE_during()
         elif self.fsm.state == AxisRespnsFSMStates.HOME:
             if self.fsm.state_prev != AxisRespnsFSMStates.HOME:
                 self.fsm_on_HOME_entry()
             else:
-                self.fsm_on_HOME_during(); return
+                self.fsm_on_HOME_during()
         elif self.fsm.state == AxisRespnsFSMStates.CENTER:
             if self.fsm.state_prev != AxisRespnsFSMStates.CENTER:
                 self.fsm_on_CENTER_entry()
             else:
-                self.fsm_on_CENTER_during(); return
+                self.fsm_on_CENTER_during()
         elif self.fsm.state == AxisRespnsFSMStates.GET_AXIS_INFO:
             if self.fsm.state_prev != AxisRespnsFSMStates.GET_AXIS_INFO:
                 self.fsm_on_GET_AXIS_INFO_entry()
             else:
-                self.fsm_on_GET_AXIS_INFO_during(); return
+                self.fsm_on_GET_AXIS_INFO_during()
         elif self.fsm.state == AxisRespnsFSMStates.SWEEP:
             if self.fsm.state_prev != AxisRespnsFSMStates.SWEEP:
                 self.fsm_on_SWEEP_entry()
             else:
-                self.fsm_on_SWEEP_during(); return
+                self.fsm_on_SWEEP_during()
         elif self.fsm.state == AxisRespnsFSMStates.ANALYZE_AUTO:
             if self.fsm.state_prev != AxisRespnsFSMStates.ANALYZE_AUTO:
                 self.fsm_on_ANALYZE_AUTO_entry()
             else:
-                self.fsm_on_ANALYZE_AUTO_during(); return
+                self.fsm_on_ANALYZE_AUTO_during()
         elif self.fsm.state == AxisRespnsFSMStates.ANALYZE_MANUAL:
             if self.fsm.state_prev != AxisRespnsFSMStates.ANALYZE_MANUAL:
                 self.fsm_on_ANALYZE_MANUAL_entry()
             else:
-                self.fsm_on_ANALYZE_MANUAL_during(); return
+                self.fsm_on_ANALYZE_MANUAL_during()
         
-        self.fsm.state_prev = self.fsm.state
+        if entering: self.fsm.state_prev = self.fsm.state
+        return entering or self.fsm.state != state
 
-    
-    def fsm_update_and_manage_tmr(self):
-        
-        self.fsm_update_TMR.cancel()
 
-        self.fsm_update()
+    def fsm_run(self):
+        '''Body of the FSM thread. Each event updates the FSM until it settles,
+        so transitions happen as soon as whatever they wait on arrives.'''
+        while True:
+            event, seq = self.fsm_events.get()
+            if seq is not None and seq != self.fsm.state_seq: continue # Scheduled by a state that has since been left.
+            self.fsm.event = event
+            try:
+                while self.fsm_update(): pass
+            except Exception as e:
+                self._logger.error(f"An error occurred in the calibration routine: {str(e)}")
+                self.fsm_kill()
+
+
+    def fsm_post_event(self, event, seq=None):
+        self.fsm_events.put((event, seq))
+
 
-        # Routine is not finished.
-        if self.fsm.state is not AxisRespnsFSMStates.IDLE:
-            self.fsm_update_TMR = ResettableTimer(FSM_UPDATE_RATE_SEC, self.fsm_update_and_manage_tmr)
-            self.fsm_update_TMR.start()
+    def fsm_schedule_event(self, delay, event):
+        '''Posts `event` after `delay` seconds, unless the current state has been left by then.'''
+        tmr = ResettableTimer(delay, self.fsm_post_event, args=[event, self.fsm.state_seq])
+        self.fsm_timers.append(tmr)
+        tmr.start()
+
+
+    def fsm_cancel_scheduled_events(self):
+        for tmr in self.fsm_timers: tmr.cancel()
+        self.fsm_timers = []
 
 
     def get_selected_calibration_type(self):
@@ -495,13 +580,13 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         if type is None:
             self._logger.error("Can't send result without a calibration selected!")
             return
-        ismag = get_ismag(self.active_solution.w_bp, type, self.active_solution.wc, self.active_solution.zt, vtol=self.calibration_vtol)
+        series = self.shaper_response_cache.series(self.active_solution, type, self.calibration_vtol)
         data = dict(
             type = 'verification_result',
-            w_bp = (self.active_solution.w_bp / 2. / pi).tolist(),
-            oldG = self.active_solution.G.tolist(),
-            compensator_mag = ismag.tolist(),
-            new_mag = (self.active_solution.G * ismag).tolist(),
+            w_bp = series['w_bp'],
+            oldG = series['G'],
+            compensator_mag = series['compensator_mag'],
+            new_mag = series['new_mag'],
             G = self.active_verification_result.tolist()
         )
         self._plugin_manager.send_plugin_message(self._identifier, data)
@@ -514,10 +599,12 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
                 except: pass # We'll ignore a fail here, since it could be
                              # due to the pigpio daemon no longer running.
             self.acclerometer_cfg = AcclrmtrCfg(range=AcclrmtrRangeCfg[self._settings.get(["accelerometer_range"])],
-                                                rate=AcclrmtrRateCfg[self._settings.get(["accelerometer_rate"])])
+                                                rate=AcclrmtrRateCfg[self._settings.get(["accelerometer_rate"])],
+                                                int_gpio=self.get_acclrmtr_int_gpio_setting())
             
-            if SIMULATION: self.accelerometer = SimulatedAccelerometer(self.acclerometer_cfg)
+            if SIMULATION: self.accelerometer = SimulatedAccelerometer(self.acclerometer_cfg, rate_multiplier=SIMULATION_RATE_MULTIPLIER)
             else: self.accelerometer = Adxl345(self.acclerometer_cfg) # FUTURE: Use self._settings.get(["accelerometer_device"])
+            self.accelerometer.event_callback = lambda: self.fsm_post_event(AxisRespnsFSMEvents.ACCLRMTR)
             return True
         except DaemonNotRunning:
             self.send_client_popup(type='error', title='Pigpio Not Running',
@@ -627,12 +714,10 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
             self.send_client_clear_verification_result()
 
             self._logger.info(f'Calibration started on axis: {axis}')
-            self.fsm_update_TMR = ResettableTimer(FSM_UPDATE_RATE_SEC, self.fsm_update_and_manage_tmr)
-            self.fsm_update_TMR.start()
             self.fsm_start(axis)
     
 
-    def on_select_calibration_btn_click(self, type):
+    def on_select_calibration_btn_click(self, type, apply_recommended=True):
         selection_changed = False
         for calibration_key in calibration_keys:
             calibration_btn = getattr(self.tab_layout, 'select_' + calibration_key + '_cal_btn')
@@ -640,6 +725,7 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
                 if not calibration_btn.disabled:
                     selection_changed = calibration_btn.state is not CalibrationSelectionButtonStates.SELECTED
                     calibration_btn.state = CalibrationSelectionButtonStates.SELECTED
+                    if apply_recommended and self.apply_recommended_shaper(type): selection_changed = True
             else:
                 calibration_btn.state = CalibrationSelectionButtonStates.NOTSELECTED
         if selection_changed:
@@ -652,16 +738,24 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
 
 
     def send_client_calibration_result(self, type, reset_sliders=False):
-        ismag = get_ismag(self.active_solution.w_bp, type, self.active_solution.wc, self.active_solution.zt, vtol=self.calibration_vtol)
+        series = self.shaper_response_cache.series(self.active_solution, type, self.calibration_vtol)
         data = dict(
             type = 'calibration_result',
             istype = type, # TODO: Confusing.
-            w_bp = (self.active_solution.w_bp / 2. / pi).tolist(),
-            G = self.active_solution.G.tolist(),
-            compensator_mag = ismag.tolist(),
-            new_mag = (self.active_solution.G * ismag).tolist(),
+            w_bp = series['w_bp'],
+            G = series['G'],
+            compensator_mag = series['compensator_mag'],
+            new_mag = series['new_mag'],
             axis = self.active_solution_axis,
-            reset_sliders = reset_sliders
+            reset_sliders = reset_sliders,
+            zt = self.active_solution.zt,
+            vtol = self.calibration_vtol
+        )
+        self._plugin_manager.send_plugin_message(self._identifier, data)
+
+        data = dict(
+            type = 'shaper_predictions',
+            predictions = self.shaper_response_cache.predictions(self.active_solution, calibration_keys, self.calibration_vtol)
         )
         self._plugin_manager.send_plugin_message(self._identifier, data)
 
@@ -705,11 +799,11 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
             vtol_code = 'R'
         
         printer_configuration_command = 'M493 ' + self.active_solution_axis.upper() + mode_code + ' ' \
-                                        + frequency_code + f'{self.active_solution.wc/2./pi:0.2f}' + ' ' \
-                                        + zeta_code + f'{self.active_solution.zt:0.4f}'
+                                        + frequency_code + f'{self.active_solution.wc/2./pi:0.{M493_FREQUENCY_DECIMALS}f}' + ' ' \
+                                        + zeta_code + f'{self.active_solution.zt:0.{M493_ZETA_DECIMALS}f}'
         ei_type = type in ['ei', 'ei2h', 'ei3h']
         if ei_type:
-            printer_configuration_command += ' ' + vtol_code + f'{self.calibration_vtol:0.2f}'
+            printer_configuration_command += ' ' + vtol_code + f'{self.calibration_vtol:0.{M493_VTOL_DECIMALS}f}'
 
         self._logger.info(f'Configuring printer with: {printer_configuration_command}')
         self.send_client_logger_info('Sent printer: ' + printer_configuration_command \
@@ -725,8 +819,6 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         self.sts_manual_calibration_data_ready_for_share = False
         self.sts_manual_calibration_data_shared = False
         self._logger.info(f'Verification started on axis: {self.active_solution_axis}.')
-        self.fsm_update_TMR = ResettableTimer(FSM_UPDATE_RATE_SEC, self.fsm_update_and_manage_tmr)
-        self.fsm_update_TMR.start()
         self.fsm_start(self.active_solution_axis)
 
         self.update_tab_layout()
@@ -746,8 +838,8 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         val = float(val)
         if (val/100.) != self.calibration_vtol:
             if self.get_selected_calibration_type() == 'ei2h':
-                self.calibration_vtol = max(0.01, val/100.) # 2H EI does not support 0 vtol.
-            else: self.calibration_vtol = val/100.
+                self.calibration_vtol = quantize_vtol(max(0.01, val/100.)) # 2H EI does not support 0 vtol.
+            else: self.calibration_vtol = quantize_vtol(val/100.)
             if self.active_solution_axis == 'x': self.x_calibration_sent_to_printer = False
             elif self.active_solution_axis == 'y': self.y_calibration_sent_to_printer = False
             self.sts_calibration_saved = False
@@ -757,7 +849,7 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
 
 
     def on_damping_slider_update(self, val):
-        self.active_solution.zt = min(0.9999, max(0.0001, float(val)/1000))
+        self.active_solution.zt = quantize_zt(min(0.9999, max(0.0001, float(val)/1000)))
         if self.active_solution_axis == 'x': self.x_calibration_sent_to_printer = False
         elif self.active_solution_axis == 'y': self.y_calibration_sent_to_printer = False
         self.sts_calibration_saved = False
@@ -772,6 +864,8 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         # FSM State Reset
         self.fsm_reset()
         self.fsm.state = AxisRespnsFSMStates.IDLE
+        self.fsm_post_event(AxisRespnsFSMEvents.START)
+        if self.analysis_runner.cancel(): self.send_client_analysis_progress('Cancelled', 1.)
 
         # Plugin Data Reset
         self.sts_self_test_active = False
@@ -794,11 +888,13 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
     def on_prompt_cancel_click(self):
         self.awaiting_prompt_popup_reply = False
         self.prompt_popup_response = 'cancel'
+        self.fsm_post_event(AxisRespnsFSMEvents.PROMPT)
 
 
     def on_prompt_proceed_click(self):
         self.awaiting_prompt_popup_reply = False
         self.prompt_popup_response = 'proceed'
+        self.fsm_post_event(AxisRespnsFSMEvents.PROMPT)
 
 
     def on_accelerometer_data_plot_click(self, xval):
@@ -810,13 +906,14 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
 
         is_first_freq_selection = self.active_solution.wc is None # Infer this is the first selection on this calibration run.
 
-        self.active_solution.wc = f*2.*pi
+        if self.active_solution.replaced is not None: self.calibration_vtol = self.active_solution.replaced[2]
+        self.active_solution.recommendation = None; self.active_solution.replaced = None # Designed for the previous frequency.
+        self.active_solution.wc = quantize_wc(f*2.*pi)
         self.active_solution.zt = 0.1
 
-        if is_first_freq_selection:
-            self.tab_layout.select_zvd_cal_btn.disabled = False
-            self.on_select_calibration_btn_click('zvd') # Set ZVD as default shaper selection.
-            self.send_client_close_popups()
+        # Rebuilds the recommendation and its table for the new frequency; the first pick also selects the default shaper.
+        self.select_recommended_shaper(select=is_first_freq_selection)
+        if is_first_freq_selection: self.send_client_close_popups()
         
         if self.active_solution_axis == 'x': self.x_calibration_sent_to_printer = False
         elif self.active_solution_axis == 'y': self.y_calibration_sent_to_printer = False
@@ -883,7 +980,7 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
             check_status = verify_credentials(self._settings.get(["ORG"]),
                                               self._settings.get(["ACCESSID"]),
                                               self._settings.get(["MACHINEID"]),
-                                              self._logger)
+                                              self._logger, client=self.service_client)
         except Exception as e:
             self.handle_calibration_service_exceptions(e)
             check_status = False
@@ -891,16 +988,35 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         self.update_tab_layout()
 
 
+    def get_acclrmtr_int_gpio_setting(self):
+        int_gpio = self._settings.get(["accelerometer_int_gpio"])
+        return int(int_gpio) if int_gpio not in [None, ''] else None
+
+
     def check_accelerometer_settings_changed(self):
         if self.accelerometer is not None:
             if (self.acclerometer_cfg.range != AcclrmtrRangeCfg[self._settings.get(["accelerometer_range"])]
                 or
-                self.acclerometer_cfg.rate != AcclrmtrRateCfg[self._settings.get(["accelerometer_rate"])]):
+                self.acclerometer_cfg.rate != AcclrmtrRateCfg[self._settings.get(["accelerometer_rate"])]
+                or
+                self.acclerometer_cfg.int_gpio != self.get_acclrmtr_int_gpio_setting()):
                 self.sts_acclrmtr_connected = False
                 self.accelerometer = None
                 self.update_tab_layout()
             
 
+    def refresh_settings_snapshot(self):
+        '''Caches settings read on hot paths (e.g. for every line from the printer).'''
+        self.log_routine_debug_info = self._settings.get(["log_routine_debug_info"])
+
+
+    ##~~ SettingsPlugin mixin
+    def on_settings_save(self, data):
+        diff = octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self.refresh_settings_snapshot()
+        return diff
+
+
     def on_settings_close(self):
         self.verify_credentials_and_update_tab_layout()
         self.check_accelerometer_settings_changed()
@@ -919,6 +1035,11 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         if not self.initialized:
             self._logger.error(f'Ignored line from printer "{line}" because not yet initialized.')
             return line
+
+        if self.rx_metadata_pending: self.expire_rx_metadata_pending(line)
+        # Fast path for the bulk of the traffic (e.g. ok/temperature reports while printing).
+        if self.fsm.state is AxisRespnsFSMStates.IDLE and not self.rx_metadata_pending: return line
+
         try:
             if 'M494' in line:
                 if 'FTMCFG' in line:
@@ -932,16 +1053,19 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
                                 if key == self.fsm.axis.upper() + '_MAX_LENGTH':
                                     self.fsm.axis_reported_len_recvd = True
                                     self.fsm.axis_reported_len = float(result[key])
+                                    self.fsm_post_event(AxisRespnsFSMEvents.PRINTER_RX)
                     self.metadata['FTMCFG'] = result
-                    if self._settings.get(["log_routine_debug_info"]): self._logger.info('Metadata updated (received FTMCFG):'); self._logger.info(self.metadata)
+                    if self.log_routine_debug_info: self._logger.info('Metadata updated (received FTMCFG):'); self._logger.info(self.metadata)
                 elif 'profile ran to completion' in line:
                     if self.fsm.state == AxisRespnsFSMStates.SWEEP:
                         self.fsm.sweep_done_recvd = True
-                        if self._settings.get(["log_routine_debug_info"]): self._logger.info(f'Got sweep done message.')
+                        self.fsm_post_event(AxisRespnsFSMEvents.PRINTER_RX)
+                        if self.log_routine_debug_info: self._logger.info(f'Got sweep done message.')
 
             elif self.fsm.state == AxisRespnsFSMStates.CENTER and (self.fsm.axis.upper() + ':') in line:
                 self.fsm.axis_last_reported_pos = parse_position_line(line)[self.fsm.axis]
-                if self._settings.get(["log_routine_debug_info"]): self._logger.info(f'Got reported position = {self.fsm.axis_last_reported_pos}.')
+                self.fsm_post_event(AxisRespnsFSMEvents.PRINTER_RX)
+                if self.log_routine_debug_info: self._logger.info(f'Got reported position = {self.fsm.axis_last_reported_pos}.')
             elif 'NAME:' in line or line.startswith('NAME.'):
                 split_line = regex_firmware_splitter.split(line.strip())[
                     1:
@@ -951,7 +1075,8 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
                         result[key] = value.strip()
                 if result.get('FIRMWARE_NAME') is not None:
                     self.metadata['FIRMWARE'] = result
-                    if self._settings.get(["log_routine_debug_info"]): self._logger.info('Metadata updated (received firmware name):'); self._logger.info(self.metadata)
+                    self.rx_metadata_pending.discard('FIRMWARE')
+                    if self.log_routine_debug_info: self._logger.info('Metadata updated (received firmware name):'); self._logger.info(self.metadata)
             elif 'M92' in line:
                 match = regex_steps_per_unit.search(line)
                 if match is not None:
@@ -960,15 +1085,18 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
                         "y": float(match.group("y")),
                         "z": float(match.group("z")),
                     }
-                    self.fsm.axis_reported_steps_per_mm = result[self.fsm.axis]
-                    self.fsm.axis_reported_steps_per_mm_recvd = True
+                    if self.fsm.axis is not None:
+                        self.fsm.axis_reported_steps_per_mm = result[self.fsm.axis]
+                        self.fsm.axis_reported_steps_per_mm_recvd = True
+                        self.fsm_post_event(AxisRespnsFSMEvents.PRINTER_RX)
                     self.metadata['STEPSPERUNIT'] = str(result)
-                    if self._settings.get(["log_routine_debug_info"]): self._logger.info('Metadata updated (received M92):'); self._logger.info(self.metadata)
+                    if self.log_routine_debug_info: self._logger.info('Metadata updated (received M92):'); self._logger.info(self.metadata)
             elif self.fsm.state == AxisRespnsFSMStates.CENTER and 'echo:Home' in line and 'First' in line:
                 split_line_0 = re.split(r"echo:Home ", line.strip())
                 split_line_1 = re.split(r" First", split_line_0[1].strip())
                 self.fsm.printer_requires_additional_homing = True
                 self.fsm.printer_additional_homing_axes = split_line_1[0]
+                self.fsm_post_event(AxisRespnsFSMEvents.PRINTER_RX)
 
             return line
         except Exception as e:
@@ -976,6 +1104,18 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
             return line
 
 
+    def expire_rx_metadata_pending(self, line):
+        '''Stops looking for metadata outside a routine RX_METADATA_TIMEOUT_SEC after the
+        first printer line, or at the first position report (the connect handshake,
+        M115 included, is over by then), so firmware that never answers doesn't keep
+        the hook off its fast path.'''
+        now = time.monotonic()
+        if self.rx_metadata_deadline is None: self.rx_metadata_deadline = now + RX_METADATA_TIMEOUT_SEC
+        if now > self.rx_metadata_deadline or ' Count ' in line:
+            self._logger.info(f'Stopped waiting for printer metadata: {", ".join(sorted(self.rx_metadata_pending))}.')
+            self.rx_metadata_pending.clear()
+
+
     # TODO: 
     def get_update_information(self):
         # Define the configuration for your plugin to use with the Software Update
@@ -1001,9 +1141,10 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
     def handle_calibration_service_exceptions(self, e):
         try: raise e
         except requests.exceptions.Timeout:
+            timeout = SERVICE_CONNECT_TIMEOUT if isinstance(e, requests.exceptions.ConnectTimeout) else SERVICE_TIMEOUT_THD
             self.send_client_popup(type='error', title='Timed out connecting to Ulendo server.',
                                     message=f'Timed out connecting to the Ulendo server af'\
-                                    f'ter {SERVICE_TIMEOUT_THD} seconds.', hide=False)
+                                    f'ter {timeout:.0f} seconds.', hide=False)
         except (requests.exceptions.HTTPError,
                     requests.exceptions.ConnectionError,
                     requests.exceptions.RequestException):
@@ -1061,9 +1202,9 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
     def share_calibration_data(self, show_errors=True):
             try:
                 if self.sts_axis_verification_active:
-                    autocal_service_share(self._plugin_version, self.fsm.axis, self.sts_axis_verification_active, self.accelerometer, self.sweep_cfg, self.metadata, self._settings, self._logger, self.get_selected_calibration_type(), self.active_solution.wc, self.active_solution.zt, self.calibration_vtol)
+                    autocal_service_share(self._plugin_version, self.fsm.axis, self.sts_axis_verification_active, self.accelerometer, self.sweep_cfg, self.metadata, self._settings, self._logger, self.get_selected_calibration_type(), self.active_solution.wc, self.active_solution.zt, self.calibration_vtol, client=self.service_client)
                 else:
-                    autocal_service_share(self._plugin_version, self.fsm.axis, self.sts_axis_verification_active, self.accelerometer, self.sweep_cfg, self.metadata, self._settings, self._logger)
+                    autocal_service_share(self._plugin_version, self.fsm.axis, self.sts_axis_verification_active, self.accelerometer, self.sweep_cfg, self.metadata, self._settings, self._logger, client=self.service_client)
             except requests.exceptions.ConnectionError:
                 if show_errors: self.send_client_popup( type='info', title='Sharing Data Failed',
                                                         message=f'Sharing the calibration data failed because the service' \
@@ -1088,7 +1229,7 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         self.fsm.axis_reported_steps_per_mm_recvd = False
         self.fsm.axis_last_reported_pos = 0.
 
-        self.fsm.axis_centering_wait_time = 0.
+        self.fsm.axis_centered = False
         self.fsm.sweep_initiated = False
         self.fsm.sweep_done_recvd = False
         self.fsm.accelerometer_stopped = False
@@ -1153,17 +1294,18 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         self.send_printer_command('M92')
         self.send_client_popup(type='info', title='Calibrating',
                                    message='Initiating calibration sweep procedure...')
+        self.fsm_schedule_event(GET_AXIS_INFO_TIMEOUT, AxisRespnsFSMEvents.TIMEOUT)
 
     
     def fsm_on_GET_AXIS_INFO_during(self):
-        if self.fsm.in_state_time > GET_AXIS_INFO_TIMEOUT:
+        if self.fsm.event is AxisRespnsFSMEvents.TIMEOUT:
             self.sts_axis_calibration_active = False
             self.sts_axis_verification_active = False
             self.send_client_popup(type='error', title='Axis Info. Error',
                                    message='Couldn\'t get information about the axis. Is the firmware compatible?')
             self.fsm_kill()
         else:
-            if self.fsm.axis_reported_len_recvd:
+            if self.fsm.axis_reported_len_recvd and self.fsm.axis_reported_steps_per_mm_recvd:
                 if (self._settings.get(["home_axis_before_calibration"])):
                     self.fsm.state = AxisRespnsFSMStates.CENTER
                 else: self.fsm.state = AxisRespnsFSMStates.SWEEP
@@ -1174,22 +1316,30 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
     
     def fsm_on_CENTER_entry(self):
         self.send_printer_command('G1 ' + self.fsm.axis.upper() + str(round(self.fsm.axis_reported_len/2)) + ' F' + str(MOVE_TO_CENTER_SPEED_MM_PER_MIN))
+        self.send_printer_command('M114')
+        self.fsm_schedule_event(CENTER_POSITION_POLL_SEC, AxisRespnsFSMEvents.POLL)
+        self.fsm_schedule_event(CENTER_AXIS_TIMEOUT, AxisRespnsFSMEvents.TIMEOUT)
 
     
     def fsm_on_CENTER_during(self):
         if self.fsm.printer_requires_additional_homing:
             self.fsm.axis_reported_len_recvd = False
-            self.fsm.state = AxisRespnsFSMStates.HOME
-        self.send_printer_command('M114')
-        if self._settings.get(["log_routine_debug_info"]): self._logger.info(f'on_CENTER vars: {self.fsm.axis_last_reported_pos}, {self.fsm.axis_reported_len}, {self.fsm.axis_centering_wait_time}.')
-        if abs(self.fsm.axis_last_reported_pos - self.fsm.axis_reported_len/2) < 1. or not self._settings.get(["home_axis_before_calibration"]) or SIMULATION:
-            if self.fsm.axis_centering_wait_time >= self.fsm.axis_reported_len/2/(MOVE_TO_CENTER_SPEED_MM_PER_MIN/60):
-                self.fsm.state = AxisRespnsFSMStates.SWEEP
-            self.fsm.axis_centering_wait_time += FSM_UPDATE_RATE_SEC
-        if self.fsm.in_state_time > CENTER_AXIS_TIMEOUT:
+            self.fsm.state = AxisRespnsFSMStates.HOME; return
+        if self.fsm.event is AxisRespnsFSMEvents.TIMEOUT:
             self.send_client_popup(type='error', title='Axis Center Timeout',
                                    message='Unknown error moving the axis to center.')
-            self.fsm_kill()
+            self.fsm_kill(); return
+        if self.fsm.event is AxisRespnsFSMEvents.POLL:
+            self.send_printer_command('M114')
+            self.fsm_schedule_event(CENTER_POSITION_POLL_SEC, AxisRespnsFSMEvents.POLL)
+        if self.log_routine_debug_info: self._logger.info(f'on_CENTER vars: {self.fsm.axis_last_reported_pos}, {self.fsm.axis_reported_len}, {self.fsm.axis_centered}.')
+        if abs(self.fsm.axis_last_reported_pos - self.fsm.axis_reported_len/2) < 1. or not self._settings.get(["home_axis_before_calibration"]) or SIMULATION:
+            if not self.fsm.axis_centered:
+                # Reported position can lead the actual one, so allow the move's duration to pass.
+                self.fsm.axis_centered = True
+                self.fsm_schedule_event(self.fsm.axis_reported_len/2/(MOVE_TO_CENTER_SPEED_MM_PER_MIN/60), AxisRespnsFSMEvents.SETTLED)
+            elif self.fsm.event is AxisRespnsFSMEvents.SETTLED:
+                self.fsm.state = AxisRespnsFSMStates.SWEEP
     
 
     def fsm_on_SWEEP_entry(self):
@@ -1218,15 +1368,22 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
                                                      self.sweep_cfg.a, self.sweep_cfg.step_ti/1000., self.sweep_cfg.step_a,
                                                      self.sweep_cfg.dly1_ti/1000., self.sweep_cfg.dly2_ti/1000., self.sweep_cfg.dly3_ti/1000.)
         
-        self.accelerometer.start()
+        self.peak_track = None
+        if not self._settings.get(["use_caas_service"]):
+            self.analysis_runner.warm_up()
+            if not self.sts_axis_verification_active and self._settings.get(["i2f_estimator"]) == 'stft':
+                self.peak_track = StreamingPeakTrack(self.sweep_cfg, self.accelerometer.T)
+        self.accelerometer.start(expected_duration=FSM_SWEEP_START_DLY + self.sweep_cfg.duration())
+        if self.peak_track is not None: self.start_peak_tracking()
         self.sts_acclrmtr_active = True
         self.send_client_acclrmtr_data_TMR = ResettableTimer(ACCLRMTR_LIVE_VIEW_RATE_SEC, self.send_client_acclrmtr_data)
         self.send_client_acclrmtr_data_TMR.start()
+        self.fsm_schedule_event(FSM_SWEEP_START_DLY, AxisRespnsFSMEvents.DELAY)
         
 
     def fsm_on_SWEEP_during(self):
         
-        if self.fsm.in_state_time > FSM_SWEEP_START_DLY and not self.fsm.sweep_initiated:
+        if self.fsm.event is AxisRespnsFSMEvents.DELAY and not self.fsm.sweep_initiated:
             if not SIMULATION:
                 # M494
                 #
@@ -1271,7 +1428,9 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
 
         if stop_accelerometer and not self.fsm.accelerometer_stopped:
             self.accelerometer.stop()
-            if self._settings.get(["log_routine_debug_info"]): self._logger.info('Triggering accelerometer data collection stop.')
+            if self.log_routine_debug_info:
+                self._logger.info('Triggering accelerometer data collection stop.')
+                self._logger.info(f'Acquisition stats: {self.accelerometer.acquisition_stats()}.')
             self.fsm.accelerometer_stopped = True
 
         if self.accelerometer.status != AcclrmtrStatus.COLLECTING:
@@ -1313,24 +1472,36 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         if not self.sts_axis_verification_active:
             try:
                 self.send_client_popup(type='info', title='Processing Data', message='Processing data, please wait...')
-                wc, zt, w_gui_bp, G_gui = autocal_service_solve(self._plugin_version, self.fsm.axis, self.accelerometer, self.sweep_cfg, self.metadata, self._settings)
+                wc, zt, w_gui_bp, G_gui = autocal_service_solve(self._plugin_version, self.fsm.axis, self.accelerometer, self.sweep_cfg, self.metadata, self._settings, client=self.service_client)
                 self.send_client_popup(type='success', title='Calibration Received', message='')
                 
+            except requests.exceptions.RequestException as e: # Service unreachable; solve on the device instead.
+                self._logger.error(f'Calibration service request failed, solving locally: {e!r}')
+                try: self.active_solution = self.solve_locally()
+                except Exception as e_local:
+                    self._logger.info(f'Local solver fallback failed: {e_local}.')
+                    self.handle_calibration_service_exceptions(e)
+                    self.active_solution = None
+                else:
+                    self.send_client_popup(type='info', title='Calibrated Offline',
+                                            message='The Ulendo server could not be reached, so the calibration'\
+                                                    ' was computed on this device.', hide=False)
             except Exception as e:
                 self.handle_calibration_service_exceptions(e)
                 self.active_solution = None
             else:
                 self.active_solution = InpShprSolution(wc, zt, w_gui_bp, G_gui)
-                self.active_solution_axis = self.fsm.axis
-                self.tab_layout.select_zvd_cal_btn.disabled = False
-                self.on_select_calibration_btn_click('zvd') # Set ZVD as default shaper selection.
+                self.log_local_solver_cross_check()
             finally:
+                if self.active_solution is not None:
+                    self.active_solution_axis = self.fsm.axis
+                    self.select_recommended_shaper()
                 self.sts_axis_calibration_active = False
                 self.update_tab_layout()
         else:
             try:
                 self.send_client_popup(type='info', title='Verifying Calibration', message='Please wait...')
-                _, g_gui = autocal_service_guidata(self._plugin_version, self.fsm.axis, self.accelerometer, self.sweep_cfg, self.metadata, self._settings)
+                _, g_gui = autocal_service_guidata(self._plugin_version, self.fsm.axis, self.accelerometer, self.sweep_cfg, self.metadata, self._settings, client=self.service_client)
 
             except Exception as e:
                 self.handle_calibration_service_exceptions(e)
@@ -1348,6 +1519,74 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
                 self.update_tab_layout()
         return
 
+
+    def solve_locally(self):
+        '''Local analysis and solution of the last sweep.'''
+        data = self.accelerometer.x_buff if self.fsm.axis == 'x' else self.accelerometer.y_buff
+        result = analyze_manual(data, self.sweep_cfg, self.accelerometer.T,
+                                full_scale=full_scale_mm_per_sec_sqr(self.acclerometer_cfg.range),
+                                rng=np.random.default_rng(I2F_RANDOM_SEED),
+                                i2f_estimator=self._settings.get(["i2f_estimator"]))
+        solution = solve_shaper(result.f_bp*2.*pi, result.mag_fild)
+        self._logger.info(f'Local solver result: {solution.wc/2./pi:.2f} Hz, zt={solution.zt:.3f}.')
+        return solution
+
+
+    def log_local_solver_cross_check(self):
+        try: wc, zt = find_resonance(self.active_solution.w_bp, self.active_solution.G)
+        except NoResonanceFound as e: self._logger.info(f'Local solver cross-check: {e}'); return
+        self._logger.info(f'Local solver cross-check: {wc/2./pi:.2f} Hz, zt={zt:.3f} vs. service'\
+                          f' {self.active_solution.wc/2./pi:.2f} Hz, zt={self.active_solution.zt:.3f}.')
+
+    
+    def select_recommended_shaper(self, select=True):
+        '''Sends the tab the optimizer's table of candidates for the active solution and,
+        with `select`, selects ZVD at the solution's parameters, or the recommendation if
+        set to. The recommended design is kept on the solution, for when it is picked.'''
+        type = 'zvd' # Default shaper selection.
+        auto_apply = self._settings.get(["auto_apply_recommended_shaper"])
+        try: recommended, table = optimize_shaper(self.active_solution.w_bp, self.active_solution.G, self.active_solution.wc,
+                                                            self.active_solution.zt, calibration_keys)
+        except Exception as e:
+            self._logger.info(f'Shaper optimizer failed: {e}')
+            self._plugin_manager.send_plugin_message(self._identifier, dict(type='shaper_table', recommended=None, candidates=[])) # Hides any previous table.
+        else:
+            for c in table:
+                self._logger.info(f'Shaper optimizer candidate: {c.type} at {c.wc/2./pi:.2f} Hz, zt={c.zt:.3f}'\
+                                  + (f', vtol={c.vtol:.2f}' if c.vtol is not None else '')\
+                                  + f'; residual={c.residual:.3f}, delay={c.delay*1000.:.1f} ms{" (Pareto)" if c.pareto else ""}.')
+            self._logger.info(f'Shaper optimizer recommends {recommended.type}.')
+            self.active_solution.recommendation = recommended
+
+            data = dict(
+                type = 'shaper_table',
+                recommended = recommended.type,
+                candidates = [c.as_dict() for c in table]
+            )
+            self._plugin_manager.send_plugin_message(self._identifier, data)
+            if auto_apply: type = recommended.type
+
+        if not select: return
+        getattr(self.tab_layout, 'select_' + type + '_cal_btn').disabled = False
+        self.on_select_calibration_btn_click(type, apply_recommended=auto_apply)
+
+
+    def apply_recommended_shaper(self, type):
+        '''Loads the recommended design's parameters when its type is selected, and
+        the solution's own back when another type is. Returns True if they changed.'''
+        solution = self.active_solution
+        if solution is None or solution.recommendation is None: return False
+        recommended = solution.recommendation
+        if type == recommended.type and solution.replaced is None:
+            solution.replaced = (solution.wc, solution.zt, self.calibration_vtol)
+            solution.wc = quantize_wc(recommended.wc); solution.zt = quantize_zt(recommended.zt)
+            if recommended.vtol is not None: self.calibration_vtol = quantize_vtol(recommended.vtol)
+            return True
+        if type != recommended.type and solution.replaced is not None:
+            solution.wc, solution.zt, self.calibration_vtol = solution.replaced; solution.replaced = None
+            return True
+        return False
+
     
     def fsm_on_ANALYZE_AUTO_during(self):
         self.fsm.state = AxisRespnsFSMStates.IDLE
@@ -1374,185 +1613,112 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
                                             ' enable the associated option in the plugin\'s settings.',
                                     hide=False)
 
-        # Following logic is known to fail for data rates below 400 Hz, so perform a check.
-        if self.accelerometer.T > (1/300.):
-            self.send_client_popup(type='error', title='Accelerometer sample rate too low.',
-                                    message='Accelerometer sample rate too low to perform analysis.'\
-                                            ' Try setting the rate higher in the plugin\'s settings.', hide=False)
-            self.fsm_on_ANALYZE_MANUAL_error(); return
-
         self.fsm.missed_sample_retry_count = 0
 
-        # Select axis data and trim.
+        self.stop_peak_tracking()
         data = self.accelerometer.x_buff if self.fsm.axis == 'x' else self.accelerometer.y_buff
-        data = np.array(data)
-        
-        n_0_ = round(LOC_DLY2_TI/self.accelerometer.T)
-        m_0_ = round(self.sweep_cfg.dly2_ti/1000./self.accelerometer.T)
-        o_0_ = round(self.sweep_cfg.dly1_ti/1000./self.accelerometer.T)
+        self.analysis_runner.submit(lambda future, seq=self.fsm.state_seq: self.on_analysis_done(future, seq),
+                                    data, self.sweep_cfg, self.accelerometer.T,
+                                    full_scale=full_scale_mm_per_sec_sqr(self.acclerometer_cfg.range),
+                                    verification=self.sts_axis_verification_active,
+                                    rng=np.random.default_rng(I2F_RANDOM_SEED),
+                                    track=self.peak_track,
+                                    i2f_estimator=self._settings.get(["i2f_estimator"]))
+
+
+    def start_peak_tracking(self):
+        self.stop_peak_tracking()
+        self.peak_track_stop.clear()
+        self.peak_track_thread = threading.Thread(target=self.run_peak_tracking, args=[self.peak_track, self.fsm.axis],
+                                                  name='ulendocaas-peak-track', daemon=True)
+        self.peak_track_thread.start()
+
+
+    def stop_peak_tracking(self):
+        self.peak_track_stop.set()
+        if self.peak_track_thread is not None: self.peak_track_thread.join(); self.peak_track_thread = None
+
+
+    def run_peak_tracking(self, track, axis):
+        '''Feeds the capture to the streaming analysis while the sweep runs.'''
+        accelerometer = self.accelerometer
+        while not self.peak_track_stop.wait(STREAMING_ANALYSIS_PERIOD_SEC):
+            if accelerometer.status != AcclrmtrStatus.COLLECTING: return
+            try: track.feed(accelerometer.x_buff if axis == 'x' else accelerometer.y_buff)
+            except Exception as e:
+                self._logger.info(f'Streaming analysis stopped: {e}.'); return
+
+
+    def on_analysis_done(self, future, seq):
+        self.analysis_future = future
+        self.fsm_post_event(AxisRespnsFSMEvents.ANALYSIS, seq)
 
-        n_1_ = round(LOC_DLY3_TI/self.accelerometer.T)
-        m_1_ = round(self.sweep_cfg.dly3_ti/1000./self.accelerometer.T)
 
-        if len(data) < (o_0_ + n_0_ + m_0_ + n_1_ + m_1_):
-            self.send_client_popup(type='error', title='Data length error 1.',
+    def fsm_on_ANALYZE_MANUAL_result(self, future):
+        self.send_client_analysis_progress('Done', 1.)
+        try:
+            result = future.result()
+        except AnalysisCancelled:
+            self.fsm_on_ANALYZE_MANUAL_error(); return
+        except SampleRateTooLow:
+            self.send_client_popup(type='error', title='Accelerometer sample rate too low.',
+                                    message='Accelerometer sample rate too low to perform analysis.'\
+                                            ' Try setting the rate higher in the plugin\'s settings.', hide=False)
+            self.fsm_on_ANALYZE_MANUAL_error(); return
+        except InsufficientData as e:
+            self.send_client_popup(type='error', title=f'Data length error {e.stage}.',
                                     message='Insufficient data collected. Try adjusting the calibration'
                                             ' profile in the plugin\'s settings.', hide=False)
             self.fsm_on_ANALYZE_MANUAL_error(); return
-
-        data -= np.sum(data)/len(data)
-
-        minima_ = np.zeros((n_0_,))
-        for i in range(n_0_): minima_[i] = np.sum(np.abs(data[o_0_+i:o_0_+i+m_0_]))
-        dly1_idx = o_0_ + np.max(np.argmin(minima_))
-
-        minima_ = np.zeros((n_1_,))
-        for i in range(n_1_): minima_[i] = np.sum(np.abs(data[-n_1_-m_1_+i:-n_1_+i]))
-        dly2_idx = len(data) - n_1_ - m_1_ + np.min(np.argmin(minima_))
-        
-        data = data[dly1_idx+m_0_:dly2_idx]
+        except WeakSignal as e:
+            self._logger.info(f'Signal quality: {e.signal_quality}.')
+            self.send_client_popup(type='error', title='Weak signal detected.',
+                                    message='Could not calibrate due to a weak signal. Is '\
+                                    'the accelerometer mounted on the correct axis and in '\
+                                    'the correct orientation?', hide=False)
+            self.fsm_on_ANALYZE_MANUAL_error(); return
+        except FrequencyMapCrossCheckFailed as e:
+            self._logger.info(f'Frequency map result: {e.i2f_bm[0]:.3f};{e.i2f_bm[1]:.9f};{e.bm1_expected:.9f}; ratio={e.i2f_bm[1]/e.bm1_expected:.3f}.')
+            self.send_client_popup(type='error', title='Error in frequency analysis.',
+                                    message='The mapping cross check failed. Please try again.', hide=False)
+            self.fsm_on_ANALYZE_MANUAL_error(); return
+        except FrequencyMapError:
+            self.send_client_popup(type='error', title='Error in frequency analysis.', message='Please try again using the default profile settings.', hide=False)
+            self.fsm_on_ANALYZE_MANUAL_error(); return
+        except Exception as e:
+            self.send_client_popup(type='error', title='Error in analysis.', message=str(e), hide=False)
+            self.fsm_on_ANALYZE_MANUAL_error(); return
+        data = result.data
 
         if not self.sts_axis_verification_active:
-            # Gross check.
-            weak_signal_check_n = round(WEAK_SIGNAL_CHECK_TI/self.accelerometer.T)
-
-            if len(data) < weak_signal_check_n:
-                self.send_client_popup(type='error', title='Data length error 2.',
-                                        message='Insufficient data collected. Try adjusting the calibration'
-                                                ' profile in the plugin\'s settings.', hide=False)
-                self.fsm_on_ANALYZE_MANUAL_error(); return
-
-            k1 = pi*self.sweep_cfg.dfdt
-            k2 = 2.*pi*self.sweep_cfg.f0
-            weak_signal_accum_meas = 0.
-            weak_signal_accum_expctd = 0.
-            for i in range(weak_signal_check_n):
-                tau = i*self.accelerometer.T
-                weak_signal_accum_expctd += abs(-self.sweep_cfg.a*sin(k1*tau*tau + k2*tau))
-                weak_signal_accum_meas += abs(data[i])
-
-            self._logger.info(f'Weak signal check stats: {weak_signal_accum_meas:.1f}/{weak_signal_accum_expctd:.1f} = {weak_signal_accum_meas/weak_signal_accum_expctd:.2f}.')
-
-            if weak_signal_accum_meas/weak_signal_accum_expctd < WEAK_SIGNAL_CHECK_THD:
-                self.send_client_popup(type='error', title='Weak signal detected.',
-                                        message='Could not calibrate due to a weak signal. Is '\
-                                        'the accelerometer mounted on the correct axis and in '\
-                                        'the correct orientation?', hide=False)
-                self.fsm_on_ANALYZE_MANUAL_error(); return
-
-            # Compute magnitude for the plot.
-            Y = np.fft.fft(data)
-            NT = len(Y)*self.accelerometer.T
-            f = np.arange(len(Y))/NT
-            Y = Y/(len(data)/2)
-
-            f0_idx = ceil(self.sweep_cfg.f0*NT)
-            f1_idx = floor(self.sweep_cfg.f1*NT)
-
-            mag = np.abs(Y)*(self.sweep_cfg.f1-self.sweep_cfg.f0)/self.sweep_cfg.a/sqrt(self.sweep_cfg.dfdt)
-
-            f = f[f0_idx:f1_idx]; mag = mag[f0_idx:f1_idx]
-
-            # Filter the data for a nicer plot.
-            kbp1s = np.arange(start=0, stop=0.4, step=((max(f) - min(f)) / (len(f) - 1)))
-            n = len(kbp1s)
-            k_bp = np.concatenate((np.flip(kbp1s)[:-1], kbp1s))
-            del kbp1s
-            w = k_bp/(sum(k_bp))
-
-            mag_fild = []
-            for i in range(n-1, len(f) - n): mag_fild.append(np.dot(w, mag[i-n+1 : i+n]))
-            f = f[n-1:-n]
-
-            f_bp = f.copy()
-            self.active_solution = InpShprSolution(wc=None, zt=None, w_bp=f*2.*pi, G=np.array(mag_fild))
+            self.signal_quality = result.signal_quality
+            self._logger.info(f'Signal quality: {self.signal_quality}.')
+            self._logger.info(f'Sweep located by {"profile alignment" if result.aligned_to_profile else "quiet window search"}'\
+                              f' (alignment confidence {result.alignment_confidence:.2f}).')
+
+            self.active_solution = InpShprSolution(wc=None, zt=None, w_bp=result.f_bp*2.*pi, G=result.mag_fild)
             self.active_solution_axis = self.fsm.axis
-            del f, Y, NT, n
 
-            # Compute the frequency versus index parameters.
-            try:
-                wl = self.sweep_cfg.dfdt/4.; wo = 0.66
-                ws = wl*(1.-wo)
-                wN = round(wl/self.accelerometer.T)
-                sN = round(ws/self.accelerometer.T)
-
-                H = np.arange(start=0, stop=wN, step=1)
-                H = 0.5*(1. - np.cos(2.*pi*H/wN))
-
-                ns = []; fs = []
-
-                for i in range(floor((len(data) - wN)/sN) + 1):
-                    sidx = sN*i
-                    eidx = sidx + wN
-
-                    y_ = H*data[sidx:eidx]
-                    Y_ = np.fft.fft(np.array(y_))
-                    NT = len(Y_)*self.accelerometer.T
-                    f_ = np.arange(len(Y_))/NT
-
-                    minf_idx = ceil(self.sweep_cfg.f0*NT)
-                    maxf_idx = floor(self.sweep_cfg.f1*NT)
-
-                    f_ = f_[minf_idx:maxf_idx]; Y_ = Y_[minf_idx:maxf_idx]
-
-                    fs.append(f_[np.min(np.argmax(np.abs(Y_)))])
-                    ns.append(round(sidx+eidx)/2)
-
-                ns = np.array(ns, dtype=float)
-                fs = np.array(fs)
-
-                max_ns = max(ns)
-                ns /= max_ns
-                fs /= self.sweep_cfg.f1
-
-                w = np.clip(np.interp(fs*self.sweep_cfg.f1, f_bp, mag_fild), a_min=None, a_max=1.)
-
-                w = np.pow(w, SIGNAL_WEIGHTING_POWER)
-
-                rng = np.random.default_rng()
-                e = np.inf
-                self.i2f_bm = None
-                for _ in range(I2F_MAX_ITERATIONS):
-                    idcs1 = rng.permutation(len(ns))
-                    hi = idcs1[:I2F_RANDOM_IDCS]
-                    X = np.block([np.ones((I2F_RANDOM_IDCS, 1)), ns[hi].reshape(-1, 1)])
-                    W = np.diag(w[hi])
-                    bm_ = np.linalg.inv(X.T @ W @ X) @ X.T @ W @ fs[hi]
-                    ytil = np.block([np.ones((len(idcs1), 1)), ns[idcs1].reshape(-1, 1)]) @ bm_
-                    e_ = (fs[idcs1] - ytil)**2
-                    idcs2 = idcs1[I2F_RANDOM_IDCS:][np.where(e_[I2F_RANDOM_IDCS:] < I2F_CANDIDATE_ERROR_THD)]
-                    if len(idcs2) > I2F_CONSENSUS_THD:
-                        idcs = np.block([hi, idcs2])
-                        X_ = np.block([np.ones((len(idcs), 1)), ns[idcs].reshape(-1, 1)])
-                        W = np.diag(w[idcs])
-                        bm__ = np.linalg.inv(X_.T @ W @ X_) @ X_.T @ W @ fs[idcs]
-                        ytil_ = np.block([np.ones((len(idcs), 1)), ns[idcs].reshape(-1, 1)]) @ bm__
-                        e__ = np.sum((fs[idcs] - ytil_)**2)/len(idcs)
-                        if e__ < e: e = e__; self.i2f_bm = bm__
-
-                self.i2f_bm[0] *= self.sweep_cfg.f1
-                self.i2f_bm[1] *= self.sweep_cfg.f1/max_ns
-
-                bm1_expected = self.sweep_cfg.dfdt*self.accelerometer.T
-                bm1_ratio = self.i2f_bm[1]/bm1_expected
-                self._logger.info(f'Frequency map result: {self.i2f_bm[0]:.3f};{self.i2f_bm[1]:.9f};{bm1_expected:.9f}; ratio={bm1_ratio:.3f}.')
-
-                if bm1_ratio < I2F_BM1_RATIO_LOW_THD or bm1_ratio > I2F_BM1_RATIO_HIGH_THD:
-                    self.send_client_popup(type='error', title='Error in frequency analysis.',
-                                            message='The mapping cross check failed. Please try again.', hide=False)
-                    self.fsm_on_ANALYZE_MANUAL_error(); return
-                
-            except Exception as e:
-                self.send_client_popup(type='error', title='Error in frequency analysis.', message='Please try again using the default profile settings.', hide=False)
-                self.fsm_on_ANALYZE_MANUAL_error(); return
-            
+            self.i2f_bm = result.i2f_bm; self.i2f_inliers = result.i2f_inliers; self.i2f_error = result.i2f_error
+            self._logger.info(f'Frequency map result: {self.i2f_bm[0]:.3f};{self.i2f_bm[1]:.9f};{result.bm1_expected:.9f}; ratio={result.bm1_ratio:.3f}.')
+
             self.sts_axis_calibration_active = False
             self.sts_manual_mode_ready_for_user_selections = True
-            
-            self.send_client_popup( type='info', title='Select Peak Acceleration',
-                                    message='To proceed, select the peak acceleration point on the'\
-                                            ' data graph.',
-                                    hide=False)
+
+            # Preselect the resonance found by the local solver; the user may still pick another on the graph.
+            try: self.active_solution.wc, self.active_solution.zt = find_resonance(self.active_solution.w_bp, self.active_solution.G)
+            except NoResonanceFound as e:
+                self._logger.info(f'Local solver: {e}')
+                self.send_client_popup( type='info', title='Select Peak Acceleration',
+                                        message='To proceed, select the peak acceleration point on the'\
+                                                ' data graph.',
+                                        hide=False)
+            else:
+                self._logger.info(f'Local solver result: {self.active_solution.wc/2./pi:.2f} Hz, zt={self.active_solution.zt:.3f}.')
+                self.send_client_popup( type='info', title='Resonance Detected',
+                                        message=f'Found a resonance at {self.active_solution.wc/2./pi:.1f} Hz. To use a'\
+                                                ' different frequency, select it on the data graph.')
+                self.select_recommended_shaper()
             
             prompt_user = True
 
@@ -1586,7 +1752,9 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
 
     
     def fsm_on_ANALYZE_MANUAL_during(self):
-        self.fsm.state = AxisRespnsFSMStates.IDLE
+        if self.fsm.event is AxisRespnsFSMEvents.ANALYSIS:
+            self.fsm.state = AxisRespnsFSMStates.IDLE
+            self.fsm_on_ANALYZE_MANUAL_result(self.analysis_future)
         return
 		
 
@@ -1597,6 +1765,7 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
         else: return
 
         self.fsm.state = AxisRespnsFSMStates.HOME
+        self.fsm_post_event(AxisRespnsFSMEvents.START)
 
     
     def fsm_kill(self):
@@ -1627,6 +1796,7 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
                     accelerometer_device='ADXL345',
                     accelerometer_range='+/-2g',
                     accelerometer_rate='800Hz',
+                    accelerometer_int_gpio=None,
                     home_axis_before_calibration=True,
                     acceleration_amplitude=4000,
                     starting_frequency=5,
@@ -1638,6 +1808,8 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
                     delay1_time=500,
                     delay2_time=1000,
                     delay3_time=1000,
+                    i2f_estimator='stft',
+                    auto_apply_recommended_shaper=False,
                     share_calibration_data=True,
                     log_routine_debug_info=False,
                     save_post_data_locally=False
@@ -1655,6 +1827,7 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
                     accelerometer_device=self._settings.get(["accelerometer_device"]),
                     accelerometer_range=self._settings.get(["accelerometer_range"]),
                     accelerometer_rate=self._settings.get(["accelerometer_rate"]),
+                    accelerometer_int_gpio=self._settings.get(["accelerometer_int_gpio"]),
                     home_axis_before_calibration=self._settings.get(["home_axis_before_calibration"]),
                     acceleration_amplitude=self._settings.get(["acceleration_amplitude"]),
                     starting_frequency=self._settings.get(["starting_frequency"]),
@@ -1666,6 +1839,7 @@ class UlendocaasPlugin(octoprint.plugin.SettingsPlugin,
                     delay1_time=self._settings.get(["delay1_time"]),
                     delay2_time=self._settings.get(["delay2_time"]),
                     delay3_time=self._settings.get(["delay3_time"]),
+                    i2f_estimator=self._settings.get(["i2f_estimator"]),
                     share_calibration_data=self._settings.get(["share_calibration_data"]),
                     log_routine_debug_info=self._settings.get(["log_routine_debug_info"]),
                     save_post_data_locally=self._settings.get(["save_post_data_locally"])
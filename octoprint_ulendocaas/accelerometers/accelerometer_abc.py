@@ -3,19 +3,39 @@ import threading
 import pigpio
 import time
 
+import numpy as np
+
 from abc import ABC, abstractmethod
 from enum import Enum
 
+from .sample_buffer import SampleBuffer
+
+
+BUFFER_DEFAULT_TI = 30. # Capture length to size for when the caller gives no estimate.
+BUFFER_MARGIN_TI = 5.
+BUFFER_CHUNK_TI = 5.
+POLL_JITTER_GAIN = 0.05 # Gain of the wake-up latency estimate used to compensate poll jitter.
+
 
 AcclrmtrRangeCfg = Enum('AcclrmtrRangeCfg', ['+/-2g', '+/-4g', '+/-8g', '+/-16g'])
 AcclrmtrRateCfg = Enum('AcclrmtrRateCfg', ['3200Hz', '1600Hz', '800Hz', '400Hz', '200Hz'])
 
 
 class AcclrmtrCfg():
-    def __init__(self, range: AcclrmtrRangeCfg, rate: AcclrmtrRateCfg):
+    def __init__(self, range: AcclrmtrRangeCfg, rate: AcclrmtrRateCfg, int_gpio=None):
         self.range = range
         self.rate = rate
         self.poll_time = None # To be calibrateable by each implementer.
+        self.int_gpio = int_gpio # GPIO wired to the device's interrupt pin, if any.
+
+
+def full_scale_mm_per_sec_sqr(range: AcclrmtrRangeCfg):
+    '''Largest magnitude a device configured for `range` can report.'''
+    if range == AcclrmtrRangeCfg['+/-2g']: return 2.*9806.65
+    elif range == AcclrmtrRangeCfg['+/-4g']: return 4.*9806.65
+    elif range == AcclrmtrRangeCfg['+/-8g']: return 8.*9806.65
+    elif range == AcclrmtrRangeCfg['+/-16g']: return 16.*9806.65
+    else: raise Exception('Got unexpected range config.')
 
 
 AcclrmtrStatus = Enum('AcclrmtrStatus', ['INIT', 'COLLECTING', 'CONNECTION_FAILED',
@@ -27,13 +47,96 @@ class Accelerometer(ABC):
     '''Abstract base class for an accelerometer that's sampled via polling.'''
     def __init__(self, config: AcclrmtrCfg):
         self.config = config
+        self.lsb = None # Value of one count (mm/sec^2), where samples are whole counts.
         self.status = AcclrmtrStatus.INIT
-        self._stop = False
-
-
-    def _refresh_collect_timer(self):
-        if not self._stop: threading.Timer(self.config.poll_time, self._collect_samples).start()
-        else: self.status = AcclrmtrStatus.STOPPED
+        self._stop_event = threading.Event()
+        self._acq_thread = None
+        self.samples = SampleBuffer(0, 1)
+        self._poll_lateness = SampleBuffer(0, 1, channels=1)
+        self._acq_duration = None; self._acq_cpu_time = None
+        self.event_callback = None # Called from the acquisition thread when collection ends.
+
+
+    @property
+    def x_buff(self): return self.samples.channel(0)
+    @property
+    def y_buff(self): return self.samples.channel(1)
+    @property
+    def z_buff(self): return self.samples.channel(2)
+    @property
+    def poll_lateness(self):
+        '''How late (in seconds) each poll of the last collection ran versus its
+        deadline (or, for interrupt-driven devices, versus the interrupt edge).'''
+        return self._poll_lateness.channel(0)
+
+
+    def _run_acquisition(self):
+        self._acquire()
+        self._notify()
+
+
+    def _notify(self):
+        if self.event_callback is not None: self.event_callback()
+
+
+    def _acquire(self):
+        '''Body of the acquisition thread. Polls `_collect_samples` on a fixed
+        deadline schedule until stopped or until collection fails.'''
+        poll_time = self.config.poll_time
+        wake_bias = 0. # Estimated wake-up latency; waits end this much early.
+        self._acq_start_time = time.perf_counter(); self._acq_start_cpu_time = time.thread_time()
+        deadline = self._acq_start_time + poll_time
+
+        while not self._stop_event.wait(max(0., deadline - wake_bias - time.perf_counter())):
+            late = time.perf_counter() - deadline
+            self._poll_lateness.append(late)
+            wake_bias = min(poll_time, max(0., wake_bias + POLL_JITTER_GAIN*late))
+
+            self._collect_samples()
+            if self.status != AcclrmtrStatus.COLLECTING: self._note_acq_end(); return
+
+            deadline += poll_time
+            now = time.perf_counter()
+            if deadline < now: deadline = now + poll_time # Fell behind; don't try to catch up with a burst.
+
+        # Drain whatever arrived since the last poll before reporting stopped.
+        self._collect_samples()
+        self._note_acq_end()
+        if self.status == AcclrmtrStatus.COLLECTING: self.status = AcclrmtrStatus.STOPPED
+
+
+    def _note_acq_end(self):
+        self._acq_duration = time.perf_counter() - self._acq_start_time
+        self._acq_cpu_time = time.thread_time() - self._acq_start_cpu_time
+
+
+    def _append_block(self, xyz):
+        '''Stores a (3, m) block of samples and feeds the live-view downsampler,
+        carrying any incomplete downsample group over to the next block.'''
+        self.samples.extend(xyz)
+
+        ds = self.downsample_factor
+        if self._anim_carry.shape[1] > 0: xyz = np.concatenate((self._anim_carry, xyz), axis=1)
+        n = xyz.shape[1] - xyz.shape[1] % ds
+        if n > 0:
+            anim = xyz[:, :n].reshape(3, -1, ds).mean(axis=2, dtype=float)
+            self.x_buff_anim.extend(anim[0].tolist())
+            self.y_buff_anim.extend(anim[1].tolist())
+            self.z_buff_anim.extend(anim[2].tolist())
+        self._anim_carry = xyz[:, n:].copy()
+
+
+    def acquisition_stats(self):
+        '''Summary of the last collection: poll lateness and the CPU time used
+        by the acquisition thread.'''
+        late = self.poll_lateness
+        if len(late) == 0: return dict(polls=0)
+        stats = dict(status=self.status.name, samples=len(self.samples), polls=len(late),
+                     late_mean=float(np.mean(late)), late_p99=float(np.percentile(late, 99)), late_max=float(np.max(late)))
+        if self._acq_duration is not None:
+            stats['cpu_time'] = self._acq_cpu_time
+            stats['cpu_per_sec'] = self._acq_cpu_time/self._acq_duration if self._acq_duration > 0. else 0.
+        return stats
 
 
     @abstractmethod
@@ -41,27 +144,38 @@ class Accelerometer(ABC):
 
 
     @abstractmethod
-    def start(self):
-        self._stop = False
-
-        self.x_buff = []; self.y_buff = []; self.z_buff = []
+    def start(self, expected_duration=None):
+        '''Starts collection. The sample store is sized for `expected_duration`
+        seconds of data (plus margin) and grows in chunks beyond that.'''
+        self._stop_event.clear()
+
+        if expected_duration is None: expected_duration = BUFFER_DEFAULT_TI
+        self.samples = SampleBuffer(capacity=round((expected_duration + BUFFER_MARGIN_TI)/self.T),
+                                    chunk=round(BUFFER_CHUNK_TI/self.T))
+        self._poll_lateness = SampleBuffer(capacity=round((expected_duration + BUFFER_MARGIN_TI)/self.config.poll_time),
+                                           chunk=round(BUFFER_CHUNK_TI/self.config.poll_time), channels=1)
         self._x_anim = 0.; self._y_anim = 0.; self._z_anim = 0.
+        self._anim_carry = np.empty((3, 0))
+        self._acq_duration = None; self._acq_cpu_time = None
         self.x_buff_anim = []; self.y_buff_anim = []; self.z_buff_anim = []; self.t_buff_anim = []
         self.samples_collected = 0
         self._samples_for_anim_idx = 0
     
         self.status = AcclrmtrStatus.COLLECTING
-        threading.Timer(self.config.poll_time, self._collect_samples).start()
+        self._acq_thread = threading.Thread(target=self._run_acquisition, name=type(self).__name__ + '-acquisition', daemon=True)
+        self._acq_thread.start()
 
 
     @abstractmethod
     def _collect_samples(self):
-        self._refresh_collect_timer()
+        '''Reads whatever samples are ready. Called from the acquisition thread;
+        collection ends as soon as this leaves `status` other than COLLECTING.'''
+        pass
 
 
     def stop(self):
-        self._stop = True
-        while self.status == AcclrmtrStatus.COLLECTING: time.sleep(self.config.poll_time)
+        self._stop_event.set()
+        if self._acq_thread is not None: self._acq_thread.join()
 
     
     @abstractmethod
@@ -76,16 +190,19 @@ class SpiOpenFailed(AcclerometerOverSPIError): pass
 
 
 class AcclerometerOverSPI(Accelerometer):
-    def __init__(self, config: AcclrmtrCfg):
-        try:
-            subprocess.check_output(['service', 'pigpiod', 'status'])
-        except subprocess.CalledProcessError as cpe:
-            if cpe.returncode == 3:
-                if b'Loaded: not-found' in cpe.stdout: raise PigpioNotInstalled
-                else: raise DaemonNotRunning
-            if cpe.returncode == 4: raise PigpioNotInstalled
-
-        self._rpi = pigpio.pi()
+    def __init__(self, config: AcclrmtrCfg, rpi=None):
+        '''`rpi` may be given to use an existing (or fake) pigpio.pi connection.'''
+        if rpi is None:
+            try:
+                subprocess.check_output(['service', 'pigpiod', 'status'])
+            except subprocess.CalledProcessError as cpe:
+                if cpe.returncode == 3:
+                    if b'Loaded: not-found' in cpe.stdout: raise PigpioNotInstalled
+                    else: raise DaemonNotRunning
+                if cpe.returncode == 4: raise PigpioNotInstalled
+
+            rpi = pigpio.pi()
+        self._rpi = rpi
         if not self._rpi.connected: raise PigpioConnectionFailed
             
         try:
@@ -1,23 +1,32 @@
 from .accelerometer_abc import AcclerometerOverSPI, AcclrmtrCfg, AcclrmtrRangeCfg, AcclrmtrRateCfg, AcclrmtrSelfTestSts, AcclrmtrStatus
 
+import numpy as np
+import pigpio
+import threading
 import time
 
 
 READ_CONTINUE_THD = 5
 FIFO_ACQ_TIMOUT_TI = 0.5
 FIFO_ACQ_TIMEOUT_THD = 25
+FIFO_BULK_READ = True # Drain the FIFO as one block and decode it vectorized; False uses the per-sample path.
+FIFO_WATERMARK = 16 # FIFO level that raises the watermark interrupt when an interrupt GPIO is configured.
 
 
 class Adxl345(AcclerometerOverSPI):
-    def __init__(self, config: AcclrmtrCfg):
+    '''ADXL345 over SPI. Samples are collected by polling FIFO_STATUS unless
+    `config.int_gpio` names the GPIO wired to INT1, in which case the FIFO
+    watermark interrupt wakes the acquisition thread instead.'''
+    def __init__(self, config: AcclrmtrCfg, rpi=None):
         
-        super().__init__(config)
+        super().__init__(config, rpi)
 
         if config.range == AcclrmtrRangeCfg['+/-2g']: self._lsb_to_mm_per_sec_sqr = 2.*2./1024.*9806.65
         elif config.range == AcclrmtrRangeCfg['+/-4g']: self._lsb_to_mm_per_sec_sqr = 2.*4./1024.*9806.65
         elif config.range == AcclrmtrRangeCfg['+/-8g']: self._lsb_to_mm_per_sec_sqr = 2.*8./1024.*9806.65
         elif config.range == AcclrmtrRangeCfg['+/-16g']: self._lsb_to_mm_per_sec_sqr = 2.*16./1024.*9806.65
         else: raise Exception('Got unexpected range config.')
+        self.lsb = self._lsb_to_mm_per_sec_sqr
         self.status = AcclrmtrStatus.INIT
 
         if config.rate == AcclrmtrRateCfg['3200Hz']: self.T = 1/3200.; self.config.poll_time = 0.0005
@@ -28,6 +37,16 @@ class Adxl345(AcclerometerOverSPI):
         else: raise Exception('Unknown rate configuration.')
 
         self.downsample_factor = round((1/1600.) / self.T * 24)
+        self.bulk_read = FIFO_BULK_READ
+        self._fifo_max_level = 0
+
+        self._watermark_event = threading.Event()
+        self._watermark_cb = None
+        self._watermark_time = None
+        self._use_watermark = False
+        if config.int_gpio is not None:
+            self._rpi.set_mode(config.int_gpio, pigpio.INPUT)
+            self._rpi.set_pull_up_down(config.int_gpio, pigpio.PUD_DOWN)
 
     
     def __cnfgr_for_data_acq(self):
@@ -46,7 +65,12 @@ class Adxl345(AcclerometerOverSPI):
         elif self.config.range == AcclrmtrRangeCfg['+/-16g']: self._rpi.spi_write(self._spi0, [0x31, 0b00000011])
         else: raise Exception('Unknown range configuration.')
         
-        self._rpi.spi_write(self._spi0, [0x38, 0b10000000]) # FIFO control register; FIFO mode to stream
+        if self.config.int_gpio is not None:
+            self._rpi.spi_write(self._spi0, [0x38, 0b10000000 | FIFO_WATERMARK]) # FIFO control register; stream mode, watermark samples
+            self._rpi.spi_write(self._spi0, [0x2F, 0b00000000]) # Interrupt map register; all interrupts to INT1
+            self._rpi.spi_write(self._spi0, [0x2E, 0b00000010]) # Interrupt enable register; watermark only
+        else:
+            self._rpi.spi_write(self._spi0, [0x38, 0b10000000]) # FIFO control register; FIFO mode to stream
         self._rpi.spi_write(self._spi0, [0x2D, 0b00001000]) # Power control register; Enter measurement mode
 
     
@@ -55,6 +79,7 @@ class Adxl345(AcclerometerOverSPI):
         self._rpi.spi_write(self._spi0, [0x2C, 0b00001100]) # Data rate register; 400 Hz
         self._rpi.spi_write(self._spi0, [0x31, 0b00001011]) # Data format register; FULL_RES mode and +/- 16g range
         self._rpi.spi_write(self._spi0, [0x38, 0b10000000]) # FIFO control register; FIFO mode to stream
+        self._rpi.spi_write(self._spi0, [0x2E, 0b00000000]) # Interrupt enable register; none
         self._rpi.spi_write(self._spi0, [0x2D, 0b00001000]) # Power control register; Enter measurement mode
 
 
@@ -65,6 +90,8 @@ class Adxl345(AcclerometerOverSPI):
     
 
     def __read_fifo(self, n):
+        if self.bulk_read: return self.__read_fifo_block(n)
+
         for _ in range(n):
             try: xyz = self._spi0_read_bytes(0x32, 6)
             except: return False
@@ -73,7 +100,7 @@ class Adxl345(AcclerometerOverSPI):
             y = self._lsb_to_mm_per_sec_sqr*int.from_bytes(xyz[2:3+1], byteorder='little', signed=True)
             z = self._lsb_to_mm_per_sec_sqr*int.from_bytes(xyz[4:5+1], byteorder='little', signed=True)
 
-            self.x_buff.append(x); self.y_buff.append(y); self.z_buff.append(z)
+            self.samples.append(x, y, z)
 
             self._x_anim += x; self._y_anim += y; self._z_anim += z
             self._samples_for_anim_idx += 1
@@ -85,6 +112,25 @@ class Adxl345(AcclerometerOverSPI):
                 self._x_anim = 0.; self._y_anim = 0.; self._z_anim = 0.
                 self._samples_for_anim_idx = 0
         return True
+
+
+    def __read_fifo_block(self, n):
+        '''Drains n FIFO entries and decodes them together. The part only pops an
+        entry when chip select is released, so each entry is still its own
+        transfer, but the transfers run back-to-back and the whole block is
+        decoded with one int16 view and one scale multiply.'''
+        raw = bytearray()
+        xfer_cmd = [0x32 | 0x80 | 0x40] + [0xFF]*6 # Multi-byte read of DATAX0..DATAZ1
+        try:
+            for _ in range(n):
+                (count, rx_data) = self._rpi.spi_xfer(self._spi0, xfer_cmd)
+                if count != 7: return False
+                raw += rx_data[1:]
+        except: return False
+
+        xyz = np.frombuffer(raw, dtype='<i2').reshape(-1, 3).T
+        self._append_block(xyz*self._lsb_to_mm_per_sec_sqr)
+        return True
     
 
     def self_test(self):
@@ -92,13 +138,13 @@ class Adxl345(AcclerometerOverSPI):
         For functional details, it is best to refer to the datasheet.
         '''
         self.__cnfgr_for_self_test()
-        self.start(self_test_mode=True)
+        self.start(self_test_mode=True, expected_duration=0.25)
         time.sleep(0.25) # Requires 0.1 sec of data or greater -- use 0.25 and first 32 will be discarded.
         self.stop()
         if self.status != AcclrmtrStatus.STOPPED: return AcclrmtrSelfTestSts.FAIL
         x_st_off = self.x_buff.copy(); y_st_off = self.y_buff.copy(); z_st_off = self.z_buff.copy()
         self.__cnfgr_for_self_test(); self.__ena_self_test()
-        self.start(self_test_mode=True)
+        self.start(self_test_mode=True, expected_duration=0.25)
         time.sleep(0.25)
         self.stop()
         if self.status != AcclrmtrStatus.STOPPED: return AcclrmtrSelfTestSts.FAIL
@@ -109,13 +155,13 @@ class Adxl345(AcclerometerOverSPI):
         if not (len(x_st_on) > 32 and len(y_st_on) > 32 and len(z_st_on) > 32 and
                 len(x_st_off) > 32 and len(y_st_off) > 32 and len(z_st_off) > 32): return AcclrmtrSelfTestSts.FAIL
         
-        x_st_off_avg = sum(x_st_off[32:])/len(x_st_off[32:])
-        y_st_off_avg = sum(y_st_off[32:])/len(y_st_off[32:])
-        z_st_off_avg = sum(z_st_off[32:])/len(z_st_off[32:])
+        x_st_off_avg = np.mean(x_st_off[32:], dtype=float)
+        y_st_off_avg = np.mean(y_st_off[32:], dtype=float)
+        z_st_off_avg = np.mean(z_st_off[32:], dtype=float)
 
-        x_st_on_avg = sum(x_st_on[32:])/len(x_st_on[32:])
-        y_st_on_avg = sum(y_st_on[32:])/len(y_st_on[32:])
-        z_st_on_avg = sum(z_st_on[32:])/len(z_st_on[32:])
+        x_st_on_avg = np.mean(x_st_on[32:], dtype=float)
+        y_st_on_avg = np.mean(y_st_on[32:], dtype=float)
+        z_st_on_avg = np.mean(z_st_on[32:], dtype=float)
 
         x_st = (x_st_on_avg - x_st_off_avg)/self._lsb_to_mm_per_sec_sqr
         y_st = (y_st_on_avg - y_st_off_avg)/self._lsb_to_mm_per_sec_sqr
@@ -129,9 +175,10 @@ class Adxl345(AcclerometerOverSPI):
         return AcclrmtrSelfTestSts.PASS if (x_pass and y_pass and z_pass) else AcclrmtrSelfTestSts.FAIL
 
 
-    def start(self, self_test_mode=False):
+    def start(self, self_test_mode=False, expected_duration=None):
         
         self._n_fifo_zero_cnt = 0
+        self._fifo_max_level = 0
 
         if not self_test_mode:
             self.__cnfgr_for_data_acq()
@@ -145,11 +192,56 @@ class Adxl345(AcclerometerOverSPI):
                 try: _ = self._spi0_read_bytes(0x32, 6)
                 except: self.status = AcclrmtrStatus.READ_FAILED; return
             
-            super().start()
+            self._use_watermark = False
+            if self.config.int_gpio is not None and not self_test_mode:
+                self._watermark_event.clear()
+                try:
+                    self._watermark_cb = self._rpi.callback(self.config.int_gpio, pigpio.RISING_EDGE, self._on_watermark)
+                    self._use_watermark = True
+                except: self._watermark_cb = None # Fall back to polling.
+
+            super().start(expected_duration)
         else:
             self.status = AcclrmtrStatus.OUT_OF_RANGE
 
 
+    def _on_watermark(self, gpio, level, tick):
+        '''pigpio callback for the INT1 rising edge.'''
+        self._watermark_time = time.perf_counter()
+        self._watermark_event.set()
+
+
+    def _acquire(self):
+        if not self._use_watermark: return super()._acquire()
+
+        # Wait for watermark edges rather than a poll deadline. A wait that times
+        # out polls anyway, so a missed edge (or a dead device) is still handled
+        # by the FIFO_STATUS checks in _collect_samples. The timeout leaves room
+        # for a late edge but expires before the remaining FIFO space fills.
+        timeout = 1.5*FIFO_WATERMARK*self.T
+        self._acq_start_time = time.perf_counter(); self._acq_start_cpu_time = time.thread_time()
+
+        while True:
+            edge = self._watermark_event.wait(timeout)
+            if self._stop_event.is_set(): break
+            self._watermark_event.clear() # Before draining, so an edge during the drain isn't lost.
+            self._poll_lateness.append(time.perf_counter() - self._watermark_time if edge else timeout)
+
+            self._collect_samples()
+            if self.status != AcclrmtrStatus.COLLECTING: self._end_watermark(); self._note_acq_end(); return
+
+        self._collect_samples()
+        self._end_watermark()
+        self._note_acq_end()
+        if self.status == AcclrmtrStatus.COLLECTING: self.status = AcclrmtrStatus.STOPPED
+
+
+    def _end_watermark(self):
+        if self._watermark_cb is not None: self._watermark_cb.cancel(); self._watermark_cb = None
+        try: self._rpi.spi_write(self._spi0, [0x2E, 0b00000000]) # Interrupt enable register; none
+        except: pass
+
+
     def _collect_samples(self):
 
         try: n_fifo = self._spi0_read_bytes(0x39, 1)[0] & 0b00111111
@@ -158,10 +250,10 @@ class Adxl345(AcclerometerOverSPI):
         if n_fifo == 0: # No samples ready
             self._n_fifo_zero_cnt += 1
             if self._n_fifo_zero_cnt > FIFO_ACQ_TIMEOUT_THD: self.status = AcclrmtrStatus.CONNECTION_FAILED
-            else: self._refresh_collect_timer()
 
         elif n_fifo > 0 and n_fifo <= 32: # Samples are ready
             self._n_fifo_zero_cnt = 0
+            self._fifo_max_level = max(self._fifo_max_level, n_fifo)
 
             success = self.__read_fifo(n_fifo)
             if not success: self.status = AcclrmtrStatus.READ_FAILED; return
@@ -172,18 +264,24 @@ class Adxl345(AcclerometerOverSPI):
                 if n_fifo < READ_CONTINUE_THD: break
                 elif n_fifo == 32: self.status = AcclrmtrStatus.OVERRUN; return
                 else:
+                    self._fifo_max_level = max(self._fifo_max_level, n_fifo)
                     success = self.__read_fifo(n_fifo)
                     if not success: self.status = AcclrmtrStatus.READ_FAILED; return
-
-            self._refresh_collect_timer()
-
-            if n_fifo == 32: # Overrun
-                self.status = AcclrmtrStatus.OVERRUN
         else:
             self.status = AcclrmtrStatus.OUT_OF_RANGE
 
 
+    def acquisition_stats(self):
+        stats = super().acquisition_stats()
+        stats['fifo_max_level'] = self._fifo_max_level
+        stats['bulk_read'] = self.bulk_read
+        stats['watermark'] = self._use_watermark
+        return stats
+
+
     def stop(self):
+        self._stop_event.set()
+        self._watermark_event.set() # Wake the acquisition thread if it's waiting for an edge.
         super().stop()
         self._rpi.spi_write(self._spi0, [0x2D, 0b00000000]) # Power control register; Stop measurement mode
 
@@ -1,18 +1,22 @@
 from .accelerometer_abc import Accelerometer, AcclrmtrCfg, AcclrmtrRateCfg, AcclrmtrSelfTestSts
-from math import pi, sin, sqrt
+from ..cfg import SIMULATION_RATE_MULTIPLIER
+from math import floor, pi, sin, sqrt
 
 import numpy as np
 import time
 
 
-RATE_MULTIPLIER = 20. # Speed things up for simulation.
+AFAP_BATCH_TI = 1. # Seconds of data emitted per poll when running as fast as possible.
 DEAD_TIME = 0.5 # Some startup dead time to match real accelerometer behavior.
 
 
 class SimulatedAccelerometer(Accelerometer):
-    def __init__(self, config: AcclrmtrCfg):
+    def __init__(self, config: AcclrmtrCfg, rate_multiplier=SIMULATION_RATE_MULTIPLIER):
+        '''`rate_multiplier` scales simulated time against wall time; None emits
+        data as fast as the acquisition thread can take it.'''
 
         super().__init__(config)
+        self.rate_multiplier = rate_multiplier
 
         if config.rate == AcclrmtrRateCfg['3200Hz']: self.T = 1/3200.; self.config.poll_time = 0.0005
         elif config.rate == AcclrmtrRateCfg['1600Hz']: self.T = 1/1600.; self.config.poll_time = 0.001
@@ -27,7 +31,7 @@ class SimulatedAccelerometer(Accelerometer):
     
     def set_simulation_params(self, f0, f1, dfdt, a, step_ti, step_a, dly1_ti, dly2_ti, dly3_ti):
         prfl_cfg = ChirpConfig(f0, f1, dfdt, a, step_ti, step_a, dly1_ti, dly2_ti, dly3_ti)
-        self.sim_data = np.gradient(np.gradient(make_profile(prfl_cfg, self.T, sim=True)/self.T)/self.T)
+        self.sim_data = make_acceleration_profile(prfl_cfg, self.T, sim=True)
         self.sim_data = np.concatenate((np.zeros((round(DEAD_TIME/self.T),)), self.sim_data))
 
 
@@ -37,38 +41,26 @@ class SimulatedAccelerometer(Accelerometer):
     def self_test(self): return AcclrmtrSelfTestSts.PASS
 
 
-    def start(self):
-        self.last_collect_time = time.perf_counter()
+    def start(self, expected_duration=None):
         self.sim_sample_idx = 0
-        super().start()
+        if expected_duration is None: expected_duration = len(self.sim_data)*self.T
+        self.sim_start_time = time.perf_counter()
+        super().start(expected_duration)
 
 
     def _collect_samples(self):
-        n_new_samples = round(RATE_MULTIPLIER * (time.perf_counter() - self.last_collect_time) / self.T)
+        if self.rate_multiplier is None:
+            n_new_samples = round(AFAP_BATCH_TI / self.T)
+        else:
+            n_due = floor(self.rate_multiplier * (time.perf_counter() - self.sim_start_time) / self.T)
+            n_new_samples = n_due - self.sim_sample_idx
         n_new_samples = min(n_new_samples, len(self.sim_data) - self.sim_sample_idx)
-        
-        for _ in range(n_new_samples):
-            new_sample = float(self.sim_data[self.sim_sample_idx])
-            self.x_buff.append(new_sample)
-            self.y_buff.append(new_sample)
-            self.z_buff.append(new_sample)
-
-            self._x_anim += new_sample
-            self._y_anim += new_sample
-            self._z_anim += new_sample
-            self._samples_for_anim_idx += 1
-
-            if self._samples_for_anim_idx == self.downsample_factor:
-                self.x_buff_anim.append(self._x_anim/self.downsample_factor)
-                self.y_buff_anim.append(self._y_anim/self.downsample_factor)
-                self.z_buff_anim.append(self._z_anim/self.downsample_factor)
-                self._x_anim = 0.; self._y_anim = 0.; self._z_anim = 0.
-                self._samples_for_anim_idx = 0
-                
-            self.sim_sample_idx += 1
-
-        self.last_collect_time = time.perf_counter()
-        self._refresh_collect_timer()
+        if n_new_samples <= 0: return
+
+        block = self.sim_data[self.sim_sample_idx:self.sim_sample_idx + n_new_samples]
+        self._append_block(np.broadcast_to(block, (3, n_new_samples)))
+        self.sim_sample_idx += n_new_samples
+        if self.simulation_done(): self._notify()
 
     
     def close(self): return
@@ -101,6 +93,52 @@ class TrajGenConfig:
         
 
 def make_profile(prfl_cfg, T, sim=False):
+    """Vectorized profile generation. Evaluates each segment of the firmware's
+    piecewise profile over its range of sample indices; sample-for-sample
+    equivalent to `make_profile_reference` (up to libm vs NumPy sin and pow
+    rounding, a few ulp).
+    """
+
+    traj_gen_cfg = TrajGenConfig(prfl_cfg)
+    max_intervals = round(traj_gen_cfg.pcws_ti[-1]/T + 0.5) # ceil
+
+    tau = np.arange(max_intervals) * T
+    s = np.zeros((max_intervals,))
+
+    # Segment k holds the samples with pcws_ti[k-1] < tau <= pcws_ti[k].
+    edges = np.searchsorted(tau, traj_gen_cfg.pcws_ti, side='right')
+
+    for (i0, i1, sign) in [(edges[0], edges[1], 1.), (edges[4], edges[5], -1.)]: # Opening and closing steps.
+        if i0 == i1: continue
+        tau_ = tau[i0:i1] - (traj_gen_cfg.pcws_ti[0] if sign > 0. else traj_gen_cfg.pcws_ti[4])
+        s_ = np.empty_like(tau_)
+        j0 = np.searchsorted(tau_, prfl_cfg.step_ti, side='left')
+        j1 = np.searchsorted(tau_, traj_gen_cfg.step_ti_x_3, side='left')
+        s_[:j0] = traj_gen_cfg.step_a_x_0p5 * tau_[:j0] * tau_[:j0]
+        k_ = tau_[j0:j1] - traj_gen_cfg.step_ti_x_2; s_[j0:j1] = traj_gen_cfg.step_a_x_step_ti_x_step_ti - traj_gen_cfg.step_a_x_0p5 * k_**2
+        k_ = tau_[j1:] - traj_gen_cfg.step_ti_x_4; s_[j1:] = traj_gen_cfg.step_a_x_0p5 * k_**2
+        s[i0:i1] = sign*s_
+
+    i0, i1 = edges[2], edges[3] # Sweep.
+    tau_ = tau[i0:i1] - traj_gen_cfg.pcws_ti[2]
+    tau_tau_ = tau_*tau_
+    tau_tau_tau_ = tau_tau_*tau_
+    k_ = 1 / (2*traj_gen_cfg.k1*tau_ + traj_gen_cfg.k2)
+    A_ = np.minimum(tau_tau_tau_, 1.) * prfl_cfg.a * k_ * k_
+    if sim:
+        f = prfl_cfg.f0 - 1. + tau_*prfl_cfg.dfdt
+        A_ *= 1./np.sqrt((1.-(f/35)**2)**2+(.2*f/35)**2)
+    s[i0:i1] = A_*np.sin(traj_gen_cfg.k1*tau_tau_ + traj_gen_cfg.k2*tau_)
+
+    return s
+
+
+def make_acceleration_profile(prfl_cfg, T, sim=False):
+    """Acceleration of the profile, as the accelerometer would measure it."""
+    return np.gradient(np.gradient(make_profile(prfl_cfg, T, sim=sim)/T)/T)
+
+
+def make_profile_reference(prfl_cfg, T, sim=False):
     """Python implementation of the firmware profile generation.
     """
 
@@ -0,0 +1,50 @@
+import numpy as np
+
+
+class SampleBuffer():
+    '''Contiguous, preallocated store for multi-channel samples.
+
+    Each channel is a row of one 2D array, so the filled part of a channel is
+    a contiguous NumPy view that can be read (or encoded) without copying.
+    Storage grows by `chunk` samples at a time if the initial capacity is
+    exceeded; views taken before a growth keep referring to the old storage.
+    '''
+    def __init__(self, capacity, chunk, channels=3, dtype=np.float32):
+        self.chunk = max(1, int(chunk))
+        self._data = np.empty((channels, max(0, int(capacity))), dtype=dtype)
+        self._n = 0
+
+
+    def __len__(self): return self._n
+
+
+    @property
+    def capacity(self): return self._data.shape[1]
+
+
+    def _reserve(self, n):
+        if n <= self.capacity: return
+        new_capacity = max(n, self.capacity + self.chunk)
+        data = np.empty((self._data.shape[0], new_capacity), dtype=self._data.dtype)
+        data[:, :self._n] = self._data[:, :self._n]
+        self._data = data
+
+
+    def append(self, *values):
+        self._reserve(self._n + 1)
+        self._data[:, self._n] = values
+        self._n += 1
+
+
+    def extend(self, block):
+        '''Appends a (channels, m) block of samples.'''
+        m = block.shape[1]
+        self._reserve(self._n + m)
+        self._data[:, self._n:self._n + m] = block
+        self._n += m
+
+
+    def channel(self, idx): return self._data[idx, :self._n]
+
+
+    def clear(self): self._n = 0
@@ -0,0 +1,370 @@
+from .cfg import *
+from .signal_quality import assess_signal_quality
+from .accelerometers.accelerometer_sim import ChirpConfig, TrajGenConfig, make_acceleration_profile
+
+import numpy as np
+
+from functools import lru_cache
+from math import ceil, floor, pi, sqrt
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Errors with extra attributes reduce to their constructor arguments so they
+# survive being pickled back from a worker process.
+class AnalysisError(Exception): pass
+class AnalysisCancelled(AnalysisError): pass
+class SampleRateTooLow(AnalysisError): pass
+class InsufficientData(AnalysisError):
+    def __init__(self, stage): super().__init__(f'Insufficient data ({stage}).'); self.stage = stage
+    def __reduce__(self): return (type(self), (self.stage,))
+class WeakSignal(AnalysisError):
+    def __init__(self, signal_quality): super().__init__(str(signal_quality)); self.signal_quality = signal_quality
+    def __reduce__(self): return (type(self), (self.signal_quality,))
+class FrequencyMapError(AnalysisError): pass
+class FrequencyMapCrossCheckFailed(FrequencyMapError):
+    def __init__(self, i2f_bm, bm1_expected):
+        super().__init__(f'Frequency map slope {i2f_bm[1]:.9f} vs. {bm1_expected:.9f} expected.')
+        self.i2f_bm = i2f_bm; self.bm1_expected = bm1_expected
+    def __reduce__(self): return (type(self), (self.i2f_bm, self.bm1_expected))
+
+
+def window_abs_sums(x, m):
+    '''Sum of |x| over every length-m window of x: out[i] = sum(|x[i:i+m]|).
+    O(n) via a cumulative sum, so subject to its (small) rounding error.'''
+    if m <= 0: return np.zeros((len(x) + 1,))
+    c = np.concatenate(([0.], np.cumsum(np.abs(x), dtype=float)))
+    return c[m:] - c[:-m]
+
+
+def argmin_window_abs_sum(x, m):
+    '''Start index of the length-m window of x with the least sum of |x|.
+
+    Returns the same index as np.argmin over [np.sum(np.abs(x[i:i+m])) for
+    every window], including its first-occurrence tie-breaking: windows the
+    cumulative sum can't separate from the minimum are re-summed directly.'''
+    if m <= 0: return 0
+    if len(x) < m: raise ValueError(f'No length-{m} window in {len(x)} samples.')
+    sums = window_abs_sums(x, m)
+    tol = 4.*len(x)*np.finfo(float).eps*(np.sum(np.abs(x)) + 1.) # Bound on the cumulative sum's rounding error.
+    candidates = np.flatnonzero(sums <= np.min(sums) + tol)
+    if len(candidates) == 1: return int(candidates[0])
+    exact = np.array([np.sum(np.abs(x[i:i+m])) for i in candidates])
+    return int(candidates[np.argmin(exact)])
+
+
+@lru_cache(maxsize=8)
+def _stft_axes(wN, T):
+    '''Hann window and one-sided frequency axis for wN-long windows at sample time T.'''
+    H = 0.5*(1. - np.cos(2.*pi*np.arange(wN)/wN))
+    f = np.arange(wN//2 + 1)/(wN*T)
+    H.setflags(write=False); f.setflags(write=False)
+    return H, f
+
+
+def stft_peak_frequencies(x, T, wN, sN, f0, f1):
+    '''Short-time FFT of x over Hann-weighted windows of wN samples, every sN
+    samples. Returns the centre index of each window and the frequency of its
+    largest bin in [f0, f1).'''
+    H, f = _stft_axes(wN, T)
+    frames = sliding_window_view(x, wN)[::sN] # Strided view of all windows.
+    Y = np.fft.rfft(frames*H, axis=1)
+
+    minf_idx = ceil(f0*wN*T)
+    maxf_idx = min(floor(f1*wN*T), len(f))
+    fs = f[minf_idx + np.argmax(np.abs(Y[:, minf_idx:maxf_idx]), axis=1)]
+    ns = sN*np.arange(len(frames)) + wN/2.
+    return ns, fs
+
+
+def _stft_lengths(sweep_cfg, T):
+    '''Window and step lengths, in samples, of the frequency map's STFT.'''
+    wl = sweep_cfg.dfdt/4.; wo = 0.66
+    ws = wl*(1.-wo)
+    return round(wl/T), round(ws/T)
+
+
+def _dly1_search_lengths(sweep_cfg, T):
+    '''Lengths, in samples, of the opening delay, the search margin and the
+    dly2 dwell that the sweep start is searched for after.'''
+    return round(sweep_cfg.dly1_ti/1000./T), round(LOC_DLY2_TI/T), round(sweep_cfg.dly2_ti/1000./T)
+
+
+def align_to_profile(data, sweep_cfg, T, max_start=None):
+    '''Locates the expected motion profile in the capture by FFT cross-correlation.
+
+    Only the profile up to ALIGNMENT_SWEEP_TI into the sweep is matched, so a
+    sample clock drifting against the printer's has little effect, and sweep
+    starts past `max_start` aren't considered, which also keeps the closing
+    movement from matching. Returns the capture index of the sweep start and
+    the magnitude of the normalized correlation there (1 for a perfect match,
+    of either sign), or (None, 0.) if the capture is too short.'''
+    prfl_cfg = ChirpConfig(sweep_cfg.f0, sweep_cfg.f1, sweep_cfg.dfdt, sweep_cfg.a, sweep_cfg.step_ti/1000., sweep_cfg.step_a,
+                           sweep_cfg.dly1_ti/1000., sweep_cfg.dly2_ti/1000., sweep_cfg.dly3_ti/1000.)
+    sweep_start_ti = TrajGenConfig(prfl_cfg).pcws_ti[2]
+    k0 = round(sweep_start_ti/T)
+    p = make_acceleration_profile(prfl_cfg, T)[:round((sweep_start_ti + ALIGNMENT_SWEEP_TI)/T)]
+    m = len(p)
+    if max_start is not None: data = data[:max(0, max_start - k0 + m)]
+    if len(data) < m: return None, 0.
+
+    N = 1 << (len(data) + m - 2).bit_length() # Power of two at least len(data) + m - 1.
+    corr = np.fft.irfft(np.fft.rfft(data, N)*np.conj(np.fft.rfft(p, N)), N)[:len(data)-m+1]
+    c = np.concatenate(([0.], np.cumsum(data*data)))
+    norm = np.sqrt(np.maximum(c[m:] - c[:-m], 0.)*np.dot(p, p))
+    ncc = np.abs(np.divide(corr, norm, out=np.zeros_like(corr), where=norm > 0.))
+
+    k = int(np.argmax(ncc))
+    return k + k0, float(ncc[k])
+
+
+class StreamingPeakTrack():
+    '''STFT peak track of a sweep capture, computed while the capture arrives.
+
+    Each `feed` is given the capture so far and processes the windows that
+    have completed since the last. Windows are laid every sN samples from the
+    end of the opening delay, the earliest point the sweep start can be found
+    at, so their grid doesn't depend on where the capture is finally trimmed.'''
+    def __init__(self, sweep_cfg, T):
+        self.T = T; self.f0 = sweep_cfg.f0; self.f1 = sweep_cfg.f1
+        self.wN, self.sN = _stft_lengths(sweep_cfg, T)
+        self.origin = _dly1_search_lengths(sweep_cfg, T)[0]
+        self._fs = []; self.n_frames = 0
+
+
+    def feed(self, data):
+        x = data[self.origin + self.n_frames*self.sN:]
+        if len(x) < self.wN: return
+        n = (len(x) - self.wN)//self.sN + 1
+        _, fs = stft_peak_frequencies(np.asarray(x[:(n-1)*self.sN+self.wN], dtype=float),
+                                      self.T, self.wN, self.sN, self.f0, self.f1)
+        self._fs.append(fs); self.n_frames += n
+
+
+    def peak_frequencies(self, start, stop):
+        '''Centre indices (relative to `start`) and peak frequencies of the
+        windows that lie within capture[start:stop].'''
+        lo = self.origin + self.sN*np.arange(self.n_frames)
+        within = (lo >= start) & (lo + self.wN <= stop)
+        fs = np.concatenate(self._fs) if self._fs else np.empty((0,))
+        return lo[within] - start + self.wN/2., fs[within]
+
+
+def _wls_line(S, Sx, Sy, Sxx, Sxy):
+    '''Closed-form weighted least-squares line from its weighted sums (each may be a batch).'''
+    det = S*Sxx - Sx*Sx
+    b1 = (S*Sxy - Sx*Sy)/det
+    b0 = (Sy - b1*Sx)/S
+    return b0, b1
+
+
+def ransac_line_fit(x, y, w, n_sample, error_thd, consensus_thd, iterations, rng=None):
+    '''Robust weighted fit of y = bm[0] + bm[1]*x.
+
+    Each of `iterations` candidates fits `n_sample` random points; candidates
+    with more than `consensus_thd` other points within `error_thd` (squared
+    residual) are refit on those points plus the sample, and the refit with the
+    least mean squared residual wins. All candidates are evaluated as one batch.
+    Returns (bm, inliers, error), or (None, empty, inf) if none reached consensus.'''
+    if rng is None: rng = np.random.default_rng()
+    x = np.asarray(x, dtype=float); y = np.asarray(y, dtype=float); w = np.asarray(w, dtype=float)
+    n = len(x)
+
+    hi = np.argsort(rng.random((iterations, n)), axis=1)[:, :n_sample] # Random subset per candidate.
+    sample = np.zeros((iterations, n), dtype=bool)
+    np.put_along_axis(sample, hi, True, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wh = w[hi]; xh = x[hi]; yh = y[hi]
+        b0, b1 = _wls_line(wh.sum(axis=1), (wh*xh).sum(axis=1), (wh*yh).sum(axis=1),
+                           (wh*xh*xh).sum(axis=1), (wh*xh*yh).sum(axis=1))
+        inliers = ((y - (b0[:, None] + b1[:, None]*x))**2 < error_thd) & ~sample
+        qualified = inliers.sum(axis=1) > consensus_thd
+
+        inliers |= sample
+        W = inliers*w
+        b0, b1 = _wls_line(W.sum(axis=1), W @ x, W @ y, W @ (x*x), W @ (x*y))
+        e = np.sum(inliers*(y - (b0[:, None] + b1[:, None]*x))**2, axis=1)/inliers.sum(axis=1)
+
+    e = np.where(qualified & np.isfinite(e), e, np.inf)
+    best = np.argmin(e)
+    if not np.isfinite(e[best]): return None, np.array([], dtype=int), np.inf
+    return np.array([b0[best], b1[best]]), np.flatnonzero(inliers[best]), float(e[best])
+
+
+def analytic_i2f(Y, T, f0, f1, dfdt, error_thd, lowpass_ti=I2F_ANALYTIC_LOWPASS_TI):
+    '''Index-to-frequency line of a linear chirp capture from its FFT Y.
+
+    The [f0, f1) band of Y gives the capture's analytic signal. Mixing it down
+    by the nominal chirp (f0 at index 0, rising dfdt) and averaging over
+    `lowpass_ti` leaves a slow residual, whose unwrapped phase gives the
+    deviation from the nominal instantaneous frequency. The deviation is fit
+    as an envelope weighted line. Returns (bm, inliers, error) as
+    `ransac_line_fit` does, with residuals relative to f1.'''
+    N = len(Y)
+    f = np.fft.fftfreq(N, T)
+    z = np.fft.ifft(np.where((f >= f0) & (f < f1), 2.*Y, 0.))
+
+    t = np.arange(N)*T
+    z *= np.exp(-2j*pi*(f0 + 0.5*dfdt*t)*t)
+    L = max(1, round(lowpass_ti/T))
+    c = np.concatenate(([0.], np.cumsum(z)))
+    z = (c[L:] - c[:-L])/L # Moving average; z[i] is centred on sample i + (L-1)/2.
+
+    df = np.diff(np.unwrap(np.angle(z)))/(2.*pi*T)
+    env = np.abs(z)
+    w = env[1:]*env[:-1]
+    n = np.arange(len(df)) + L/2.
+    b0, b1 = _wls_line(w.sum(), w @ n, w @ df, w @ (n*n), w @ (n*df))
+    bm = np.array([f0 + b0, dfdt*T + b1])
+
+    r = ((df - (b0 + b1*n))/f1)**2
+    inliers = np.flatnonzero(r < error_thd)
+    error = float(np.sum(w[inliers]*r[inliers])/np.sum(w[inliers])) if len(inliers) else np.inf
+    return bm, inliers, error
+
+
+def smooth_magnitude(f, mag, half_width):
+    '''Smooths a magnitude spectrum with the plot kernel spanning +/-half_width
+    (in the units of the uniformly spaced f). Returns the frequencies and
+    magnitudes of the bins the kernel fully covers.'''
+    kbp1s = np.arange(start=0, stop=half_width, step=((max(f) - min(f)) / (len(f) - 1)))
+    n = len(kbp1s)
+    k_bp = np.concatenate((np.flip(kbp1s)[:-1], kbp1s))
+    w = k_bp/(sum(k_bp))
+
+    mag_fild = np.convolve(mag, w[::-1], mode='valid')
+    return f[n-1:-n], mag_fild[:-1]
+
+
+class ManualAnalysisResult():
+    '''Outcome of `analyze_manual`. Spectrum and frequency map fields are None
+    for verification runs.'''
+    def __init__(self, data, T, dly1_idx, dly2_idx):
+        self.data = data; self.T = T; self.dly1_idx = dly1_idx; self.dly2_idx = dly2_idx
+        self.aligned_to_profile = False; self.alignment_confidence = 0.
+        self.signal_quality = None
+        self.f = None; self.mag = None # Sweep band of the spectrum.
+        self.f_bp = None; self.mag_fild = None # Smoothed magnitude for the plot.
+        self.i2f_bm = None; self.i2f_inliers = None; self.i2f_error = None; self.bm1_expected = None
+
+    @property
+    def bm1_ratio(self): return self.i2f_bm[1]/self.bm1_expected
+
+
+def analyze_manual(data, sweep_cfg, T, full_scale=np.inf, verification=False, rng=None, progress=None, track=None,
+                   i2f_estimator='stft'):
+    '''Local analysis of one axis' sweep capture.
+
+    `sweep_cfg` is the SweepConfig the sweep ran with and `T` the sample period.
+    The capture is trimmed to the sweep; unless `verification`, its signal is
+    checked and its spectrum and index-to-frequency map are computed. Raises
+    an AnalysisError subclass when the capture can't be used.
+
+    `progress(stage, fraction)` is called as the analysis advances; it may
+    raise (e.g. AnalysisCancelled) to abandon the analysis. Given a
+    StreamingPeakTrack fed with the capture as it arrived, the frequency map
+    is fit on its windows and only those not yet processed are computed.
+
+    `i2f_estimator` selects how the index-to-frequency map is found: 'stft'
+    fits the peaks of windowed FFTs, 'analytic' demodulates the capture's
+    analytic signal (see `analytic_i2f`).'''
+    if progress is None: progress = lambda stage, fraction: None
+
+    # Following logic is known to fail for data rates below 400 Hz, so perform a check.
+    if T > (1/300.): raise SampleRateTooLow
+
+    # Trim.
+    progress('Trimming data', 0.)
+    data = np.array(data, dtype=float)
+
+    o_0_, n_0_, m_0_ = _dly1_search_lengths(sweep_cfg, T)
+
+    n_1_ = round(LOC_DLY3_TI/T)
+    m_1_ = round(sweep_cfg.dly3_ti/1000./T)
+
+    if len(data) < (o_0_ + n_0_ + m_0_ + n_1_ + m_1_): raise InsufficientData(1)
+
+    data_mean = np.sum(data)/len(data)
+    data -= data_mean
+
+    # Align the sweep start to the expected profile, falling back to the quietest
+    # dly2-long window. The sweep end is the quietest dly3-long window.
+    sweep_start, alignment_confidence = align_to_profile(data, sweep_cfg, T, max_start=o_0_+n_0_+m_0_-1)
+    aligned = alignment_confidence >= ALIGNMENT_CONFIDENCE_THD and sweep_start - m_0_ >= 0
+    if aligned: dly1_idx = sweep_start - m_0_
+    else: dly1_idx = o_0_ + argmin_window_abs_sum(data[o_0_:o_0_+n_0_+m_0_-1], m_0_)
+    dly2_idx = len(data) - n_1_ - m_1_ + argmin_window_abs_sum(data[len(data)-n_1_-m_1_:len(data)-1], m_1_)
+    if dly2_idx <= dly1_idx + m_0_: raise InsufficientData(1)
+
+    capture = data
+    quiet = data[dly1_idx:dly1_idx+m_0_]
+    result = ManualAnalysisResult(data[dly1_idx+m_0_:dly2_idx], T, dly1_idx, dly2_idx)
+    result.aligned_to_profile = aligned; result.alignment_confidence = alignment_confidence
+    if verification: return result
+    data = result.data
+
+    # Gross check.
+    progress('Checking signal', 0.2)
+    weak_signal_check_n = round(WEAK_SIGNAL_CHECK_TI/T)
+    if len(data) < weak_signal_check_n: raise InsufficientData(2)
+
+    result.signal_quality = assess_signal_quality(data, quiet, T, sweep_cfg.f0, sweep_cfg.dfdt, sweep_cfg.a,
+                                                  weak_signal_check_n, full_scale, offset=data_mean)
+    if result.signal_quality.amplitude_ratio < WEAK_SIGNAL_CHECK_THD: raise WeakSignal(result.signal_quality)
+
+    # Compute magnitude for the plot.
+    progress('Computing spectrum', 0.3)
+    Y = np.fft.fft(data)
+    NT = len(Y)*T
+    f = np.arange(len(Y))/NT
+    Y = Y/(len(data)/2)
+
+    f0_idx = ceil(sweep_cfg.f0*NT)
+    f1_idx = floor(sweep_cfg.f1*NT)
+
+    mag = np.abs(Y)*(sweep_cfg.f1-sweep_cfg.f0)/sweep_cfg.a/sqrt(sweep_cfg.dfdt)
+
+    result.f = f[f0_idx:f1_idx]; result.mag = mag[f0_idx:f1_idx]
+
+    # Filter the data for a nicer plot.
+    result.f_bp, result.mag_fild = smooth_magnitude(result.f, result.mag, MAG_SMOOTHING_HALF_WIDTH)
+
+    # Compute the frequency versus index parameters.
+    progress('Mapping frequencies', 0.6)
+    try:
+        if i2f_estimator == 'analytic':
+            i2f_bm, result.i2f_inliers, result.i2f_error = analytic_i2f(Y, T, sweep_cfg.f0, sweep_cfg.f1, sweep_cfg.dfdt, I2F_CANDIDATE_ERROR_THD)
+            if not np.all(np.isfinite(i2f_bm)): raise FrequencyMapError('Analytic frequency map fit failed.')
+        else:
+            if track is None:
+                wN, sN = _stft_lengths(sweep_cfg, T)
+                ns, fs = stft_peak_frequencies(data, T, wN, sN, sweep_cfg.f0, sweep_cfg.f1)
+            else:
+                track.feed(capture)
+                ns, fs = track.peak_frequencies(dly1_idx + m_0_, dly2_idx)
+
+            max_ns = max(ns)
+            ns /= max_ns
+            fs /= sweep_cfg.f1
+
+            w = np.clip(np.interp(fs*sweep_cfg.f1, result.f_bp, result.mag_fild), a_min=None, a_max=1.)
+
+            w = np.pow(w, SIGNAL_WEIGHTING_POWER)
+
+            progress('Fitting frequency map', 0.8)
+            i2f_bm, result.i2f_inliers, result.i2f_error = ransac_line_fit(
+                ns, fs, w, I2F_RANDOM_IDCS, I2F_CANDIDATE_ERROR_THD, I2F_CONSENSUS_THD, I2F_MAX_ITERATIONS, rng=rng)
+            if i2f_bm is None: raise FrequencyMapError('No consensus in the frequency map fit.')
+
+            i2f_bm[0] *= sweep_cfg.f1
+            i2f_bm[1] *= sweep_cfg.f1/max_ns
+    except (AnalysisCancelled, FrequencyMapError): raise
+    except Exception as e: raise FrequencyMapError(str(e)) from e
+
+    result.i2f_bm = i2f_bm
+    result.bm1_expected = sweep_cfg.dfdt*T
+
+    if result.bm1_ratio < I2F_BM1_RATIO_LOW_THD or result.bm1_ratio > I2F_BM1_RATIO_HIGH_THD:
+        raise FrequencyMapCrossCheckFailed(i2f_bm, result.bm1_expected)
+
+    return result
@@ -0,0 +1,97 @@
+import multiprocessing
+import os
+import threading
+
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from .analysis import analyze_manual, AnalysisCancelled
+
+
+# Set in each worker by the executor's initializer.
+_progress_queue = None
+_active_job = None
+
+
+def _init_worker(progress_queue, active_job):
+    global _progress_queue, _active_job
+    _progress_queue = progress_queue; _active_job = active_job
+
+
+def _run_analysis(job_id, args, kwargs):
+    def progress(stage, fraction):
+        if _active_job.value != job_id: raise AnalysisCancelled
+        _progress_queue.put((job_id, stage, fraction))
+    return analyze_manual(*args, progress=progress, **kwargs)
+
+
+class AnalysisRunner():
+    '''Runs `analyze_manual` in the background, one job at a time. Uses a worker
+    process when more than one core is available, so the analysis doesn't hold
+    the GIL against OctoPrint's threads; otherwise a worker thread.'''
+    def __init__(self, on_progress=None, use_process=None):
+        '''`on_progress(stage, fraction)` is called from a runner thread.'''
+        self.on_progress = on_progress
+        self.use_process = (os.cpu_count() or 1) > 1 if use_process is None else use_process
+        self._ctx = multiprocessing.get_context('spawn')
+        self._progress_queue = self._ctx.Queue()
+        self._active_job = self._ctx.Value('i', 0) # Id of the job allowed to run; 0 for none.
+        self._job_id = 0
+        self._executor = None
+        self._lock = threading.Lock()
+        threading.Thread(target=self._forward_progress, name='ulendocaas-analysis-progress', daemon=True).start()
+
+
+    def _get_executor(self):
+        if self._executor is None:
+            initargs = (self._progress_queue, self._active_job)
+            if self.use_process:
+                self._executor = ProcessPoolExecutor(max_workers=1, mp_context=self._ctx, initializer=_init_worker, initargs=initargs)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ulendocaas-analysis', initializer=_init_worker, initargs=initargs)
+        return self._executor
+
+
+    def warm_up(self):
+        '''Starts the worker ahead of the first job (a spawned process takes a while to import).'''
+        with self._lock: self._submit(int)
+
+
+    def _submit(self, fn, *args):
+        try: return self._get_executor().submit(fn, *args)
+        except BrokenExecutor: # Worker died (e.g. killed for memory); start a new one.
+            self._executor = None
+            return self._get_executor().submit(fn, *args)
+
+
+    def submit(self, on_done, *args, **kwargs):
+        '''Starts `analyze_manual(*args, **kwargs)`, cancelling any job in progress.
+        `on_done(future)` is called from a runner thread once it finishes.'''
+        with self._lock:
+            self._job_id += 1
+            self._active_job.value = self._job_id
+            future = self._submit(_run_analysis, self._job_id, args, kwargs)
+            job_id = self._job_id
+        future.add_done_callback(lambda future: self._finish(job_id)) # Drops progress still queued.
+        future.add_done_callback(on_done)
+        return future
+
+
+    def _finish(self, job_id):
+        with self._lock:
+            if self._active_job.value == job_id: self._active_job.value = 0
+
+
+    def cancel(self):
+        '''Cancels the job in progress; it ends with AnalysisCancelled at its next progress report.
+        Returns whether a job was in progress.'''
+        with self._lock:
+            active = self._active_job.value != 0
+            self._active_job.value = 0
+        return active
+
+
+    def _forward_progress(self):
+        while True:
+            try: job_id, stage, fraction = self._progress_queue.get()
+            except (EOFError, OSError): return # Queue closed at interpreter exit.
+            if job_id == self._active_job.value and self.on_progress is not None: self.on_progress(stage, fraction)
@@ -1,4 +1,5 @@
 SIMULATION = False # Simulate the accelerometer for development.
+SIMULATION_RATE_MULTIPLIER = 20. # Simulated time vs. wall time; None runs as fast as possible.
 
 
 # Plugin tab behavior.
@@ -7,27 +8,76 @@ ACCLRMTR_LIVE_VIEW_NUM_SAMPLES = 200
 
 
 # Calibration routine behavior.
-FSM_UPDATE_RATE_SEC = 0.25
+CENTER_POSITION_POLL_SEC = 0.25 # M114 period while waiting for the axis to center.
 GET_AXIS_INFO_TIMEOUT = 10.
 CENTER_AXIS_TIMEOUT = 12.
 MOVE_TO_CENTER_SPEED_MM_PER_MIN = 6000
 FSM_SWEEP_START_DLY = 0.5
 MAX_RETRIES_FOR_MISSED_SAMPLES = 2
+RX_METADATA_TIMEOUT_SEC = 10. # How long after the first printer line to watch for metadata (the M115 reply) outside a routine.
+
+
+# Resolution of the shaper parameters in the printer's M493 command, as decimal places.
+M493_FREQUENCY_DECIMALS = 2 # Hz
+M493_ZETA_DECIMALS = 4
+M493_VTOL_DECIMALS = 2
+SHAPER_RESPONSE_CACHE_SIZE = 64 # Shapers whose calibration plot series are kept for the active solution.
 
 
 # Manual calibration behavior.
+ALIGNMENT_SWEEP_TI = 0.5 # Sec of the sweep included when aligning the capture to the expected profile.
+ALIGNMENT_CONFIDENCE_THD = 0.2 # Least normalized correlation to trust the alignment over the quiet window search.
 LOC_DLY2_TI = 3.
 LOC_DLY3_TI = 3.
 WEAK_SIGNAL_CHECK_TI = 3.
 WEAK_SIGNAL_CHECK_THD = 0.45
+MAG_SMOOTHING_HALF_WIDTH = 0.4 # Hz, half width of the magnitude plot smoothing kernel.
 SIGNAL_WEIGHTING_POWER = 3.
 I2F_RANDOM_IDCS = 10
 I2F_CANDIDATE_ERROR_THD = 5e-2
 I2F_MAX_ITERATIONS = 100
 I2F_CONSENSUS_THD = 10
+I2F_ANALYTIC_LOWPASS_TI = 0.1 # Sec, averaging time of the demodulated chirp in the analytic estimator.
+I2F_RANDOM_SEED = None # Seed for the fit's random subsets; None for a fresh seed each run.
 I2F_BM1_RATIO_LOW_THD = 0.25
 I2F_BM1_RATIO_HIGH_THD = 1.25
+STREAMING_ANALYSIS_PERIOD_SEC = 0.5 # How often the sweep capture is fed to the streaming analysis.
+
+
+# Shaper optimizer.
+OPT_NUM_FREQS = 160 # Points the measured response is resampled to for the search.
+OPT_RIGID_GAIN = 1. # Transfer magnitude of a rigid axis; only the response above it counts as vibration.
+OPT_FREQ_SHIFT = 0.05 # Fractional shift of the response the residual must also hold under.
+OPT_WC_SPAN = 0.15 # Fraction either side of the solution's frequency to search.
+OPT_WC_STEPS = 13
+OPT_ZT_MIN = 0.005
+OPT_ZT_MAX = 0.5
+OPT_ZT_STEPS = 10 # Log spaced.
+OPT_VTOL_MIN = 0.01 # 2H EI does not support 0 vtol.
+OPT_VTOL_MAX = 0.25
+OPT_VTOL_STEPS = 5
+OPT_REFINE_CANDIDATES = 3 # Best grid points of each type refined.
+OPT_REFINE_ITERATIONS = 4
+OPT_RESIDUAL_TARGET = 0.05 # Residual within which the shortest shaper is recommended.
+
+
+# Shaper time domain predictions.
+PREDICT_SAMPLES_PER_PERIOD = 100 # Of the mode the step response models.
+PREDICT_SETTLE_BAND = 0.02 # Fraction of the step the response settles within.
+PREDICT_MARGIN_TI = 0.1
+PREDICT_MAX_TI = 5.
 
 
 SERVICE_URL = 'https://ogsxeca3e2.execute-api.us-east-2.amazonaws.com/beta/solve'
-SERVICE_TIMEOUT_THD = 30
+SERVICE_TIMEOUT_THD = 30 # Sec to wait for a response once connected.
+SERVICE_CONNECT_TIMEOUT = 5.
+SERVICE_READ_TIMEOUTS = { 'VERIFY_CREDENTIALS': 10., 'UPLOAD_IMAGE': 60. } # By operation, where not SERVICE_TIMEOUT_THD.
+SERVICE_POOL_SIZE = 2 # Connections kept alive to the service.
+SERVICE_MAX_RETRIES = 2
+SERVICE_RETRY_BACKOFF = 0.5 # Sec before the first retry, doubling for each further one.
+SERVICE_RETRY_STATUSES = (502, 503, 504)
+SERVICE_LATENCY_HISTORY = 20
+
+CAPTURE_ENCODING_LEGACY = 1 # Base64 float32 samples, the body sent as a JSON-encoded string.
+CAPTURE_ENCODING_VERSION = 2 # int16 counts (else float32), compressed, in a plain JSON body.
+CAPTURE_COMPRESS_LEVEL = 1 # zlib level; None sends the samples uncompressed.
@@ -1,238 +1,98 @@
-from math import sqrt, exp, pi, sin, cos, log10
+from math import sqrt, pi, log10
 import numpy as np
 
 
-def zv_mag1(wc, zt, w):
-    df = sqrt(1. - zt*zt)
-    k_ = exp(-zt*pi/df)
-    a0 = 1/(1+k_)
-    a1 = k_/(1+k_)
-    im = a1*sin((w/wc)*(pi/df))
-    re = a0 + a1*cos((w/wc)*(pi/df))
-    return 20.*log10(sqrt(re*re + im*im))
-    
-
-def zv_mag2(wc, zt, w):
-    if w > 2*wc*sqrt(1. - zt*zt):
-        return 0.
-    else:
-        return zv_mag1(wc, zt, w)
-    
-
-def zv_mags(wc, zt, w):
-    df = sqrt(1. - zt*zt)
-    k_ = exp(-zt*pi/df)
-    a0 = 1/(1+k_)
-    a1 = k_/(1+k_)
-    arg = (w/wc)*(pi/df)
-    im = a1*np.sin(arg)
-    re = a0 + a1*np.cos(arg)
-    return np.sqrt(re**2 + im**2)
-    
-
-def zvd_mag1(wc, zt, w):
-    df = sqrt(1. - zt*zt)
-    k_ = exp(-zt*pi/df)
-    a0 = 1/(1+2*k_+k_*k_)
-    a1 = 2*k_*a0
-    a2 = k_*k_*a0
-    im = a1*sin((w/wc)*(pi/df)) + a2*sin(2*(w/wc)*(pi/df))
-    re = a0 + a1*cos((w/wc)*(pi/df)) + a2*cos(2*(w/wc)*(pi/df))
-    return 20.*log10(sqrt(re*re + im*im))
-    
-
-def zvd_mag2(wc, zt, w):
-    if w > 2*wc*sqrt(1. - zt*zt):
-        return 0.
-    else:
-        return zvd_mag1(wc, zt, w)
-
-
-def zvd_mags(wc, zt, w):
-    df = sqrt(1. - zt*zt)
-    k_ = exp(-zt*pi/df)
-    a0 = 1/(1+2*k_+k_*k_)
-    a1 = 2*k_*a0
-    a2 = k_*k_*a0
-    arg = (w/wc)*(pi/df)
-    arg2 = 2.*arg
-    im = a1*np.sin(arg) + a2*np.sin(arg2)
-    re = a0 + a1*np.cos(arg) + a2*np.cos(arg2)
-    return np.sqrt(re**2 + im**2)
-
-
-def mzv_mag1(wc, zt, w):
-    df = sqrt(1. - zt*zt)
-    k_ = exp(-zt*pi/df)
-    B = 1.4142135623730950488016887242097*k_
-    a0 = 1./(1.+B+k_*k_)
-    a1 = B*a0
-    a2 = k_*k_*a0
-    im = a1*sin((w/wc)*(0.75*pi/df)) + a2*sin(2*(w/wc)*(0.75*pi/df))
-    re = a0 + a1*cos((w/wc)*(0.75*pi/df)) + a2*cos(2*(w/wc)*(0.75*pi/df))
-    return 20.*log10(sqrt(re*re + im*im))
-
-
-def mzv_mag2(wc, zt, w):
-    if w > wc*sqrt(1. - zt*zt)/0.375:
-        return 0.
-    else:
-        return mzv_mag1(wc, zt, w)
-    
-
-def mzv_mags(wc, zt, w):
-    df = sqrt(1. - zt*zt)
-    k_ = exp(-zt*pi/df)
-    B = 1.4142135623730950488016887242097*k_
-    a0 = 1./(1.+B+k_*k_)
-    a1 = B*a0
-    a2 = k_*k_*a0
-    arg = (w/wc)*(0.75*pi/df)
-    arg2 = 2.*arg
-    im = a1*np.sin(arg) + a2*np.sin(arg2)
-    re = a0 + a1*np.cos(arg) + a2*np.cos(arg2)
-    return np.sqrt(re**2 + im**2)
-
-
-def ei_mag1(wc, zt, vtol, w):
-    df = sqrt(1. - zt*zt)
-    k_ = exp(-zt*pi/df)
-    a0 = 0.25 * (1. + vtol)
-    a1 = 0.5 * (1. - vtol) * k_
-    a2 = a0 * k_*k_
-    a_adj = 1. / (a0 + a1 + a2)
-    a0 *= a_adj
-    a1 *= a_adj
-    a2 *= a_adj
-    im = a1*sin((w/wc)*(pi/df)) + a2*sin(2*(w/wc)*(pi/df))
-    re = a0 + a1*cos((w/wc)*(pi/df)) + a2*cos(2*(w/wc)*(pi/df))
-    return 20.*log10(sqrt(re*re + im*im))
-
-
-def ei_mag2(wc, zt, vtol, w):
-    if w > 2*wc*sqrt(1. - zt*zt):
-        return 0.
-    else:
-        return ei_mag1(wc, zt, vtol, w)
-
-
-def ei_mags(wc, zt, vtol, w):
-    df = sqrt(1. - zt*zt)
-    k_ = exp(-zt*pi/df)
-    a0 = 0.25 * (1. + vtol)
-    a1 = 0.5 * (1. - vtol) * k_
-    a2 = a0 * k_*k_
-    a_adj = 1. / (a0 + a1 + a2)
-    a0 *= a_adj
-    a1 *= a_adj
-    a2 *= a_adj
-    arg = (w/wc)*(pi/df)
-    arg2 = 2.*arg
-    im = a1*np.sin(arg) + a2*np.sin(arg2)
-    re = a0 + a1*np.cos(arg) + a2*np.cos(arg2)
-    return np.sqrt(re**2 + im**2)
-
-
-def ei2h_mag1(wc, zt, vtol, w):
-    df = sqrt(1. - zt*zt)
-    k_ = exp(-zt*pi/df)
-    vtol2 = vtol * vtol
-    k2 = pow(vtol2 * (sqrt(1. - vtol2) + 1.), 1./3.)
-    a0 = (3.*k2*k2 + 2.*k2 + 3*vtol2) / (16.*k2)
-    a1 = (0.5 - a0) * k_
-    a2 = a1 * k_
-    a3 = a0 * k_*k_*k_
-    a_adj = 1. / (a0 + a1 + a2 + a3)
-    a0 *= a_adj
-    a1 *= a_adj
-    a2 *= a_adj
-    a3 *= a_adj
-    im = a1*sin((w/wc)*(pi/df)) + a2*sin(2*(w/wc)*(pi/df)) + a3*sin(3*(w/wc)*(pi/df))
-    re = a0 + a1*cos((w/wc)*(pi/df)) + a2*cos(2*(w/wc)*(pi/df)) + a3*cos(3*(w/wc)*(pi/df))
-    return 20.*log10(sqrt(re*re + im*im))
-
-def ei2h_mag2(wc, zt, vtol, w):
-    if w > 2*wc*sqrt(1. - zt*zt):
-        return 0.
-    else:
-        return ei2h_mag1(wc, zt, vtol, w)
-    
-
-def ei2h_mags(wc, zt, vtol, w):
-    df = sqrt(1. - zt*zt)
-    k_ = exp(-zt*pi/df)
-    vtol2 = vtol * vtol
-    k2 = pow(vtol2 * (sqrt(1. - vtol2) + 1.), 1./3.)
-    a0 = (3.*k2*k2 + 2.*k2 + 3*vtol2) / (16.*k2)
-    a1 = (0.5 - a0) * k_
-    a2 = a1 * k_
-    a3 = a0 * k_*k_*k_
-    a_adj = 1. / (a0 + a1 + a2 + a3)
-    a0 *= a_adj
-    a1 *= a_adj
-    a2 *= a_adj
-    a3 *= a_adj
-    arg = (w/wc)*(pi/df)
-    arg2 = 2.*arg
-    arg3 = 3.*arg
-    im = a1*np.sin(arg) + a2*np.sin(arg2) + a3*np.sin(arg3)
-    re = a0 + a1*np.cos(arg) + a2*np.cos(arg2) + a3*np.cos(arg3)
-    return np.sqrt(re**2 + im**2)
-
-
-def ei3h_mag1(wc, zt, vtol, w):
-    df = sqrt(1. - zt*zt)
-    k_ = exp(-zt*pi/df)
-    a0 = 0.0625 * ( 1. + 3.*vtol + 2.*sqrt(2. * (vtol + 1.)*vtol ) )
-    a1 = 0.25 * (1. - vtol) * k_
-    a2 = ( 0.5 * (1. + vtol) - 2. * a0 ) * k_ * k_
-    a3 = a1 * k_ * k_
-    a4 = a0 * k_ * k_ * k_ * k_
-    a_adj = 1. / (a0 + a1 + a2 + a3 + a4)
-    a0 *= a_adj
-    a1 *= a_adj
-    a2 *= a_adj
-    a3 *= a_adj
-    a4 *= a_adj
-    im = a1*sin((w/wc)*(pi/df)) + a2*sin(2*(w/wc)*(pi/df)) + a3*sin(3*(w/wc)*(pi/df)) + a4*sin(4*(w/wc)*(pi/df))
-    re = a0 + a1*cos((w/wc)*(pi/df)) + a2*cos(2*(w/wc)*(pi/df)) + a3*cos(3*(w/wc)*(pi/df)) + a4*cos(4*(w/wc)*(pi/df))
-    return 20.*log10(sqrt(re*re + im*im))
-
-
-def ei3h_mag2(wc, zt, vtol, w):
-    if w > 2*wc*sqrt(1. - zt*zt):
-        return 0.
-    else:
-        return ei3h_mag1(wc, zt, vtol, w)
-    
-
-def ei3h_mags(wc, zt, vtol, w):
-    df = sqrt(1. - zt*zt)
-    k_ = exp(-zt*pi/df)
-    a0 = 0.0625 * ( 1. + 3.*vtol + 2.*sqrt(2. * (vtol + 1.)*vtol ) )
-    a1 = 0.25 * (1. - vtol) * k_
-    a2 = ( 0.5 * (1. + vtol) - 2. * a0 ) * k_ * k_
-    a3 = a1 * k_ * k_
-    a4 = a0 * k_ * k_ * k_ * k_
-    a_adj = 1. / (a0 + a1 + a2 + a3 + a4)
-    a0 *= a_adj
-    a1 *= a_adj
-    a2 *= a_adj
-    a3 *= a_adj
-    a4 *= a_adj
-    arg = (w/wc)*(pi/df)
-    arg2 = 2.*arg
-    arg3 = 3.*arg
-    arg4 = 4.*arg
-    im = a1*np.sin(arg) + a2*np.sin(arg2) + a3*np.sin(arg3) + a4*np.sin(arg4)
-    re = a0 + a1*np.cos(arg) + a2*np.cos(arg2) + a3*np.cos(arg3) + a4*np.cos(arg4)
-    return np.sqrt(re**2 + im**2)
+class ShaperImpulses():
+    '''Impulse amplitude/time table of an input shaper: amplitudes `a` (summing
+    to 1 along the last axis) applied at `t`, with the impulses `td` seconds
+    apart. Tables for many designs at once carry their leading axes in td and a.'''
+    def __init__(self, a, td): self.a = a; self.td = td; self.t = np.multiply.outer(td, np.arange(a.shape[-1]))
+    @property
+    def duration(self): return self.td*(self.a.shape[-1] - 1)
+
+
+def shaper_impulses(type, wc, zt, vtol=None):
+    '''Impulse table of a `type` shaper designed for the mode at wc (rad/sec), zt.
+    Any of wc, zt and vtol may be arrays, giving a table per broadcast design.'''
+    zt = np.asarray(zt, dtype=float)
+    df = np.sqrt(1. - zt*zt)
+    k_ = np.exp(-zt*pi/df)
+    td = pi/(np.asarray(wc, dtype=float)*df) # Half the damped period.
+    if vtol is not None: vtol = np.asarray(vtol, dtype=float)
+
+    if type == 'zv': a = [1., k_]
+    elif type == 'zvd': a = [1., 2.*k_, k_**2]
+    elif type == 'zvdd': a = [1., 3.*k_, 3.*k_**2, k_**3]
+    elif type == 'zvddd': a = [1., 4.*k_, 6.*k_**2, 4.*k_**3, k_**4]
+    elif type == 'mzv': a = [1., 1.4142135623730950488016887242097*k_, k_**2]; td = 0.75*td
+    elif type == 'ei':
+        a0 = 0.25*(1. + vtol)
+        a = [a0, 0.5*(1. - vtol)*k_, a0*k_**2]
+    elif type == 'ei2h':
+        vtol2 = vtol*vtol
+        k2 = np.cbrt(vtol2*(np.sqrt(1. - vtol2) + 1.))
+        a0 = (3.*k2*k2 + 2.*k2 + 3*vtol2)/(16.*k2)
+        a1 = (0.5 - a0)*k_
+        a = [a0, a1, a1*k_, a0*k_**3]
+    elif type == 'ei3h':
+        a0 = 0.0625*(1. + 3.*vtol + 2.*np.sqrt(2.*(vtol + 1.)*vtol))
+        a1 = 0.25*(1. - vtol)*k_
+        a = [a0, a1, (0.5*(1. + vtol) - 2.*a0)*k_**2, a1*k_**2, a0*k_**4]
+    else: raise ValueError('Unknown shaper type: ' + str(type))
+
+    a = np.stack(np.broadcast_arrays(*a), axis=-1)
+    return ShaperImpulses(a/np.sum(a, axis=-1, keepdims=True), td)
+
+
+def impulse_mags(imp, w, zt=0.):
+    '''Magnitude of the response of the impulse table `imp` at frequencies w (rad/sec).
+    The result has the table's design axes followed by the axes of w. With zt,
+    it is instead the residual vibration of a mode of damping zt at each w,
+    relative to that of a single impulse.
+
+    The impulses are equally spaced, so the response is a polynomial in
+    z = exp(s*td); one complex exponential per w is taken and the harmonics
+    are accumulated by Horner's recurrence instead of a sin/cos per harmonic.'''
+    w = np.asarray(w, dtype=float)
+    z = np.exp(np.multiply.outer(imp.td, w*(zt + 1j*sqrt(1. - zt*zt))))
+    a = imp.a.reshape(imp.a.shape[:-1] + (1,)*w.ndim + imp.a.shape[-1:])
+    r = np.zeros(np.broadcast_shapes(z.shape, a.shape[:-1]), dtype=complex); r += a[..., -1]
+    for k in range(a.shape[-1] - 2, -1, -1): r *= z; r += a[..., k]
+    if zt == 0.: return np.abs(r)
+    return np.abs(r)*np.exp(-zt*np.multiply.outer(imp.duration, w))
 
 
 def get_ismag(w, type, wc, zt, vtol=None):
-    if type == 'zv': return zv_mags(wc, zt, w)
-    elif type == 'zvd': return zvd_mags(wc, zt, w)
-    elif type == 'mzv': return mzv_mags(wc, zt, w)
-    elif type == 'ei': return ei_mags(wc, zt, vtol, w)
-    elif type == 'ei2h': return ei2h_mags(wc, zt, vtol, w)
-    elif type == 'ei3h': return ei3h_mags(wc, zt, vtol, w)
+    return impulse_mags(shaper_impulses(type, wc, zt, vtol), w)
+
+
+def get_ismag_db(w, type, wc, zt, vtol=None, cutoff=False):
+    '''get_ismag in dB. With `cutoff`, 0 is given beyond the first repeat of the
+    response (w > 2*pi/td), where the shaper gives no further attenuation.'''
+    imp = shaper_impulses(type, wc, zt, vtol)
+    mags = 20.*np.log10(impulse_mags(imp, w))
+    if cutoff: mags = np.where(np.asarray(w) > 2.*pi/imp.td, 0., mags)
+    return mags
+
+
+# Single-shaper helpers, kept for existing callers.
+def zv_mag1(wc, zt, w): return 20.*log10(float(get_ismag(w, 'zv', wc, zt)))
+def zv_mag2(wc, zt, w): return float(get_ismag_db(w, 'zv', wc, zt, cutoff=True))
+def zv_mags(wc, zt, w): return get_ismag(w, 'zv', wc, zt)
+def zvd_mag1(wc, zt, w): return 20.*log10(float(get_ismag(w, 'zvd', wc, zt)))
+def zvd_mag2(wc, zt, w): return float(get_ismag_db(w, 'zvd', wc, zt, cutoff=True))
+def zvd_mags(wc, zt, w): return get_ismag(w, 'zvd', wc, zt)
+def zvdd_mags(wc, zt, w): return get_ismag(w, 'zvdd', wc, zt)
+def zvddd_mags(wc, zt, w): return get_ismag(w, 'zvddd', wc, zt)
+def mzv_mag1(wc, zt, w): return 20.*log10(float(get_ismag(w, 'mzv', wc, zt)))
+def mzv_mag2(wc, zt, w): return float(get_ismag_db(w, 'mzv', wc, zt, cutoff=True))
+def mzv_mags(wc, zt, w): return get_ismag(w, 'mzv', wc, zt)
+def ei_mag1(wc, zt, vtol, w): return 20.*log10(float(get_ismag(w, 'ei', wc, zt, vtol)))
+def ei_mag2(wc, zt, vtol, w): return float(get_ismag_db(w, 'ei', wc, zt, vtol, cutoff=True))
+def ei_mags(wc, zt, vtol, w): return get_ismag(w, 'ei', wc, zt, vtol)
+def ei2h_mag1(wc, zt, vtol, w): return 20.*log10(float(get_ismag(w, 'ei2h', wc, zt, vtol)))
+def ei2h_mag2(wc, zt, vtol, w): return float(get_ismag_db(w, 'ei2h', wc, zt, vtol, cutoff=True))
+def ei2h_mags(wc, zt, vtol, w): return get_ismag(w, 'ei2h', wc, zt, vtol)
+def ei3h_mag1(wc, zt, vtol, w): return 20.*log10(float(get_ismag(w, 'ei3h', wc, zt, vtol)))
+def ei3h_mag2(wc, zt, vtol, w): return float(get_ismag_db(w, 'ei3h', wc, zt, vtol, cutoff=True))
+def ei3h_mags(wc, zt, vtol, w): return get_ismag(w, 'ei3h', wc, zt, vtol)
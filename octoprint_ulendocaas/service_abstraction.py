@@ -1,11 +1,12 @@
 from .cfg import *
 from .service_exceptions import *
+from .service_client import ServiceClient
 
 import requests
 import base64
 import socket
-import struct
 import json
+import zlib
 from PIL import Image
 from io import BytesIO
 
@@ -14,7 +15,17 @@ import numpy as np
 from datetime import datetime
 
 
-def verify_credentials(org_id, access_id, machine_id, plugin_logger):
+_default_client = None
+
+
+def default_service_client():
+    '''Client shared by calls not given one.'''
+    global _default_client
+    if _default_client is None: _default_client = ServiceClient()
+    return _default_client
+
+
+def verify_credentials(org_id, access_id, machine_id, plugin_logger, client=None):
     now = datetime.now()
     postdata =  {   'ACTION': 'VERIFY',
                     'ACCESS':{
@@ -29,13 +40,18 @@ def verify_credentials(org_id, access_id, machine_id, plugin_logger):
                     }
                 }
        
+    client = client or default_service_client()
     try: 
-        postreq = requests.post(SERVICE_URL, json=json.dumps(postdata))
+        postreq = client.post('VERIFY_CREDENTIALS', json.dumps(postdata), idempotent=True)
         response_body = postreq.json()
         plugin_logger.info(f'Output from verify creds: {response_body}')
 
         if 'exception' in response_body: raise_exception_from_response(response_body['exception'])
-        else: return True
+        else:
+            # The service lists the capture encodings it accepts; ones that don't get the legacy encoding.
+            accepted = response_body.get('capture_encodings', [])
+            client.capture_encoding = CAPTURE_ENCODING_VERSION if CAPTURE_ENCODING_VERSION in accepted else CAPTURE_ENCODING_LEGACY
+            return True
     except requests.RequestException as e:
         plugin_logger.error(f'Network error in verify_credentials: {str(e)}')
         raise
@@ -44,7 +60,7 @@ def verify_credentials(org_id, access_id, machine_id, plugin_logger):
         raise
 
 
-def upload_image_rating(image_bytes, rating, org_id, access_id, machine_id, machine_name, logger):
+def upload_image_rating(image_bytes, rating, org_id, access_id, machine_id, machine_name, logger, client=None):
     now = datetime.now()
     
     postdata =  {   
@@ -66,7 +82,7 @@ def upload_image_rating(image_bytes, rating, org_id, access_id, machine_id, mach
                 }
     
     try: 
-        postreq = requests.post(SERVICE_URL, json=postdata)
+        postreq = (client or default_service_client()).post('UPLOAD_IMAGE', postdata)
         response_body = postreq.json()
         logger.info(f'Output from upload image: {response_body}')
 
@@ -94,11 +110,67 @@ def get_source_ip():
     
 
 def encode_float_list_to_base64(list):
-    bin_data = struct.pack(f'{len(list)}f', *list)
+    # Sample buffers are already contiguous float32, in which case this doesn't copy.
+    bin_data = np.ascontiguousarray(list, dtype=np.float32)
     return base64.b64encode(bin_data).decode('utf-8')
 
 
-def get_run_post_data(version, axis, accelerometer, sweep_cfg, metadata, plugin_settings):
+def encode_capture(samples, lsb=None):
+    '''One axis's samples in the compact capture encoding. Samples that are all
+    whole counts of `lsb` are sent as int16 counts and the scale, else as
+    float32, little-endian and zlib-compressed at CAPTURE_COMPRESS_LEVEL.'''
+    samples = np.asarray(samples, dtype=np.float32)
+    data = None
+    if lsb is not None:
+        counts = np.rint(samples.astype(np.float64)/lsb)
+        # Only lossless if the counts give back the very float32 samples the device produced.
+        if np.all(np.abs(counts) <= 32767) and np.array_equal((counts*lsb).astype(np.float32), samples):
+            data = counts.astype('<i2').tobytes(); capture = { 'ENCODING': 'int16', 'SCALE': lsb }
+    if data is None: data = samples.astype('<f4').tobytes(); capture = { 'ENCODING': 'float32' }
+
+    if CAPTURE_COMPRESS_LEVEL is not None: data = zlib.compress(data, CAPTURE_COMPRESS_LEVEL); capture['COMPRESSION'] = 'zlib'
+    else: capture['COMPRESSION'] = 'none'
+    capture.update(COUNT=len(samples), DATA=base64.b64encode(data).decode('ascii'))
+    return capture
+
+
+def set_capture_encoding(postdata, accelerometer, capture_encoding):
+    '''Fills in the axis responses of `postdata` in the `capture_encoding` wire format.'''
+    if capture_encoding == CAPTURE_ENCODING_LEGACY:
+        encode = encode_float_list_to_base64
+        postdata['REQUEST'].pop('CAPTURE_ENCODING', None)
+    else:
+        encode = lambda samples: encode_capture(samples, accelerometer.lsb)
+        postdata['REQUEST']['CAPTURE_ENCODING'] = capture_encoding
+    postdata['XAXISRESPONSE'] = encode(accelerometer.x_buff)
+    postdata['YAXISRESPONSE'] = encode(accelerometer.y_buff)
+    postdata['ZAXISRESPONSE'] = encode(accelerometer.z_buff)
+
+
+def post_run_data(client, operation, postdata, accelerometer, plugin_settings, idempotent=False):
+    '''POSTs a run in the capture encoding the service accepts, returning the
+    response body. A service that turns the compact encoding down is sent
+    the run again in, and from then on gets, the legacy encoding.'''
+    client = client or default_service_client()
+    while True:
+        capture_encoding = client.capture_encoding
+        set_capture_encoding(postdata, accelerometer, capture_encoding)
+        if plugin_settings.get(["save_post_data_locally"]): save_post_as_file(postdata)
+
+        # The legacy body is a JSON-encoded string of the post data.
+        legacy = capture_encoding == CAPTURE_ENCODING_LEGACY
+        postreq = client.post(operation, json.dumps(postdata) if legacy else postdata, idempotent=idempotent)
+        # A gateway error's body is HTML; raise it as the HTTPError it is rather than fail to decode it.
+        if postreq.status_code in SERVICE_RETRY_STATUSES: postreq.raise_for_status()
+        if not legacy and postreq.status_code == 415: client.capture_encoding = CAPTURE_ENCODING_LEGACY; continue
+
+        response_body = json.loads(postreq.text)
+        if not legacy and response_body.get('exception') == 'UnsupportedCaptureEncoding': client.capture_encoding = CAPTURE_ENCODING_LEGACY; continue
+        return response_body
+
+
+def get_run_post_data(version, axis, accelerometer, sweep_cfg, metadata, plugin_settings, capture_encoding=CAPTURE_ENCODING_LEGACY):
+    '''Post data for a run. The axis responses are left unset for a `capture_encoding` of None.'''
 
     now = datetime.now()
 
@@ -108,9 +180,9 @@ def get_run_post_data(version, axis, accelerometer, sweep_cfg, metadata, plugin_
                         'RANGE': plugin_settings.get(["accelerometer_range"]),
                         'RATE': plugin_settings.get(["accelerometer_rate"])
                     },
-                    'XAXISRESPONSE': encode_float_list_to_base64(accelerometer.x_buff),
-                    'YAXISRESPONSE': encode_float_list_to_base64(accelerometer.y_buff),
-                    'ZAXISRESPONSE': encode_float_list_to_base64(accelerometer.z_buff),
+                    'XAXISRESPONSE': None,
+                    'YAXISRESPONSE': None,
+                    'ZAXISRESPONSE': None,
                     'AXIS': axis,
                     'OPERATION': '',
                     'METADATA': metadata if metadata is not {} else 'N/A',
@@ -135,6 +207,7 @@ def get_run_post_data(version, axis, accelerometer, sweep_cfg, metadata, plugin_
                         'MANUFACTURER_NAME': ""
                     },                    
                 }
+    if capture_encoding is not None: set_capture_encoding(postdata, accelerometer, capture_encoding)
     
     return postdata
 
@@ -149,16 +222,13 @@ def save_post_as_file(postdata):
     except: pass
 
 
-def autocal_service_solve(version, axis, accelerometer, sweep_cfg, metadata, plugin_settings):
+def autocal_service_solve(version, axis, accelerometer, sweep_cfg, metadata, plugin_settings, client=None):
     
-    postdata = get_run_post_data(version, axis, accelerometer, sweep_cfg, metadata, plugin_settings)
+    postdata = get_run_post_data(version, axis, accelerometer, sweep_cfg, metadata, plugin_settings, capture_encoding=None)
     
     postdata['OPERATION'] = 'SOLVE'
-
-    if plugin_settings.get(["save_post_data_locally"]): save_post_as_file(postdata)
          
-    postreq = requests.post(SERVICE_URL, json=json.dumps(postdata), timeout=SERVICE_TIMEOUT_THD)
-    response_body = json.loads(postreq.text)
+    response_body = post_run_data(client, 'SOLVE', postdata, accelerometer, plugin_settings)
         
     if 'exception' in response_body: raise_exception_from_response(response_body['exception'])
     elif 'solution' in response_body:
@@ -170,16 +240,13 @@ def autocal_service_solve(version, axis, accelerometer, sweep_cfg, metadata, plu
     else: raise UnknownResponse
 
 
-def autocal_service_guidata(version, axis, accelerometer, sweep_cfg, metadata, plugin_settings):
+def autocal_service_guidata(version, axis, accelerometer, sweep_cfg, metadata, plugin_settings, client=None):
     
-    postdata = get_run_post_data(version, axis, accelerometer, sweep_cfg, metadata, plugin_settings)
+    postdata = get_run_post_data(version, axis, accelerometer, sweep_cfg, metadata, plugin_settings, capture_encoding=None)
     
     postdata['OPERATION'] = 'VERIFY'
-    
-    if plugin_settings.get(["save_post_data_locally"]): save_post_as_file(postdata)
 
-    postreq = requests.post(SERVICE_URL, json=json.dumps(postdata), timeout=SERVICE_TIMEOUT_THD)
-    response_body = json.loads(postreq.text)
+    response_body = post_run_data(client, 'VERIFY', postdata, accelerometer, plugin_settings, idempotent=True)
 
     if 'exception' in response_body: raise_exception_from_response(response_body['exception'])
     elif 'verification' in response_body:
@@ -190,9 +257,9 @@ def autocal_service_guidata(version, axis, accelerometer, sweep_cfg, metadata, p
     else: raise UnknownResponse
 
 
-def autocal_service_share(version, axis, is_verification, accelerometer, sweep_cfg, metadata, plugin_settings, plugin_logger, calibration_type=None, wc=None, zt=None, vtol=None):
+def autocal_service_share(version, axis, is_verification, accelerometer, sweep_cfg, metadata, plugin_settings, plugin_logger, calibration_type=None, wc=None, zt=None, vtol=None, client=None):
 
-    postdata = get_run_post_data(version, axis, accelerometer, sweep_cfg, metadata, plugin_settings)
+    postdata = get_run_post_data(version, axis, accelerometer, sweep_cfg, metadata, plugin_settings, capture_encoding=None)
     
     postdata['OPERATION'] = 'SHARE-MANUAL-ANALYZE' if not is_verification else 'SHARE-MANUAL-VERIFY'
 
@@ -203,10 +270,7 @@ def autocal_service_share(version, axis, is_verification, accelerometer, sweep_c
         postdata['CALIBRATION_SELECTION']['ZT'] = zt
         postdata['CALIBRATION_SELECTION']['VTOL'] = vtol
 
-    if plugin_settings.get(["save_post_data_locally"]): save_post_as_file(postdata)
-
-    postreq = requests.post(SERVICE_URL, json=json.dumps(postdata), timeout=SERVICE_TIMEOUT_THD)
-    response_body = json.loads(postreq.text)
+    response_body = post_run_data(client, 'SHARE', postdata, accelerometer, plugin_settings)
 
     if response_body['message'] == 'Data share success.':
         plugin_logger.info(f'The server reported the data was shared successfully.')
@@ -221,5 +285,6 @@ def raise_exception_from_response(exception_str):
     elif exception_str == "NotAuthenticated": raise NotAuthenticated
     elif exception_str == "MachineIDNotFound": raise MachineIDNotFound
     elif exception_str == "PictureUploadError": raise PictureUploadError
+    elif exception_str == "UnsupportedCaptureEncoding": raise UnsupportedCaptureEncoding
     else: raise Exception('Unknown exception returned from service.')
 
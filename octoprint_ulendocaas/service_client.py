@@ -0,0 +1,84 @@
+import collections
+import json
+import time
+
+import requests
+import urllib3
+
+from .cfg import *
+
+
+def _never_sent(e):
+    '''Whether a request failed before any of it could reach the service.'''
+    if isinstance(e, requests.exceptions.ConnectTimeout): return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(e, requests.exceptions.ConnectionError) and isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+class ServiceClient():
+    '''Client for the calibration service. Keeps its connections alive between
+    calls, retries failed calls with exponential backoff, and records how long
+    each phase of each call took (the latest SERVICE_LATENCY_HISTORY in
+    `latencies`).'''
+    def __init__(self, url=SERVICE_URL, logger=None, pool_size=SERVICE_POOL_SIZE):
+        self.url = url
+        self.logger = logger
+        self.latencies = collections.deque(maxlen=SERVICE_LATENCY_HISTORY)
+        self.capture_encoding = CAPTURE_ENCODING_LEGACY # Until the service says it accepts a newer one.
+        self._adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', self._adapter); self.session.mount('http://', self._adapter)
+
+
+    def _connections_made(self):
+        '''Connections opened so far by the pools the session holds (looked up
+        without creating one, which would evict the pool in use).'''
+        pools = self._adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+
+    def post(self, operation, body, idempotent=False):
+        '''POSTs `body` as JSON and returns the response, its content read. The
+        timeouts are SERVICE_CONNECT_TIMEOUT and the operation's read timeout.
+        Idempotent operations are retried on any connection error, timeout or
+        SERVICE_RETRY_STATUSES status; others only when they could not have
+        reached the service.'''
+        t0 = time.perf_counter()
+        data = json.dumps(body, allow_nan=False).encode('utf-8')
+        record = dict(operation=operation, attempts=0, new_connections=0, encode=time.perf_counter() - t0,
+                      request=0., read=0., status=None)
+        timeout = (SERVICE_CONNECT_TIMEOUT, SERVICE_READ_TIMEOUTS.get(operation, SERVICE_TIMEOUT_THD))
+
+        try:
+            for attempt in range(SERVICE_MAX_RETRIES + 1):
+                if attempt > 0: time.sleep(SERVICE_RETRY_BACKOFF*2**(attempt - 1))
+                record['attempts'] += 1
+                connections = self._connections_made()
+                t1 = time.perf_counter()
+                try:
+                    response = self.session.post(self.url, data=data, headers={'Content-Type': 'application/json'},
+                                                 timeout=timeout, stream=True)
+                    t2 = time.perf_counter()
+                    response.content # Reads the body, returning the connection to the pool.
+                    t3 = time.perf_counter()
+                except requests.RequestException as e:
+                    record['request'] += time.perf_counter() - t1
+                    record['new_connections'] += max(0, self._connections_made() - connections)
+                    if attempt < SERVICE_MAX_RETRIES and (idempotent or _never_sent(e)): continue
+                    record['status'] = type(e).__name__
+                    raise
+                record['request'] += t2 - t1; record['read'] += t3 - t2
+                record['new_connections'] += max(0, self._connections_made() - connections)
+                record['status'] = response.status_code
+                if idempotent and response.status_code in SERVICE_RETRY_STATUSES and attempt < SERVICE_MAX_RETRIES: continue
+                return response
+        finally:
+            record['total'] = time.perf_counter() - t0
+            self.latencies.append(record)
+            if self.logger is not None:
+                self.logger.info(f'Service {operation}: {record["status"]} after {record["attempts"]} attempt(s),'\
+                                 f' {record["new_connections"]} new connection(s); encode {record["encode"]*1000.:.0f} ms,'\
+                                 f' request {record["request"]*1000.:.0f} ms, read {record["read"]*1000.:.0f} ms.')
+
+
+    def close(self): self.session.close()
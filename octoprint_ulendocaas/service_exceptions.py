@@ -11,3 +11,4 @@ class UnknownResponse(Exception): pass
 class NotAuthenticated(Exception): pass
 class MachineIDNotFound(Exception): pass
 class PictureUploadError(Exception): pass
+class UnsupportedCaptureEncoding(Exception): pass
@@ -0,0 +1,59 @@
+import numpy as np
+
+from math import pi, sqrt, log, ceil
+
+from .cfg import *
+from .ismags import shaper_impulses
+
+
+class ShapingPrediction():
+    def __init__(self, settle_time, residual, delay): self.settle_time = settle_time; self.residual = residual; self.delay = delay
+    def as_dict(self): return { "settle_time": self.settle_time, "residual": self.residual, "delay": self.delay }
+
+
+def mode_step_response(wc, zt, T, n):
+    '''Response of a mode at wc (rad/sec) with damping zt to a unit step command, sampled at T.'''
+    t = T*np.arange(n); df = sqrt(1. - zt*zt)
+    return 1. - np.exp(-zt*wc*t)*(np.cos(wc*df*t) + zt/df*np.sin(wc*df*t))
+
+
+def mode_prediction_grid(wc, zt, delay):
+    '''Sample time and length that resolve the mode at wc, zt and see its step
+    response settle after a shaper of duration `delay`.'''
+    T = 2.*pi/wc/PREDICT_SAMPLES_PER_PERIOD
+    ti = min(PREDICT_MAX_TI, delay + log(1./PREDICT_SETTLE_BAND)/(zt*wc) + PREDICT_MARGIN_TI)
+    return T, int(ceil(ti/T))
+
+
+def predict_shaping(candidates, step, T):
+    '''Time domain cost of each shaper (type, wc, zt, vtol) in `candidates` on a
+    system whose response to a step command is `step`, sampled at T from the
+    step. Modelled or measured, it should have settled by its end.
+
+    The shapers' impulse trains (interpolated onto the samples) are convolved with
+    the step response in one batched FFT. For each, settle_time is when the
+    shaped response is last outside PREDICT_SETTLE_BAND of its final value,
+    residual the peak vibration after the shaper ends relative to that of the
+    unshaped response over the same time, and delay the shaper's duration.
+    Returns a ShapingPrediction per candidate.'''
+    step = np.asarray(step, dtype=float); n = len(step)
+    imps = [shaper_impulses(type, wc, zt, vtol) for type, wc, zt, vtol in candidates]
+    pos = [np.minimum(imp.t/T, n - 2) for imp in imps]
+
+    # Each impulse is split between the samples either side of it, in proportion to its nearness.
+    trains = np.zeros((len(imps), n))
+    for train, imp, p in zip(trains, imps, pos):
+        i = np.floor(p).astype(int); frac = p - i
+        np.add.at(train, i, imp.a*(1. - frac)); np.add.at(train, i + 1, imp.a*frac)
+    N = 1 << (2*n - 2).bit_length() # Power of two at least 2n - 1, so the convolution doesn't wrap.
+    shaped = np.fft.irfft(np.fft.rfft(trains, N)*np.fft.rfft(step, N), N)[:, :n]
+
+    final = step[-1]
+    vib = np.abs(shaped - final); vib0 = np.abs(step - final)
+    after = np.arange(n) >= np.ceil([p[-1] for p in pos])[:, None]
+    residual = np.max(np.where(after, vib, 0.), axis=1)/np.maximum(np.max(np.where(after, vib0, 0.), axis=1), 1e-12)
+
+    outside = vib > PREDICT_SETTLE_BAND*abs(final)
+    settle_idx = np.where(np.any(outside, axis=1), n - np.argmax(outside[:, ::-1], axis=1), 0)
+
+    return [ShapingPrediction(float(settle_idx[c]*T), float(residual[c]), float(imps[c].duration)) for c in range(len(imps))]
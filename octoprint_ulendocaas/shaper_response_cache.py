@@ -0,0 +1,78 @@
+import threading
+
+from collections import OrderedDict
+from math import pi
+
+from .cfg import *
+from .ismags import get_ismag, shaper_impulses
+from .shaper_solver import NoResonanceFound, find_resonance
+from .shaper_predictor import mode_prediction_grid, mode_step_response, predict_shaping
+
+
+def quantize_wc(wc): return round(wc/2./pi, M493_FREQUENCY_DECIMALS)*2.*pi
+def quantize_zt(zt): return round(zt, M493_ZETA_DECIMALS)
+def quantize_vtol(vtol): return round(vtol, M493_VTOL_DECIMALS)
+
+
+class ShaperResponseCache():
+    '''Bounded LRU store of the calibration plot series and time domain predictions
+    of the shapers tried on a solution. Shapers are keyed by their parameters at
+    the resolution the printer takes them, so slider positions that load the same
+    shaper share an entry.'''
+    def __init__(self, size=SHAPER_RESPONSE_CACHE_SIZE):
+        self.size = size
+        self.hits = 0; self.misses = 0
+        self._entries = OrderedDict()
+        self._base_id = None; self._base = None # Series common to every shaper on the solution.
+        self._lock = threading.Lock()
+
+
+    def clear(self):
+        with self._lock: self._entries.clear(); self._base_id = None; self._base = None
+
+
+    def stats(self):
+        with self._lock: return dict(hits=self.hits, misses=self.misses, entries=len(self._entries))
+
+
+    def series(self, solution, type, vtol):
+        '''w_bp (Hz), G, the `type` shaper's magnitude and the shaped magnitude, as lists.'''
+        key = (type, quantize_wc(solution.wc), quantize_zt(solution.zt),
+               quantize_vtol(vtol) if type in ['ei', 'ei2h', 'ei3h'] else None, id(solution.w_bp))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None: self.hits += 1; self._entries.move_to_end(key); return entry
+            self.misses += 1
+            if self._base_id != id(solution.w_bp):
+                self._base_id = id(solution.w_bp); self._base = dict(w_bp=(solution.w_bp/2./pi).tolist(), G=solution.G.tolist())
+            base = self._base
+
+        ismag = get_ismag(solution.w_bp, type, *key[1:4])
+        entry = dict(base, compensator_mag=ismag.tolist(), new_mag=(solution.G*ismag).tolist())
+        with self._lock:
+            self._entries[key] = entry
+            if len(self._entries) > self.size: self._entries.popitem(last=False)
+        return entry
+
+
+    def predictions(self, solution, types, vtol):
+        '''Time domain predictions (as dicts, by type) of the shapers of `types` on
+        solution. The step response is that of the dominant resonance in the
+        measured response, else of the mode the solution gives.'''
+        wc = quantize_wc(solution.wc); zt = quantize_zt(solution.zt); vtol = quantize_vtol(vtol)
+        key = ('predictions', tuple(types), wc, zt, vtol, id(solution.w_bp))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None: self.hits += 1; self._entries.move_to_end(key); return entry
+            self.misses += 1
+
+        try: w_mode, zt_mode = find_resonance(solution.w_bp, solution.G)
+        except NoResonanceFound: w_mode, zt_mode = wc, zt
+        delay = max(shaper_impulses(type, wc, zt, vtol).duration for type in types)
+        T, n = mode_prediction_grid(w_mode, zt_mode, delay)
+        predictions = predict_shaping([(type, wc, zt, vtol) for type in types], mode_step_response(w_mode, zt_mode, T, n), T)
+        entry = {type: p.as_dict() for type, p in zip(types, predictions)}
+        with self._lock:
+            self._entries[key] = entry
+            if len(self._entries) > self.size: self._entries.popitem(last=False)
+        return entry
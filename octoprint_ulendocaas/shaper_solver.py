@@ -0,0 +1,131 @@
+import itertools
+import numpy as np
+
+from math import sqrt, pi, log
+
+from .cfg import *
+from .ismags import shaper_impulses, impulse_mags
+
+
+class InpShprSolution():
+    '''A mode (wc, zt) solved from the transfer magnitude G over w_bp. The
+    optimizer's recommended ShaperCandidate, if any, is kept alongside; while its
+    design is applied, `replaced` holds the (wc, zt, vtol) it replaced.'''
+    def __init__(self, wc, zt, w_bp, G):
+        self.wc = wc; self.zt = zt; self.w_bp = w_bp; self.G = G
+        self.recommendation = None; self.replaced = None
+
+
+class NoResonanceFound(Exception): pass
+
+
+def _crossing(w, G, j, level):
+    '''Where G, between samples j and j+1, crosses `level` (linearly interpolated).'''
+    return w[j] + (level - G[j])*(w[j+1] - w[j])/(G[j+1] - G[j])
+
+
+def find_resonance(w_bp, G):
+    '''Dominant resonance of the transfer magnitude G over frequencies w_bp (rad/sec).
+
+    The largest value of G is refined to the vertex of the parabola through it
+    and its neighbours, and its damping ratio is taken from the half-power
+    bandwidth: zt = (w2 - w1)/(2*wc), with w1 and w2 where G falls to
+    1/sqrt(2) of the peak either side. If only one side falls that far within
+    w_bp, the bandwidth is twice that side's. Returns (wc, zt).'''
+    w = np.asarray(w_bp, dtype=float); G = np.asarray(G, dtype=float)
+    i = int(np.argmax(G))
+    if i == 0 or i == len(G) - 1: raise NoResonanceFound('Largest response is at the edge of the band.')
+
+    a, b, c = G[i-1], G[i], G[i+1]
+    d = 0.5*(a - c)/(a - 2.*b + c) if a - 2.*b + c != 0. else 0.
+    wc = w[i] + d*(w[i+1] - w[i-1])/2.
+    half = (b - 0.25*(a - c)*d)/sqrt(2.)
+
+    below = np.flatnonzero(G[:i] < half)
+    above = np.flatnonzero(G[i+1:] < half)
+    w1 = _crossing(w, G, below[-1], half) if len(below) else None
+    w2 = _crossing(w, G, i + above[0], half) if len(above) else None
+    if w1 is None and w2 is None: raise NoResonanceFound('No half-power point within the band.')
+
+    if w1 is None: bw = 2.*(w2 - wc)
+    elif w2 is None: bw = 2.*(wc - w1)
+    else: bw = w2 - w1
+    return wc, min(0.9999, max(0.0001, bw/(2.*wc)))
+
+
+def solve_shaper(w_bp, G):
+    '''Local solution for the dominant resonance of a measured transfer magnitude.'''
+    wc, zt = find_resonance(w_bp, G)
+    return InpShprSolution(wc, zt, w_bp, G)
+
+
+class ShaperCandidate():
+    def __init__(self, type, wc, zt, vtol, residual, delay):
+        self.type = type; self.wc = wc; self.zt = zt; self.vtol = vtol
+        self.residual = residual; self.delay = delay; self.pareto = False
+    def as_dict(self): return { "type": self.type, "f": self.wc/2./pi, "zt": self.zt, "vtol": self.vtol,
+                                "residual": self.residual, "delay": self.delay, "pareto": self.pareto }
+
+
+def _residuals(type, w, E, zt, wc, lzt, vtol):
+    '''Residual and duration of the `type` shaper for each broadcast design
+    (wc, ln zt, vtol). The residual is the peak of the vibration E, shaped by the
+    residual vibration left in modes of damping zt, relative to its unshaped peak.'''
+    imp = shaper_impulses(type, wc, np.exp(lzt), vtol if type.startswith('ei') else None)
+    residual = np.max(impulse_mags(imp, w, zt)*E, axis=-1)/np.max(E)
+    return residual, np.broadcast_to(imp.duration, residual.shape)
+
+
+def _optimize_type(type, w, E, wc, zt):
+    '''Least-residual `type` shaper: a grid search over (wc, zt, vtol) and a
+    pattern search, halving its steps, from the best few grid points.'''
+    lo = np.array([wc*(1. - OPT_WC_SPAN), log(OPT_ZT_MIN), OPT_VTOL_MIN])
+    hi = np.array([wc*(1. + OPT_WC_SPAN), log(OPT_ZT_MAX), OPT_VTOL_MAX])
+    steps = np.array([OPT_WC_STEPS, OPT_ZT_STEPS, OPT_VTOL_STEPS if type.startswith('ei') else 1])
+
+    # Kept on separate axes, the grid needs one exponential per (wc, zt) rather than per design.
+    wcs, lzts, vtols = [np.linspace(lo[i], hi[i], steps[i]) for i in range(3)]
+    residual, _ = _residuals(type, w, E, zt, wcs[:, None, None], lzts[None, :, None], vtols[None, None, :])
+    best = np.unravel_index(np.argsort(residual, axis=None)[:OPT_REFINE_CANDIDATES], residual.shape)
+    P = np.stack([wcs[best[0]], lzts[best[1]], vtols[best[2]]], axis=-1)
+
+    h = np.where(steps > 1, (hi - lo)/np.maximum(steps - 1, 1), 0.)
+    offsets = np.array(list(itertools.product(*[(-1., 0., 1.) if h_ > 0. else (0.,) for h_ in h])))
+    for _ in range(OPT_REFINE_ITERATIONS):
+        h = h/2.
+        Q = np.clip(P[:, None, :] + offsets*h, lo, hi)
+        residual, _ = _residuals(type, w, E, zt, *np.moveaxis(Q, -1, 0))
+        P = Q[np.arange(len(Q)), np.argmin(residual, axis=1)]
+
+    residual, delay = _residuals(type, w, E, zt, *P.T)
+    i = int(np.argmin(residual))
+    return ShaperCandidate(type, float(P[i, 0]), float(np.exp(P[i, 1])), float(P[i, 2]) if type.startswith('ei') else None,
+                           float(residual[i]), float(delay[i]))
+
+
+def optimize_shaper(w_bp, G, wc, zt, types):
+    '''Best shaper of each of `types` for the transfer magnitude G over w_bp (rad/sec)
+    of an axis whose modes have damping about zt, searched within OPT_WC_SPAN of wc.
+
+    Candidates are scored by residual (the peak of the vibration left after
+    shaping relative to the unshaped peak, where vibration is G in excess of
+    OPT_RIGID_GAIN, and the peak is also taken with G shifted by
+    +/-OPT_FREQ_SHIFT in frequency) and by delay (the shaper's duration, sec).
+    Returns the recommended candidate, the shortest with a residual within
+    OPT_RESIDUAL_TARGET (else the least residual one), and the table of
+    candidates by delay with the Pareto optimal ones flagged.'''
+    w_bp = np.asarray(w_bp, dtype=float); G = np.asarray(G, dtype=float)
+    w = np.linspace(w_bp[0], w_bp[-1], OPT_NUM_FREQS)
+    # The shaper's response is non-negative, so the peak of it times each shifted
+    # response is its peak times their upper envelope.
+    G = np.max([np.interp(w/(1. + s), w_bp, G) for s in (-OPT_FREQ_SHIFT, 0., OPT_FREQ_SHIFT)], axis=0)
+    E = G - OPT_RIGID_GAIN
+    if np.max(E) <= 0.: raise NoResonanceFound('No response above that of a rigid axis.')
+    E = np.maximum(E, 0.)
+
+    table = [_optimize_type(type, w, E, wc, zt) for type in types]
+    for c in table:
+        c.pareto = not any(o.residual <= c.residual and o.delay <= c.delay and (o.residual < c.residual or o.delay < c.delay) for o in table)
+    on_target = [c for c in table if c.residual <= OPT_RESIDUAL_TARGET]
+    recommended = min(on_target, key=lambda c: c.delay) if on_target else min(table, key=lambda c: c.residual)
+    return recommended, sorted(table, key=lambda c: c.delay)
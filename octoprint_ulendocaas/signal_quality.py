@@ -0,0 +1,42 @@
+import numpy as np
+
+from math import pi
+
+
+CLIPPING_FULL_SCALE_FRACTION = 0.98 # Readings at least this fraction of full scale count as clipped.
+
+
+class SignalQualityReport():
+    def __init__(self, meas, expctd, snr_db, clipped_fraction):
+        self.meas = meas; self.expctd = expctd; self.snr_db = snr_db; self.clipped_fraction = clipped_fraction
+
+    @property
+    def amplitude_ratio(self): return self.meas/self.expctd
+
+    def as_dict(self): return { "meas": self.meas, "expctd": self.expctd, "amplitude_ratio": self.amplitude_ratio,
+                                "snr_db": self.snr_db, "clipped_fraction": self.clipped_fraction }
+
+    def __str__(self):
+        return f'amplitude {self.meas:.1f}/{self.expctd:.1f} = {self.amplitude_ratio:.2f}, ' \
+               f'SNR = {self.snr_db:.1f} dB, clipped = {100.*self.clipped_fraction:.2f}%'
+
+
+def assess_signal_quality(sweep, quiet, T, f0, dfdt, a, check_n, full_scale, offset=0.):
+    '''Quality of a captured sweep.
+
+    `sweep` is the trimmed, zero-mean sweep data and `quiet` a zero-mean window
+    of the dwell before it; `offset` is the mean that was removed from both.
+    The amplitude ratio compares the first `check_n` sweep samples to the
+    commanded acceleration, SNR compares the sweep's RMS to the dwell's, and
+    the clipped fraction counts sweep samples near `full_scale`.'''
+    check_n = min(check_n, len(sweep))
+    tau = np.arange(check_n)*T
+    expctd = np.sum(np.abs(a*np.sin(pi*dfdt*tau*tau + 2.*pi*f0*tau)))
+    meas = np.sum(np.abs(sweep[:check_n]))
+
+    with np.errstate(divide='ignore'):
+        snr_db = 10.*np.log10(np.mean(sweep*sweep)/np.mean(quiet*quiet)) if len(quiet) > 0 else np.inf
+
+    clipped_fraction = np.count_nonzero(np.abs(sweep + offset) >= CLIPPING_FULL_SCALE_FRACTION*full_scale)/len(sweep) if len(sweep) > 0 else 0.
+
+    return SignalQualityReport(float(meas), float(expctd), float(snr_db), float(clipped_fraction))
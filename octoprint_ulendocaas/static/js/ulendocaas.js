@@ -131,14 +131,37 @@ $(function () {
                 Plotly.newPlot('calibration_results_graph', [series1, series2, series3], layout, config);
             
                 if (data.reset_sliders) {
-                    document.getElementById("damping_slider").value = 100;
+                    document.getElementById("damping_slider").value = Math.round(data.zt*1000);
                     document.getElementById("damping_slider_value").innerText = document.getElementById("damping_slider").value/10;
-                    document.getElementById("vtol_slider").value = 5;
+                    document.getElementById("vtol_slider").value = Math.round(data.vtol*100);
                     document.getElementById("vtol_slider_value").innerText = document.getElementById("vtol_slider").value;
                 }
             
             }
 
+            if (data.type == "shaper_table") {
+                let rows = '<tr><th>Shaper</th><th>Frequency [Hz]</th><th>Damping [%]</th><th>Vib. Tol. [%]</th><th>Residual [%]</th><th>Delay [ms]</th></tr>';
+                for (const c of data.candidates) {
+                    rows += (c.type == data.recommended ? '<tr class="success">' : '<tr>')
+                        + '<td>' + c.type.toUpperCase() + (c.pareto ? ' *' : '') + '</td>'
+                        + '<td>' + c.f.toFixed(1) + '</td>'
+                        + '<td>' + (c.zt*100).toFixed(1) + '</td>'
+                        + '<td>' + (c.vtol === null ? '-' : (c.vtol*100).toFixed(0)) + '</td>'
+                        + '<td>' + (c.residual*100).toFixed(1) + '</td>'
+                        + '<td>' + (c.delay*1000).toFixed(1) + '</td></tr>';
+                }
+                shaper_table.innerHTML = data.candidates.length > 0 ? rows : '';
+                shaper_table_container.style.display = data.candidates.length > 0 ? 'block' : 'none';
+            }
+
+            if (data.type == "shaper_predictions") {
+                for (const [key, p] of Object.entries(data.predictions)) {
+                    let prediction = document.getElementById('select_' + key + '_cal_prediction');
+                    prediction.innerText = '+' + (p.delay*1000).toFixed(0) + ' ms, ' + (p.residual*100).toFixed(0) + '%, ' + (p.settle_time*1000).toFixed(0) + ' ms';
+                    prediction.title = 'Delay added to moves, residual vibration, and time for a step to settle within 2%.';
+                }
+            }
+
             if (data.type == "verification_result") {
                 let series1 = { x: data.w_bp, y: data.oldG, mode: "lines", name: 'Uncmpnstd Rspns' };
                 let series2 = { x: data.w_bp, y: data.compensator_mag, mode: "lines", name: 'Cmpnstr Rspns' };
@@ -154,6 +177,9 @@ $(function () {
 
 
             if (data.type == "clear_calibration_result") {
+                for (const prediction of document.querySelectorAll('.is_prediction')) { prediction.innerText = ''; }
+                shaper_table.innerHTML = '';
+                shaper_table_container.style.display = 'none';
                 if (typeof calibration_results_graph.data != "undefined") {
                     while (calibration_results_graph.data.length > 0) { Plotly.deleteTraces('calibration_results_graph', [0]); }
                 }
@@ -444,6 +470,28 @@ $(function () {
                 return;
             }
 
+            if (data.type == "analysis_progress") {
+                if (data.fraction >= 1) {
+                    if (typeof analysis_progress_popup !== 'undefined') {
+                        analysis_progress_popup.remove();
+                        analysis_progress_popup = undefined;
+                    }
+                    return;
+                }
+                let text = data.stage + '... (' + Math.round(100*data.fraction) + '%)';
+                if (typeof analysis_progress_popup === 'undefined') {
+                    analysis_progress_popup = new PNotify({
+                        title: gettext("Analyzing Data"),
+                        text: text,
+                        type: 'info',
+                        hide: false
+                    });
+                } else {
+                    analysis_progress_popup.update({ text: text });
+                }
+                return;
+            }
+
             if (data.type == "close_popups") {
                 PNotify.removeAll();
                 return;
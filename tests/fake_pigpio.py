@@ -0,0 +1,102 @@
+import collections
+import threading
+import time
+
+import numpy as np
+
+
+FIFO_SIZE = 32
+
+
+class FakeCallback():
+    def __init__(self, pi, gpio, func): self.pi = pi; self.gpio = gpio; self.func = func
+    def cancel(self):
+        if self in self.pi.callbacks: self.pi.callbacks.remove(self)
+
+
+class FakePi():
+    '''Stands in for a pigpio.pi connection to an ADXL345 on SPI.
+
+    The device's FIFO holds up to FIFO_SIZE (x, y, z) int16 samples, the oldest
+    dropped when it's full as in stream mode. Samples are added by `push` and
+    INT1 edges raised by `edge`, or, given a `rate` (Hz), by a producer thread
+    from when measurement mode is entered, which raises an edge each time the
+    FIFO level reaches the watermark. Each transfer takes `xfer_time` sec.'''
+    connected = True
+
+    def __init__(self, rate=None, xfer_time=0., seed=0):
+        self.rate = rate; self.xfer_time = xfer_time
+        self.rng = np.random.default_rng(seed)
+        self.fifo = collections.deque()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.registers = {}
+        self.xfers = collections.Counter() # By register address.
+        self.pushed = 0; self.popped = 0; self.dropped = 0
+        self.read = [] # Every sample read out of the FIFO, in order.
+        self._producer = None; self._running = False
+
+
+    @property
+    def watermark(self):
+        '''FIFO level that raises INT1, or None if the watermark interrupt isn't enabled.'''
+        if not self.registers.get(0x2E, 0) & 0b00000010: return None
+        return self.registers.get(0x38, 0) & 0b00011111
+
+
+    def push(self, samples):
+        '''Adds (m, 3) int16 samples to the FIFO. Returns whether the level reached the watermark.'''
+        with self.lock:
+            level = len(self.fifo)
+            for s in np.asarray(samples, dtype='<i2').reshape(-1, 3):
+                if len(self.fifo) == FIFO_SIZE: self.fifo.popleft(); self.dropped += 1
+                self.fifo.append(s.copy()); self.pushed += 1
+            wm = self.watermark
+            return wm is not None and level < wm <= len(self.fifo)
+
+
+    def edge(self):
+        '''Raises INT1, calling each callback registered for it.'''
+        for cb in list(self.callbacks): cb.func(cb.gpio, 1, 0)
+
+
+    def _produce(self):
+        t0 = time.perf_counter(); n = 0
+        while self._running:
+            due = int((time.perf_counter() - t0)*self.rate)
+            if due > n:
+                if self.push(self.rng.integers(-512, 512, size=(due - n, 3))): self.edge()
+                n = due
+            time.sleep(0.25/self.rate)
+
+
+    def set_mode(self, gpio, mode): pass
+    def set_pull_up_down(self, gpio, pud): pass
+    def callback(self, gpio, edge, func): cb = FakeCallback(self, gpio, func); self.callbacks.append(cb); return cb
+    def spi_open(self, spi_channel, baud, spi_flags): return 0
+    def spi_close(self, handle): pass
+
+
+    def spi_write(self, handle, data):
+        self.registers[data[0]] = data[1]
+        if data[0] == 0x2D and self.rate is not None:
+            if data[1] & 0b00001000 and not self._running:
+                self._running = True
+                self._producer = threading.Thread(target=self._produce, daemon=True); self._producer.start()
+            elif not data[1] & 0b00001000 and self._running:
+                self._running = False; self._producer.join()
+
+
+    def spi_xfer(self, handle, data):
+        if self.xfer_time > 0.:
+            end = time.perf_counter() + self.xfer_time
+            while time.perf_counter() < end: pass
+        addr = data[0] & 0x3F
+        self.xfers[addr] += 1
+        with self.lock:
+            if addr == 0x39: return (2, bytearray([0, len(self.fifo)])) # FIFO_STATUS
+            if addr == 0x32: # DATAX0..DATAZ1, popping the entry.
+                if self.fifo: s = self.fifo.popleft(); self.popped += 1; self.read.append(s)
+                else: s = np.zeros(3, dtype='<i2')
+                return (7, bytearray([0]) + bytearray(s.tobytes()))
+            return (len(data), bytearray(len(data)))
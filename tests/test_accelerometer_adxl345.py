@@ -0,0 +1,103 @@
+import time
+
+import numpy as np
+import pytest
+
+from fake_pigpio import FakePi
+
+from octoprint_ulendocaas.accelerometers.accelerometer_abc import AcclrmtrCfg, AcclrmtrRangeCfg, AcclrmtrRateCfg, AcclrmtrStatus
+from octoprint_ulendocaas.accelerometers.accelerometer_adxl345 import Adxl345, FIFO_WATERMARK
+
+
+INT_GPIO = 4
+
+
+def make_adxl345(pi, rate='200Hz', int_gpio=INT_GPIO):
+    return Adxl345(AcclrmtrCfg(AcclrmtrRangeCfg['+/-2g'], AcclrmtrRateCfg[rate], int_gpio=int_gpio), rpi=pi)
+
+
+def wait_until(condition, timeout=2.):
+    end = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > end: return False
+        time.sleep(0.001)
+    return True
+
+
+def samples(pi, n): return pi.rng.integers(-512, 512, size=(n, 3)).astype('<i2')
+
+
+def test_fifo_drained_only_after_edge():
+    pi = FakePi(); adxl = make_adxl345(pi)
+    adxl.T = 1. # As slow as this, the edge wait's timeout (1.5*FIFO_WATERMARK sec) can't expire during the test.
+    adxl.start(expected_duration=1.)
+    assert adxl.acquisition_stats()['watermark'] and len(pi.callbacks) == 1
+    assert pi.watermark == FIFO_WATERMARK
+
+    block1 = samples(pi, FIFO_WATERMARK); pi.push(block1)
+    time.sleep(0.1)
+    assert len(adxl.samples) == 0 and pi.xfers[0x32] == 0 and pi.xfers[0x39] == 1 # Only start's FIFO_STATUS read.
+
+    pi.edge()
+    assert wait_until(lambda: len(adxl.samples) == FIFO_WATERMARK)
+
+    block2 = samples(pi, FIFO_WATERMARK); pi.push(block2)
+    time.sleep(0.1)
+    assert len(adxl.samples) == FIFO_WATERMARK
+    pi.edge()
+    assert wait_until(lambda: len(adxl.samples) == 2*FIFO_WATERMARK)
+
+    adxl.stop()
+    assert adxl.status == AcclrmtrStatus.STOPPED
+    expected = np.concatenate((block1, block2))*adxl.lsb
+    np.testing.assert_array_equal(adxl.x_buff, expected[:, 0].astype(np.float32))
+    np.testing.assert_array_equal(adxl.z_buff, expected[:, 2].astype(np.float32))
+    assert pi.callbacks == [] and pi.registers[0x2E] == 0 # Callback cancelled and the interrupt disabled.
+
+
+def test_edge_timeout_falls_back_to_poll():
+    pi = FakePi(); adxl = make_adxl345(pi, rate='3200Hz')
+    timeout = 1.5*FIFO_WATERMARK*adxl.T
+    adxl.start(expected_duration=1.)
+    block = samples(pi, 10); pi.push(block) # Below the watermark, so no edge ever comes.
+    assert wait_until(lambda: len(adxl.samples) == 10)
+    adxl.stop()
+
+    np.testing.assert_array_equal(adxl.y_buff, (block[:, 1]*adxl.lsb).astype(np.float32))
+    # Every wake-up was a timeout, recorded as that late.
+    assert len(adxl.poll_lateness) > 0 and np.all(adxl.poll_lateness == timeout)
+
+
+def test_edge_timeouts_detect_dead_device():
+    pi = FakePi(); adxl = make_adxl345(pi, rate='3200Hz')
+    adxl.start(expected_duration=1.)
+    assert wait_until(lambda: adxl.status != AcclrmtrStatus.COLLECTING)
+    assert adxl.status == AcclrmtrStatus.CONNECTION_FAILED
+    adxl.stop()
+
+
+def test_stop_releases_thread_waiting_for_edge():
+    pi = FakePi(); adxl = make_adxl345(pi)
+    adxl.T = 1.
+    adxl.start(expected_duration=1.)
+    time.sleep(0.05)
+    assert adxl._acq_thread.is_alive()
+
+    t = time.perf_counter(); adxl.stop()
+    assert time.perf_counter() - t < 0.5
+    assert not adxl._acq_thread.is_alive()
+    assert adxl.status == AcclrmtrStatus.STOPPED and pi.registers[0x2D] == 0
+
+
+@pytest.mark.parametrize('bulk_read', [True, False])
+def test_polls_without_interrupt_gpio(bulk_read):
+    pi = FakePi(); adxl = make_adxl345(pi, int_gpio=None)
+    adxl.bulk_read = bulk_read
+    adxl.start(expected_duration=1.)
+    assert pi.callbacks == [] and not adxl.acquisition_stats()['watermark'] and pi.watermark is None
+    block = samples(pi, 20); pi.push(block)
+    assert wait_until(lambda: len(adxl.samples) == 20)
+    adxl.stop()
+    np.testing.assert_array_equal(adxl.x_buff, (block[:, 0]*adxl.lsb).astype(np.float32))
+    np.testing.assert_array_equal(adxl.z_buff, (block[:, 2]*adxl.lsb).astype(np.float32))
+    assert adxl.acquisition_stats()['bulk_read'] == bulk_read
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from octoprint_ulendocaas.accelerometers.accelerometer_sim import ChirpConfig, TrajGenConfig, make_profile, make_profile_reference
+
+
+# (f0, f1, dfdt, a, step_ti, step_a, dly1_ti, dly2_ti, dly3_ti), T
+PROFILES = [
+    ((5., 90., 4., 4000., 0.05, 4000., 0.5, 1., 1.), 1/3200.),
+    ((5., 90., 8., 4000., 0.05, 4000., 0.5, 1., 1.), 1/1600.),
+    ((3., 60., 2., 2000., 0.03, 8000., 0.25, 0.7, 0.3), 1/800.),
+    ((10., 40., 5., 1000., 0.1, 2000., 1.3, 0.45, 0.65), 1/400.),
+    # T and every duration are binary fractions, so segment (and step phase)
+    # edges fall exactly on sample instants.
+    ((6., 37., 4., 3000., 0.0625, 4000., 0.25, 0.5, 0.5), 1/256.),
+    ((6., 37., 4., 3000., 0.125, 4000., 0.5, 0.25, 0.75), 1/512.),
+]
+
+
+@pytest.mark.parametrize('sim', [False, True])
+@pytest.mark.parametrize('params, T', PROFILES)
+def test_matches_reference(params, T, sim):
+    prfl_cfg = ChirpConfig(*params)
+    s = make_profile(prfl_cfg, T, sim=sim)
+    s_ref = make_profile_reference(prfl_cfg, T, sim=sim)
+    assert s.shape == s_ref.shape
+
+    # Each sample is in the same segment and step phase; values differ only by
+    # NumPy's sin and squaring against libm's sin and pow.
+    np.testing.assert_array_equal(s == 0., s_ref == 0.)
+    np.testing.assert_array_max_ulp(s, s_ref, maxulp=8)
+
+
+@pytest.mark.parametrize('params, T', PROFILES[-2:])
+def test_edges_on_sample_instants(params, T):
+    prfl_cfg = ChirpConfig(*params)
+    traj_gen_cfg = TrajGenConfig(prfl_cfg)
+    n = round(traj_gen_cfg.pcws_ti[-1]/T + 0.5)
+    tau = np.arange(n)*T
+    # The profile's edges and the steps' phase changes all land on samples, which
+    # belong to the segment (or phase) before them.
+    for ti in traj_gen_cfg.pcws_ti[:-1]: assert ti in tau
+    for start in (traj_gen_cfg.pcws_ti[0], traj_gen_cfg.pcws_ti[4]):
+        for ti in (prfl_cfg.step_ti, traj_gen_cfg.step_ti_x_3): assert start + ti in tau
+
+    s = make_profile(prfl_cfg, T); s_ref = make_profile_reference(prfl_cfg, T)
+    edges = np.flatnonzero(np.isin(tau, traj_gen_cfg.pcws_ti))
+    np.testing.assert_array_equal(s[edges], s_ref[edges])
+    np.testing.assert_array_equal(s[edges + 1], s_ref[edges + 1])
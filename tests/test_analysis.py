@@ -0,0 +1,206 @@
+import numpy as np
+import pytest
+
+from math import ceil, floor, pi
+
+from octoprint_ulendocaas.accelerometers.accelerometer_sim import ChirpConfig, make_acceleration_profile
+from octoprint_ulendocaas.analysis import argmin_window_abs_sum, ransac_line_fit, smooth_magnitude, stft_peak_frequencies, window_abs_sums
+from octoprint_ulendocaas.cfg import I2F_CANDIDATE_ERROR_THD, I2F_CONSENSUS_THD, I2F_MAX_ITERATIONS, I2F_RANDOM_IDCS
+
+
+def dly1_idx_loop(data, o, n, m):
+    '''The dly1 search as it was: the sum of every window, summed one by one.'''
+    minima_ = np.zeros((n,))
+    for i in range(n): minima_[i] = np.sum(np.abs(data[o+i:o+i+m]))
+    return o + np.max(np.argmin(minima_))
+
+
+def dly2_idx_loop(data, n, m):
+    '''The dly2 search as it was.'''
+    minima_ = np.zeros((n,))
+    for i in range(n): minima_[i] = np.sum(np.abs(data[-n-m+i:-n+i]))
+    return len(data) - n - m + np.min(np.argmin(minima_))
+
+
+def dly1_idx(data, o, n, m): return o + argmin_window_abs_sum(data[o:o+n+m-1], m)
+def dly2_idx(data, n, m): return len(data) - n - m + argmin_window_abs_sum(data[len(data)-n-m:len(data)-1], m)
+
+
+def check_both_searches(data, o, n, m):
+    assert dly1_idx(data, o, n, m) == dly1_idx_loop(data, o, n, m)
+    assert dly2_idx(data, n, m) == dly2_idx_loop(data, n, m)
+
+
+def test_window_abs_sums_match_direct_sums():
+    x = np.random.default_rng(0).standard_normal(500)
+    for m in (1, 7, 100, 500):
+        direct = [np.sum(np.abs(x[i:i+m])) for i in range(len(x) - m + 1)]
+        np.testing.assert_allclose(window_abs_sums(x, m), direct, rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_loop_on_random_data(seed):
+    rng = np.random.default_rng(seed)
+    n, m = rng.integers(1, 300, size=2); o = rng.integers(0, 50)
+    data = rng.standard_normal(o + 2*(n + m) + 10)*rng.uniform(0.1, 1000.) + rng.uniform(-100., 100.)
+    data -= np.sum(data)/len(data)
+    check_both_searches(data, o, n, m)
+
+
+def test_tie_at_first_and_last_window():
+    # The first and last windows are both exactly quiet; the first wins.
+    n, m = 40, 10
+    data = np.random.default_rng(1).uniform(1., 2., size=2*(n + m - 1))
+    data[:m] = 0.; data[n-1:n-1+m] = 0.
+    data[-n-m:-n-m+m] = 0.; data[-m-1:-1] = 0.
+    assert dly1_idx(data, 0, n, m) == 0
+    assert dly2_idx(data, n, m) == len(data) - n - m
+    check_both_searches(data, 0, n, m)
+
+
+def test_minimum_at_last_window():
+    n, m = 40, 10
+    data = np.random.default_rng(2).uniform(1., 2., size=2*(n + m - 1))
+    data[n-1:n-1+m] = 0.; data[-m-1:-1] = 0.
+    assert dly1_idx(data, 0, n, m) == n - 1
+    assert dly2_idx(data, n, m) == len(data) - m - 1
+    check_both_searches(data, 0, n, m)
+
+
+def test_ties_over_a_quiet_stretch():
+    # Every window within the zeros ties at exactly 0.
+    n, m = 60, 8
+    data = np.random.default_rng(3).standard_normal(3*(n + m))
+    data[20:50] = 0.; data[-n-m+15:-n-m+40] = 0.
+    check_both_searches(data, 0, n, m)
+    assert dly1_idx(data, 0, n, m) == 20
+
+
+def test_ties_only_rounding_can_separate():
+    # With a period dividing m, every window sums the same values, so any order is
+    # down to rounding, which the direct re-sum breaks exactly as the loop did.
+    block = np.random.default_rng(4).standard_normal(7)*1e3
+    data = np.tile(block, 60)
+    for o, n, m in ((0, 100, 35), (3, 150, 70), (5, 200, 7)):
+        check_both_searches(data, o, n, m)
+
+
+def test_too_short_data():
+    x = np.ones(5)
+    assert argmin_window_abs_sum(x, 5) == 0
+    assert argmin_window_abs_sum(x, 0) == 0
+    with pytest.raises(ValueError): argmin_window_abs_sum(x, 6)
+    with pytest.raises(ValueError): argmin_window_abs_sum(np.zeros(0), 1)
+
+
+def smooth_magnitude_loop(f, mag, half_width):
+    '''The plot smoothing as it was: one dot product per bin.'''
+    kbp1s = np.arange(start=0, stop=half_width, step=((max(f) - min(f)) / (len(f) - 1)))
+    n = len(kbp1s)
+    k_bp = np.concatenate((np.flip(kbp1s)[:-1], kbp1s))
+    w = k_bp/(sum(k_bp))
+    mag_fild = []
+    for i in range(n-1, len(f) - n): mag_fild.append(np.dot(w, mag[i-n+1 : i+n]))
+    return f[n-1:-n], np.array(mag_fild)
+
+
+@pytest.mark.parametrize('capture_ti', [5., 25., 100., 800.]) # Kernels of 3 to about 2400 taps.
+@pytest.mark.parametrize('half_width', [0.4, 1.5])
+def test_smooth_magnitude_matches_loop(capture_ti, half_width):
+    f = np.arange(round(5.*capture_ti), round(80.*capture_ti))/capture_ti
+    mag = np.abs(np.random.default_rng(round(capture_ti)).standard_normal(len(f)))*1e3
+    f_bp, mag_fild = smooth_magnitude(f, mag, half_width)
+    f_loop, mag_fild_loop = smooth_magnitude_loop(f, mag, half_width)
+    np.testing.assert_array_equal(f_bp, f_loop)
+    np.testing.assert_allclose(mag_fild, mag_fild_loop, rtol=1e-12)
+
+
+def stft_peak_frequencies_loop(data, T, wN, sN, f0, f1):
+    '''The frequency map's STFT as it was: one full FFT per window.'''
+    H = 0.5*(1. - np.cos(2.*pi*np.arange(wN)/wN))
+    ns = []; fs = []
+    for i in range(floor((len(data) - wN)/sN) + 1):
+        sidx = sN*i; eidx = sidx + wN
+        Y_ = np.fft.fft(H*data[sidx:eidx])
+        NT = len(Y_)*T; f_ = np.arange(len(Y_))/NT
+        minf_idx = ceil(f0*NT); maxf_idx = floor(f1*NT)
+        f_ = f_[minf_idx:maxf_idx]; Y_ = Y_[minf_idx:maxf_idx]
+        fs.append(f_[np.min(np.argmax(np.abs(Y_)))]); ns.append(round(sidx + eidx)/2)
+    return np.array(ns, dtype=float), np.array(fs)
+
+
+@pytest.mark.parametrize('rate', [400, 800, 1600, 3200])
+def test_stft_peaks_within_one_bin(rate):
+    T = 1./rate; f0, f1, dfdt = 5., 90., 4.
+    data = make_acceleration_profile(ChirpConfig(f0, f1, dfdt, 4000., 0.05, 4000., 0.5, 1., 1.), T, sim=True)
+    data = data + np.random.default_rng(rate).normal(scale=200., size=len(data))
+    wN, sN = round(dfdt/4./T), round(dfdt/4.*(1. - 0.66)/T)
+
+    ns, fs = stft_peak_frequencies(data, T, wN, sN, f0, f1)
+    ns_loop, fs_loop = stft_peak_frequencies_loop(data, T, wN, sN, f0, f1)
+    np.testing.assert_array_equal(ns, ns_loop)
+    assert np.max(np.abs(fs - fs_loop))*wN*T <= 1. + 1e-9
+
+
+class FixedRandom():
+    '''Stands in for a Generator, giving ransac_line_fit set draws to order its subsets by.'''
+    def __init__(self, R): self.R = R
+    def random(self, shape): assert shape == self.R.shape; return self.R
+
+
+def ransac_line_fit_loop(x, y, w, R, n_sample, error_thd, consensus_thd):
+    '''The frequency map's fit as it was, one candidate at a time, with candidate i
+    sampling the points in the order of argsort(R[i]).'''
+    e = np.inf; best = (None, np.array([], dtype=int), np.inf)
+    for it in range(len(R)):
+        idcs1 = np.argsort(R[it]); hi = idcs1[:n_sample]
+        X = np.block([np.ones((n_sample, 1)), x[hi].reshape(-1, 1)]); W = np.diag(w[hi])
+        bm_ = np.linalg.inv(X.T @ W @ X) @ X.T @ W @ y[hi]
+        e_ = (y[idcs1] - np.block([np.ones((len(idcs1), 1)), x[idcs1].reshape(-1, 1)]) @ bm_)**2
+        idcs2 = idcs1[n_sample:][np.where(e_[n_sample:] < error_thd)]
+        if len(idcs2) > consensus_thd:
+            idcs = np.block([hi, idcs2])
+            X_ = np.block([np.ones((len(idcs), 1)), x[idcs].reshape(-1, 1)]); W = np.diag(w[idcs])
+            bm__ = np.linalg.inv(X_.T @ W @ X_) @ X_.T @ W @ y[idcs]
+            e__ = np.sum((y[idcs] - np.block([np.ones((len(idcs), 1)), x[idcs].reshape(-1, 1)]) @ bm__)**2)/len(idcs)
+            if e__ < e: e = e__; best = (bm__, np.sort(idcs), e__)
+    return best
+
+
+def frequency_map_points(n, seed):
+    '''Normalized (index, frequency) points on a line, a fifth of them outliers, with weights.'''
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0., 1., n); y = 0.1 + 0.85*x + rng.normal(scale=0.02, size=n)
+    outliers = rng.random(n) < 0.2; y[outliers] = rng.random(outliers.sum())
+    return x, y, rng.random(n)**3
+
+
+@pytest.mark.parametrize('n', [30, 62, 120, 240])
+def test_ransac_matches_loop(n):
+    x, y, w = frequency_map_points(n, n)
+    R = np.random.default_rng(n + 1).random((I2F_MAX_ITERATIONS, n))
+    bm, inliers, e = ransac_line_fit(x, y, w, I2F_RANDOM_IDCS, I2F_CANDIDATE_ERROR_THD, I2F_CONSENSUS_THD, I2F_MAX_ITERATIONS, rng=FixedRandom(R))
+    bm_loop, inliers_loop, e_loop = ransac_line_fit_loop(x, y, w, R, I2F_RANDOM_IDCS, I2F_CANDIDATE_ERROR_THD, I2F_CONSENSUS_THD)
+    assert bm is not None
+    np.testing.assert_allclose(bm, bm_loop, rtol=1e-9)
+    np.testing.assert_array_equal(inliers, inliers_loop)
+    assert e == pytest.approx(e_loop, rel=1e-9)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 12345])
+def test_ransac_seeded_reproducible(seed):
+    x, y, w = frequency_map_points(62, 7)
+    fits = [ransac_line_fit(x, y, w, I2F_RANDOM_IDCS, I2F_CANDIDATE_ERROR_THD, I2F_CONSENSUS_THD, I2F_MAX_ITERATIONS,
+                            rng=np.random.default_rng(seed)) for _ in range(2)]
+    (bm1, inliers1, e1), (bm2, inliers2, e2) = fits
+    assert bm1 is not None
+    np.testing.assert_array_equal(bm1, bm2)
+    np.testing.assert_array_equal(inliers1, inliers2)
+    assert e1 == e2
+
+
+def test_ransac_without_consensus():
+    x = np.arange(30.); y = np.random.default_rng(0).random(30)
+    bm, inliers, e = ransac_line_fit(x, y, np.ones(30), I2F_RANDOM_IDCS, 1e-9, I2F_CONSENSUS_THD, I2F_MAX_ITERATIONS,
+                                     rng=np.random.default_rng(0))
+    assert bm is None and len(inliers) == 0 and e == np.inf
@@ -0,0 +1,23 @@
+import threading
+import time
+
+from octoprint_ulendocaas import analysis_runner
+from octoprint_ulendocaas.analysis import AnalysisCancelled
+from octoprint_ulendocaas.analysis_runner import AnalysisRunner
+
+
+def slow_analysis(*args, progress=None, **kwargs):
+    for i in range(200): progress('Slow', i/200.); time.sleep(0.01)
+
+
+def test_cancel_reports_whether_a_job_was_active(monkeypatch):
+    monkeypatch.setattr(analysis_runner, 'analyze_manual', slow_analysis)
+    runner = AnalysisRunner(use_process=False)
+    assert not runner.cancel()
+
+    done = threading.Event(); results = []
+    runner.submit(lambda future: (results.append(future.exception()), done.set()))
+    time.sleep(0.05)
+    assert runner.cancel()
+    assert done.wait(5.) and isinstance(results[0], AnalysisCancelled)
+    assert not runner.cancel()
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from math import pi, sqrt
+
+from octoprint_ulendocaas.ismags import impulse_mags, shaper_impulses
+
+
+ZVD_N = ['zv', 'zvd', 'zvdd', 'zvddd'] # ZVD^n, n = 0..3: (1 + k z)^(n+1), normalized.
+MODES = [(2.*pi*f, zt) for f in (20., 42., 95.) for zt in (0., 0.05, 0.2, 0.6)]
+
+
+def response(imp, w, zt):
+    '''The table's response to a mode of damping zt at w, and its derivative in w,
+    as complex sums of the impulses (impulse_mags' residual vibration, up to the
+    decay factor, is the magnitude of the first).'''
+    s = zt + 1j*sqrt(1. - zt*zt)
+    e = imp.a*np.exp(s*w*imp.t)
+    return np.sum(e), np.sum(s*imp.t*e)
+
+
+@pytest.mark.parametrize('type', ZVD_N)
+@pytest.mark.parametrize('wc, zt', MODES)
+def test_amplitudes_sum_to_one(type, wc, zt):
+    imp = shaper_impulses(type, wc, zt)
+    assert np.sum(imp.a) == pytest.approx(1., abs=1e-12) and np.all(imp.a > 0.)
+
+
+@pytest.mark.parametrize('type', ZVD_N)
+@pytest.mark.parametrize('wc, zt', MODES)
+def test_zero_response_at_wc(type, wc, zt):
+    imp = shaper_impulses(type, wc, zt)
+    assert abs(response(imp, wc, zt)[0]) < 1e-12
+    assert impulse_mags(imp, wc, zt) < 1e-12
+    if zt == 0.: assert impulse_mags(imp, wc) < 1e-12
+
+
+@pytest.mark.parametrize('type', ZVD_N[1:])
+@pytest.mark.parametrize('wc, zt', MODES)
+def test_zero_slope_at_wc(type, wc, zt):
+    imp = shaper_impulses(type, wc, zt)
+    # The table's times scale as 1/wc and its amplitudes don't depend on it, so the
+    # slope in wc at a fixed mode is -w/wc times this slope in w.
+    assert abs(response(imp, wc, zt)[1]) < 1e-9*imp.duration
+    # So the residual vibration grows as the square (or higher power) of a frequency error.
+    h = 1e-3; v = impulse_mags(imp, wc*np.array([1. - h, 1. + h]), zt)
+    assert np.all(v < 10.*h*h)
+
+
+@pytest.mark.parametrize('wc, zt', MODES)
+def test_zv_slope_is_not_zero(wc, zt):
+    # ZV's response crosses zero at wc; only the derivative shapers are flat there.
+    imp = shaper_impulses('zv', wc, zt)
+    assert abs(response(imp, wc, zt)[1])*wc > 0.1
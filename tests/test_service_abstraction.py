@@ -0,0 +1,146 @@
+import base64
+import json
+import zlib
+
+import numpy as np
+import pytest
+import requests
+
+from octoprint_ulendocaas import service_abstraction
+from octoprint_ulendocaas.cfg import CAPTURE_ENCODING_LEGACY, CAPTURE_ENCODING_VERSION
+from octoprint_ulendocaas.service_abstraction import encode_capture, post_run_data
+
+
+LSBS = [2.*g/1024.*9806.65 for g in (2., 4., 8., 16.)] # Adxl345's count value at each range.
+
+
+def decode_capture(capture):
+    '''The service's side of the compact capture encoding.'''
+    data = base64.b64decode(capture['DATA'])
+    if capture['COMPRESSION'] == 'zlib': data = zlib.decompress(data)
+    else: assert capture['COMPRESSION'] == 'none'
+    if capture['ENCODING'] == 'int16': samples = (np.frombuffer(data, dtype='<i2')*capture['SCALE']).astype(np.float32)
+    else: samples = np.frombuffer(data, dtype='<f4')
+    assert len(samples) == capture['COUNT']
+    return samples
+
+
+def device_samples(lsb, n=5000, seed=0):
+    '''Samples as Adxl345 stores them: int16 counts times the count value, as float32.'''
+    counts = np.random.default_rng(seed).integers(-512, 512, size=n).astype('<i2')
+    return (counts*lsb).astype(np.float32)
+
+
+@pytest.mark.parametrize('lsb', LSBS)
+def test_counts_round_trip(lsb):
+    samples = device_samples(lsb)
+    capture = encode_capture(samples, lsb)
+    assert capture['ENCODING'] == 'int16' and capture['SCALE'] == lsb
+    np.testing.assert_array_equal(decode_capture(capture), samples)
+
+
+def test_full_scale_counts_round_trip():
+    samples = (np.array([-32768, -32767, 0, 32767])*LSBS[0]).astype(np.float32)
+    capture = encode_capture(samples, LSBS[0])
+    np.testing.assert_array_equal(decode_capture(capture), samples)
+
+
+@pytest.mark.parametrize('samples, lsb', [
+    (np.random.default_rng(1).normal(scale=1000., size=5000).astype(np.float32), LSBS[0]), # Not whole counts.
+    (device_samples(LSBS[0]), LSBS[0]*1.0001), # Whole counts of another value.
+    (device_samples(LSBS[0]), None), # No count value, as simulated.
+    (np.array([40000.*LSBS[0]], dtype=np.float32), LSBS[0]), # Beyond int16.
+])
+def test_float32_unless_whole_counts(samples, lsb):
+    capture = encode_capture(samples, lsb)
+    assert capture['ENCODING'] == 'float32' and 'SCALE' not in capture
+    np.testing.assert_array_equal(decode_capture(capture), samples)
+
+
+def test_uncompressed(monkeypatch):
+    monkeypatch.setattr(service_abstraction, 'CAPTURE_COMPRESS_LEVEL', None)
+    samples = device_samples(LSBS[1])
+    capture = encode_capture(samples, LSBS[1])
+    assert capture['COMPRESSION'] == 'none' and len(base64.b64decode(capture['DATA'])) == 2*len(samples)
+    np.testing.assert_array_equal(decode_capture(capture), samples)
+
+
+class FakeResponse():
+    def __init__(self, status_code, body): self.status_code = status_code; self.text = body if isinstance(body, str) else json.dumps(body)
+    def raise_for_status(self):
+        if self.status_code >= 400: raise requests.exceptions.HTTPError(f'{self.status_code} Error', response=self)
+
+
+class FakeClient():
+    '''Records what's posted and answers from `replies`, (status, body) pairs.'''
+    def __init__(self, capture_encoding, replies):
+        self.capture_encoding = capture_encoding; self.replies = list(replies); self.posts = []
+    def post(self, operation, body, idempotent=False):
+        self.posts.append((operation, json.loads(json.dumps(body)), idempotent)) # As sent, before any later change.
+        return FakeResponse(*self.replies.pop(0))
+
+
+class FakeSettings():
+    def get(self, path): return False if path == ['save_post_data_locally'] else ''
+
+
+class FakeAccelerometer():
+    def __init__(self):
+        self.lsb = LSBS[0]
+        self.x_buff = device_samples(self.lsb, 100, 1); self.y_buff = device_samples(self.lsb, 100, 2); self.z_buff = device_samples(self.lsb, 100, 3)
+
+
+def run_post_data(): return { 'ACTION': 'CALIBRATE', 'OPERATION': 'SOLVE', 'REQUEST': { 'POST_VERSION': '0.0' } }
+
+
+SOLVED = { 'solution': '[1, 2]' }
+
+
+def check_compact(body, accelerometer):
+    assert isinstance(body, dict) and body['REQUEST']['CAPTURE_ENCODING'] == CAPTURE_ENCODING_VERSION
+    np.testing.assert_array_equal(decode_capture(body['XAXISRESPONSE']), accelerometer.x_buff)
+
+
+def check_legacy(body, accelerometer):
+    assert isinstance(body, str) # The post data JSON-encoded, as the service has always taken it.
+    postdata = json.loads(body)
+    assert 'CAPTURE_ENCODING' not in postdata['REQUEST']
+    np.testing.assert_array_equal(np.frombuffer(base64.b64decode(postdata['YAXISRESPONSE']), dtype=np.float32), accelerometer.y_buff)
+
+
+def test_posts_compact_encoding():
+    accelerometer = FakeAccelerometer(); client = FakeClient(CAPTURE_ENCODING_VERSION, [(200, SOLVED)])
+    assert post_run_data(client, 'SOLVE', run_post_data(), accelerometer, FakeSettings()) == SOLVED
+    assert len(client.posts) == 1
+    check_compact(client.posts[0][1], accelerometer)
+
+
+def test_posts_legacy_encoding():
+    accelerometer = FakeAccelerometer(); client = FakeClient(CAPTURE_ENCODING_LEGACY, [(200, SOLVED)])
+    assert post_run_data(client, 'SOLVE', run_post_data(), accelerometer, FakeSettings()) == SOLVED
+    assert len(client.posts) == 1
+    check_legacy(client.posts[0][1], accelerometer)
+
+
+@pytest.mark.parametrize('rejection', [(415, 'Unsupported Media Type'), (200, { 'exception': 'UnsupportedCaptureEncoding' })])
+@pytest.mark.parametrize('idempotent', [False, True])
+def test_resends_legacy_when_turned_down(rejection, idempotent):
+    accelerometer = FakeAccelerometer()
+    client = FakeClient(CAPTURE_ENCODING_VERSION, [rejection, (200, SOLVED), (200, SOLVED)])
+    assert post_run_data(client, 'VERIFY', run_post_data(), accelerometer, FakeSettings(), idempotent=idempotent) == SOLVED
+    assert [(op, i) for op, _, i in client.posts] == [('VERIFY', idempotent)]*2
+    check_compact(client.posts[0][1], accelerometer)
+    check_legacy(client.posts[1][1], accelerometer)
+
+    # And sticks with the legacy encoding from then on.
+    assert client.capture_encoding == CAPTURE_ENCODING_LEGACY
+    post_run_data(client, 'SOLVE', run_post_data(), accelerometer, FakeSettings())
+    check_legacy(client.posts[2][1], accelerometer)
+
+
+@pytest.mark.parametrize('status', [502, 503, 504])
+def test_gateway_error_raises_request_exception(status):
+    # What the calibration's offline fallback catches, rather than a decode error on the HTML body.
+    client = FakeClient(CAPTURE_ENCODING_VERSION, [(status, '<html><body><h1>502 Bad Gateway</h1></body></html>')])
+    with pytest.raises(requests.exceptions.HTTPError):
+        post_run_data(client, 'SOLVE', run_post_data(), FakeAccelerometer(), FakeSettings())
@@ -0,0 +1,145 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from octoprint_ulendocaas import service_client
+from octoprint_ulendocaas.service_client import ServiceClient, _never_sent
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive.
+    disable_nagle_algorithm = True
+    def log_message(self, *args): pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with server.lock:
+            server.requests.append(body); server.client_ports.add(self.client_address[1])
+            status, delay = server.responses.pop(0) if server.responses else (200, 0.)
+        time.sleep(delay)
+        out = json.dumps({'echo': body}).encode()
+        try:
+            self.send_response(status); self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out))); self.end_headers(); self.wfile.write(out)
+        except OSError: pass # The client gave up waiting.
+
+
+@pytest.fixture
+def stand_in():
+    '''A service stand-in on loopback. Queue (status, delay) pairs on `responses`
+    to answer the next requests with; the rest are answered 200 at once.'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock(); server.requests = []; server.client_ports = set(); server.responses = []
+    threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/solve'
+    yield server
+    server.shutdown(); server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch): monkeypatch.setattr(service_client, 'SERVICE_RETRY_BACKOFF', 0.)
+
+
+def closed_port_url():
+    with socket.socket() as s: s.bind(('127.0.0.1', 0)); port = s.getsockname()[1]
+    return f'http://127.0.0.1:{port}/solve'
+
+
+def test_connection_reused(stand_in):
+    client = ServiceClient(url=stand_in.url)
+    for i in range(10):
+        response = client.post('SOLVE', {'i': i})
+        assert response.status_code == 200 and response.json()['echo'] == {'i': i}
+    assert sum(r['new_connections'] for r in client.latencies) == 1
+    assert len(stand_in.client_ports) == 1
+    assert all(r['attempts'] == 1 and r['status'] == 200 for r in client.latencies)
+    assert set(client.latencies[0]) >= {'encode', 'request', 'read', 'total'}
+
+
+def test_body_sent_as_given(stand_in):
+    # The legacy bodies are JSON-encoded strings, to be sent encoded again.
+    client = ServiceClient(url=stand_in.url)
+    client.post('SOLVE', json.dumps({'a': 1}))
+    assert stand_in.requests == ['{"a": 1}']
+
+
+@pytest.mark.parametrize('status', service_client.SERVICE_RETRY_STATUSES)
+def test_idempotent_retried_on_gateway_status(stand_in, status):
+    client = ServiceClient(url=stand_in.url)
+    stand_in.responses = [(status, 0.)]*service_client.SERVICE_MAX_RETRIES
+    response = client.post('VERIFY', {}, idempotent=True)
+    assert response.status_code == 200 and client.latencies[-1]['attempts'] == service_client.SERVICE_MAX_RETRIES + 1
+
+
+def test_idempotent_retries_bounded(stand_in):
+    client = ServiceClient(url=stand_in.url)
+    stand_in.responses = [(503, 0.)]*(service_client.SERVICE_MAX_RETRIES + 2)
+    response = client.post('VERIFY', {}, idempotent=True)
+    assert response.status_code == 503 and client.latencies[-1]['attempts'] == service_client.SERVICE_MAX_RETRIES + 1
+
+
+def test_idempotent_not_retried_on_other_status(stand_in):
+    client = ServiceClient(url=stand_in.url)
+    stand_in.responses = [(500, 0.)]
+    assert client.post('VERIFY', {}, idempotent=True).status_code == 500
+    assert len(stand_in.requests) == 1
+
+
+@pytest.mark.parametrize('operation', ['SOLVE', 'SHARE'])
+@pytest.mark.parametrize('status', service_client.SERVICE_RETRY_STATUSES)
+def test_non_idempotent_not_retried_on_status(stand_in, operation, status):
+    client = ServiceClient(url=stand_in.url)
+    stand_in.responses = [(status, 0.)]
+    assert client.post(operation, {}).status_code == status
+    assert len(stand_in.requests) == 1 and client.latencies[-1]['attempts'] == 1
+
+
+@pytest.mark.parametrize('operation', ['SOLVE', 'SHARE'])
+def test_non_idempotent_retried_when_never_sent(operation):
+    client = ServiceClient(url=closed_port_url())
+    with pytest.raises(requests.exceptions.ConnectionError) as e: client.post(operation, {})
+    assert _never_sent(e.value)
+    assert client.latencies[-1]['attempts'] == service_client.SERVICE_MAX_RETRIES + 1
+    assert client.latencies[-1]['status'] == 'ConnectionError'
+
+
+def test_never_sent():
+    assert _never_sent(requests.exceptions.ConnectTimeout())
+    assert not _never_sent(requests.exceptions.ReadTimeout())
+    assert not _never_sent(requests.exceptions.ConnectionError('Connection aborted.'))
+
+
+def test_timeouts_split_by_operation(stand_in, monkeypatch):
+    monkeypatch.setattr(service_client, 'SERVICE_READ_TIMEOUTS', { 'VERIFY_CREDENTIALS': 0.2 })
+    monkeypatch.setattr(service_client, 'SERVICE_TIMEOUT_THD', 5.)
+    client = ServiceClient(url=stand_in.url)
+    timeouts = []
+    post = client.session.post
+    def spy(*args, **kwargs): timeouts.append(kwargs['timeout']); return post(*args, **kwargs)
+    monkeypatch.setattr(client.session, 'post', spy)
+
+    client.post('SOLVE', {}); client.post('VERIFY_CREDENTIALS', {}, idempotent=True)
+    assert timeouts == [(service_client.SERVICE_CONNECT_TIMEOUT, 5.), (service_client.SERVICE_CONNECT_TIMEOUT, 0.2)]
+
+    # Slower than the operation's read timeout but within the default one.
+    stand_in.responses = [(200, 0.5)]
+    assert client.post('SOLVE', {}).status_code == 200
+    stand_in.responses = [(200, 0.5)]*(service_client.SERVICE_MAX_RETRIES + 1)
+    with pytest.raises(requests.exceptions.ReadTimeout): client.post('VERIFY_CREDENTIALS', {}, idempotent=True)
+    assert client.latencies[-1]['attempts'] == service_client.SERVICE_MAX_RETRIES + 1
+
+
+def test_non_idempotent_not_retried_on_read_timeout(stand_in, monkeypatch):
+    monkeypatch.setattr(service_client, 'SERVICE_READ_TIMEOUTS', { 'SOLVE': 0.2 })
+    client = ServiceClient(url=stand_in.url)
+    stand_in.responses = [(200, 0.5)]
+    with pytest.raises(requests.exceptions.ReadTimeout): client.post('SOLVE', {})
+    assert len(stand_in.requests) == 1 and client.latencies[-1]['attempts'] == 1